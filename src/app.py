@@ -1,7 +1,9 @@
+import importlib
 import logging
 import os
+import threading
+import time
 
-import yfinance as yf
 from flask import (
     Flask,
     Response,
@@ -9,23 +11,80 @@ from flask import (
     redirect,
     render_template,
     request,
+    stream_with_context,
+    url_for,
 )
 from waitress import serve
 
-from cache.utils import populate_all_caches
+from metrics import STARTUP_SECONDS, render_metrics
+from web.api import api
 from web.optimizer import (
+    BACKTEST_YEARS,
     CORR,
     NUM_CONTRACTS,
     NUM_YEARS,
+    REBALANCE_DAYS,
     TaskDB,
     TaskState,
     format_error,
     format_log,
+    get_logger,
     render_optimizer,
+    render_result,
 )
-from web.plot import plot_portfolio
+from web.progress import parse_offset, stream_task_events
+
+# "blocking" populates the caches before the port is bound, "background"
+# binds it right away and populates them in a thread, with /ready returning
+# 503 until they are done
+STARTUP_MODE = os.getenv("STARTUP_MODE", "blocking")
+# imported by the warm-up instead of by the first request that needs them
+WARM_UP_MODULES = ["web.plot", "backend.backtest"]
+
+START_TIME = time.perf_counter()
 
 app = Flask(__name__)
+app.register_blueprint(api)
+ready = threading.Event()
+first_response = threading.Event()
+
+
+def get_process_seconds() -> float:
+    # seconds since the process started, including the interpreter startup and
+    # the imports, from /proc on Linux
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+    except OSError:
+        return time.perf_counter() - START_TIME
+
+
+def record_startup_event(event: str) -> None:
+    seconds = get_process_seconds()
+    STARTUP_SECONDS.set(seconds, event=event)
+    get_logger().info(f"Startup: {event} after {seconds:.2f}s")
+
+
+def warm_up(logger) -> None:
+    from cache.utils import populate_all_caches
+
+    for module in WARM_UP_MODULES:
+        importlib.import_module(module)
+    record_startup_event("imports")
+    populate_all_caches(logger)
+    record_startup_event("ready")
+    ready.set()
+
+
+@app.after_request
+def record_first_response(response: Response) -> Response:
+    if not first_response.is_set():
+        first_response.set()
+        record_startup_event("first_response")
+    return response
 
 
 def are_cookies_allowed() -> bool:
@@ -49,7 +108,7 @@ def ask_for_cookies():
 @app.route("/optimizer.html", methods=["GET", "POST"])
 def index() -> Response:
     # Set up logging
-    app_logger = yf.utils.get_yf_logger()
+    app_logger = get_logger()
 
     # check for cookies
     if not are_cookies_allowed():
@@ -64,14 +123,20 @@ def index() -> Response:
 
 @app.route("/task/<task_id>")
 def task(task_id) -> Response:
-    app_logger = yf.utils.get_yf_logger()
+    app_logger = get_logger()
     app_logger.info("Loading task ID: %s", task_id)
+    TaskDB.poll(task_id)
     task_state = TaskDB.get_state(task_id)
     cookie_dict = {
         "num_contracts": request.cookies.get("num_contracts", NUM_CONTRACTS),
         "corr": request.cookies.get("correlation_cutoff", CORR),
         "num_years": request.cookies.get("num_years", NUM_YEARS),
+        "mode": request.cookies.get("mode", "optimize"),
+        "method": request.cookies.get("method", "mean_variance"),
+        "backtest_years": request.cookies.get("backtest_years", BACKTEST_YEARS),
+        "rebalance_days": request.cookies.get("rebalance_days", REBALANCE_DAYS),
         "submitted": True,
+        "task_id": task_id,
     }
     log_output = format_log(TaskDB.get("log", task_id))
     if task_state == TaskState.NOT_FOUND:
@@ -92,12 +157,12 @@ def task(task_id) -> Response:
                 "optimizer.html",
                 in_progress=False,
                 log_output=log_output,
-                error_output=failure,
+                error_output=format_error(failure),
                 **cookie_dict,
             ),
         )
     elif task_state == TaskState.SUCCESS:
-        portfolio_output = TaskDB.get("result", task_id)
+        portfolio_output = render_result(task_id)
         rsp = make_response(
             render_template(
                 "optimizer.html",
@@ -119,10 +184,45 @@ def task(task_id) -> Response:
     return rsp
 
 
+@app.route("/task/<task_id>/events")
+def task_events(task_id) -> Response:
+    # resume after the last log line the client got if it reconnects
+    offset = parse_offset(
+        request.headers.get("Last-Event-ID", request.args.get("offset"))
+    )
+    return Response(
+        stream_with_context(stream_task_events(task_id, offset)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/task/<task_id>/cancel", methods=["POST"])
+def cancel_task(task_id) -> Response:
+    app_logger = get_logger()
+    if TaskDB.cancel(task_id, "Cancelled by the user"):
+        app_logger.info("Cancelling task ID: %s", task_id)
+    return make_response(redirect(url_for("task", task_id=task_id)))
+
+
+@app.route("/ready")
+def readiness() -> Response:
+    if ready.is_set():
+        return Response("ready", mimetype="text/plain")
+    return Response("starting", status=503, mimetype="text/plain")
+
+
+@app.route("/metrics")
+def metrics() -> Response:
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/plot", methods=["GET"])
 @app.route("/plot.html", methods=["GET"])
 def plot() -> Response:
-    app_logger = yf.utils.get_yf_logger()
+    from web.plot import plot_portfolio
+
+    app_logger = get_logger()
     if not are_cookies_allowed():
         return make_response(render_template("cookies.html", redir_page="plot.html"))
     if request.method == "GET":
@@ -135,7 +235,7 @@ def plot() -> Response:
 if __name__ == "__main__":
     logging.raiseExceptions = True
     logging.basicConfig(level=logging.INFO)
-    logger = yf.utils.get_yf_logger()
+    logger = get_logger()
     if os.getenv("DEV_MODE", "False").lower() == "true":
         logger.setLevel(logging.INFO)
         debug = True
@@ -143,8 +243,16 @@ if __name__ == "__main__":
         logger.setLevel(logging.ERROR)
         debug = False
 
-    populate_all_caches(logger)
+    assert STARTUP_MODE in ("blocking", "background"), STARTUP_MODE
+    if STARTUP_MODE == "background":
+        threading.Thread(target=warm_up, args=(logger,), daemon=True).start()
+    else:
+        warm_up(logger)
 
     # this port needs to be exposed in the Dockerfile
     port = int(os.getenv("PORT", "8080"))
-    serve(app, host="0.0.0.0", port=port)
+    # every open progress page holds a thread for its event stream, up to
+    # MAX_STREAMS of them
+    threads = int(os.getenv("THREADS", "32"))
+    record_startup_event("serve")
+    serve(app, host="0.0.0.0", port=port, threads=threads)
@@ -0,0 +1,294 @@
+import traceback
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from backend.data_quality import MAX_DAILY_RETURN
+from backend.etf import ETFOptimizer, write_to_log
+from backend.yf_utils import YFReturnsCache
+from moments import RollingMoments, nearest_psd
+from opt import find_max_sharpe_portfolio
+from task_control import CancelToken
+
+EPS = 1e-6
+
+
+class WalkForwardBacktest:
+    """Out-of-sample performance of periodically re-running the optimizer
+
+    The ETFs are selected once, on the `num_years` of returns before the
+    backtest period, so that the returns the portfolios are evaluated on do
+    not decide which ETFs they can hold. At every rebalance date the
+    max-sharpe portfolio is found using the trailing `num_years` of returns
+    and then held until the next rebalance date.
+    """
+
+    def __init__(
+        self,
+        currency: str,
+        num_contracts: int,
+        correlation_cutoff: float,
+        num_years: float,
+        backtest_years: float,
+        rebalance_days: int,
+        min_history: float = 0.8,
+        cancel_token: Optional[CancelToken] = None,
+    ):
+        self.num_years = num_years
+        self.backtest_years = backtest_years
+        self.rebalance_days = rebalance_days
+        self.min_history = min_history
+        self.optimizer = ETFOptimizer(
+            currency,
+            num_contracts,
+            correlation_cutoff,
+            num_years,
+            cancel_token=cancel_token,
+        )
+        # the optimizer selects the ETFs on the first lookback window, the
+        # walk forward runs on their returns over the whole period
+        now = self.optimizer.now
+        self.start_date = (
+            now - pd.Timedelta(days=int(365 * (num_years + backtest_years)))
+        ).strftime("%Y-%m-%d")
+        self.end_date = self.optimizer.end_date
+        self.optimizer.start_date = self.start_date
+        self.optimizer.end_date = (
+            now - pd.Timedelta(days=int(365 * backtest_years))
+        ).strftime("%Y-%m-%d")
+        self.num_days_per_year: Optional[float] = None
+        self.weights_df: Optional[pd.DataFrame] = None
+        self.rebalance_df: Optional[pd.DataFrame] = None
+        self.return_series: Optional[pd.Series] = None
+
+    def walk_forward(self, returns_df: pd.DataFrame, logger) -> None:
+        returns = returns_df.to_numpy()
+        num_assets = returns.shape[1]
+        self.num_days_per_year = len(returns_df) / (
+            self.num_years + self.backtest_years
+        )
+        lookback = int(round(self.num_years * self.num_days_per_year))
+        # the first rebalance is on or after the end of the selection window
+        lookback = max(
+            lookback, int((returns_df.index < self.optimizer.end_date).sum())
+        )
+        step = max(1, int(round(self.rebalance_days * self.num_days_per_year / 365)))
+        assert 1 < lookback < len(returns), "Not enough data to backtest"
+
+        moments = RollingMoments(
+            num_assets, shift=np.nanmean(returns[:lookback], axis=0)
+        )
+        moments.add(returns[:lookback])
+        weights = np.zeros(num_assets)
+        weight_rows: List[np.ndarray] = []
+        rebalance_rows: List[Dict] = []
+        period_returns: List[np.ndarray] = []
+        for start in range(lookback, len(returns), step):
+            self.optimizer.cancel_token.check()
+            if start > lookback:
+                # slide the window [start - lookback, start) forward by step
+                moments.add(returns[start - step : start])
+                moments.remove(returns[start - step - lookback : start - lookback])
+            mean_returns = moments.mean()
+            covar_matrix = moments.cov()
+            eligible = (moments.count() >= self.min_history * lookback) & np.isfinite(
+                mean_returns
+            )
+            idx = np.flatnonzero(eligible)
+            date = returns_df.index[start]
+            assert len(idx) > 0, f"No ETF has enough history on {date}"
+            mu = mean_returns[idx]
+            cov = covar_matrix[np.ix_(idx, idx)]
+            risk_free_idx = idx[np.argmin(np.diag(cov))]
+            try:
+                assert np.isfinite(cov).all(), f"Covariance not finite on {date}"
+                cov = nearest_psd(cov)
+                risk_free_rate = mean_returns[risk_free_idx]
+                prev_w = weights[idx]
+                w0 = prev_w / prev_w.sum() if prev_w.sum() > EPS else None
+                w, exp_ret, vol, _ = find_max_sharpe_portfolio(
+                    mu,
+                    cov,
+                    logger,
+                    risk_free_rate,
+                    w0=w0,
+                    telemetry=self.optimizer.solver_telemetry,
+                )
+                new_weights = np.zeros(num_assets)
+                new_weights[idx] = w
+            except Exception as e:  # pylint: disable=broad-except
+                # keep holding the previous portfolio, or the risk-free asset
+                logger.error(f"Error in rebalancing on {date}: {e}")
+                logger.error(traceback.format_exc())
+                new_weights, exp_ret, vol = weights, np.nan, np.nan
+                if new_weights.sum() < EPS:
+                    new_weights = np.zeros(num_assets)
+                    new_weights[risk_free_idx] = 1.0
+            hold = np.nan_to_num(returns[start : start + step])
+            period_return = hold @ new_weights
+            rebalance_rows.append(
+                {
+                    "date": date,
+                    "num_eligible": len(idx),
+                    "num_components": int((new_weights > 0.001).sum()),
+                    "exp_ret": exp_ret * self.num_days_per_year,
+                    "exp_vol": vol * np.sqrt(self.num_days_per_year),
+                    "realized_ret": period_return.sum(),
+                    "turnover": np.abs(new_weights - weights).sum() / 2,
+                }
+            )
+            logger.info(f"Rebalanced on {date}: {rebalance_rows[-1]}")
+            weight_rows.append(new_weights)
+            period_returns.append(period_return)
+            weights = new_weights
+
+        self.rebalance_df = pd.DataFrame(rebalance_rows).set_index("date")
+        self.weights_df = pd.DataFrame(
+            weight_rows, index=self.rebalance_df.index, columns=returns_df.columns
+        )
+        self.return_series = pd.Series(
+            np.concatenate(period_returns), index=returns_df.index[lookback:]
+        )
+
+    def run_backtest(self, task_id: str, logger) -> None:
+        write_to_log(task_id, "Starting walk-forward backtest")
+        self.optimizer.load_returns(task_id, logger, use_corr_index=False)
+        assert self.optimizer.returns_df is not None
+        selected = list(self.optimizer.returns_df.columns)
+        write_to_log(
+            task_id,
+            f"Selected {len(selected)} ETFs from {self.optimizer.start_date} "
+            f"to {self.optimizer.end_date}",
+        )
+        returns_cache = YFReturnsCache(
+            self.start_date,
+            self.end_date,
+            selected,
+            cancel_token=self.optimizer.cancel_token,
+            timings=self.optimizer.timings,
+        )
+        # the selected ETFs are not dropped for returns after the selection,
+        # the outliers are treated as missing instead
+        returns_df = returns_cache.get_return_df(logger, max_return=np.inf)
+        returns_df = returns_df[returns_df.index >= self.start_date]
+        returns_df = returns_df.mask(returns_df.abs() > MAX_DAILY_RETURN)
+        returns_df = returns_df.dropna(how="all")
+        with self.optimizer.timings.stage("walk_forward"):
+            self.walk_forward(returns_df, logger)
+        write_to_log(task_id, f"Solver: {self.optimizer.solver_telemetry}")
+        write_to_log(task_id, f"Time per stage: {self.optimizer.timings}")
+        write_to_log(task_id, "Finished walk-forward backtest")
+
+    def get_stats(self) -> Dict[str, float]:
+        assert self.return_series is not None and self.rebalance_df is not None
+        assert self.num_days_per_year is not None
+        annualized_return = self.return_series.mean() * self.num_days_per_year
+        annualized_volatility = self.return_series.std() * np.sqrt(
+            self.num_days_per_year
+        )
+        value = np.exp(self.return_series.cumsum() / 100)
+        drawdown = 1 - value / np.maximum(value.cummax(), 1.0)
+        return {
+            "annualized_return": annualized_return,
+            "annualized_volatility": annualized_volatility,
+            "sharpe": annualized_return / annualized_volatility,
+            "cumulative_return": value.iloc[-1] - 1,
+            "max_drawdown": max(0.0, drawdown.max()),
+            "avg_turnover": self.rebalance_df["turnover"].iloc[1:].mean(),
+            "avg_exp_ret": self.rebalance_df["exp_ret"].mean(),
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        # structured version of to_html, which is rendered from it, with the
+        # daily returns of the portfolio in percent and the weights of every
+        # rebalance
+        assert self.weights_df is not None and self.rebalance_df is not None
+        assert self.return_series is not None
+        rebalances = self.rebalance_df.reset_index()
+        rebalances["date"] = rebalances["date"].dt.strftime("%Y-%m-%d")
+        rebalances["weights"] = [
+            weights[weights > 0.001].to_dict()
+            for _, weights in self.weights_df.iterrows()
+        ]
+        return {
+            "type": "backtest",
+            "num_years": self.num_years,
+            "backtest_years": self.backtest_years,
+            "rebalance_days": self.rebalance_days,
+            "stats": {k: float(v) for k, v in self.get_stats().items()},
+            "rebalances": rebalances.to_dict(orient="records"),
+            "returns": {
+                "dates": [f"{date:%Y-%m-%d}" for date in self.return_series.index],
+                "values": self.return_series.tolist(),
+            },
+        }
+
+    def to_html(self) -> str:
+        return self.render_html(self.to_dict())
+
+    @staticmethod
+    def render_html(data: Dict[str, Any]) -> str:
+        stats = data["stats"]
+        html_text = "<div class='output'>\n"
+        html_text += "<h2>Walk-Forward Backtest</h2>\n"
+        html_text += (
+            f"<p>Re-optimized every {data['rebalance_days']} days on the trailing "
+            f"{data['num_years']:g} years of returns, over the last "
+            f"{data['backtest_years']:g} years. The universe of ETFs is selected "
+            "once on the returns before the first rebalance.</p>\n"
+        )
+        html_text += "<h3>Out-of-Sample Performance</h3>\n"
+        html_text += "<table class='table-metrics'>\n"
+        html_text += (
+            f"<tr><td>Annualized Return</td>"
+            f"<td>{stats['annualized_return']:.2f}%</td></tr>\n"
+        )
+        html_text += (
+            f"<tr><td>Annualized Volatility</td>"
+            f"<td>{stats['annualized_volatility']:.2f}%</td></tr>\n"
+        )
+        html_text += (
+            f"<tr><td>Return / Volatility</td><td>{stats['sharpe']:.2f}</td></tr>\n"
+        )
+        html_text += (
+            f"<tr><td>Cumulative Return</td>"
+            f"<td>{stats['cumulative_return']:.2%}</td></tr>\n"
+        )
+        html_text += (
+            f"<tr><td>Max Drawdown from Peak</td>"
+            f"<td>{stats['max_drawdown']:.2%}</td></tr>\n"
+        )
+        html_text += (
+            f"<tr><td>Average Turnover per Rebalance</td>"
+            f"<td>{stats['avg_turnover']:.2%}</td></tr>\n"
+        )
+        html_text += (
+            f"<tr><td>Average In-Sample Expected Return</td>"
+            f"<td>{stats['avg_exp_ret']:.2f}%</td></tr>\n"
+        )
+        html_text += "</table>\n"
+
+        html_text += "<h3>Rebalances</h3>\n"
+        html_text += "<table class='table-metrics'><tr><th>Date</th>"
+        html_text += "<th>Eligible ETFs</th><th>Components</th>"
+        html_text += "<th>Expected Return</th><th>Expected Volatility</th>"
+        html_text += "<th>Realized Return</th><th>Turnover</th></tr>\n"
+        for row in data["rebalances"]:
+            html_text += f"<tr><td>{row['date']}</td>"
+            html_text += f"<td>{row['num_eligible']}</td>"
+            html_text += f"<td>{row['num_components']}</td>"
+            html_text += f"<td>{row['exp_ret']:.2f}%</td>"
+            html_text += f"<td>{row['exp_vol']:.2f}%</td>"
+            html_text += f"<td>{row['realized_ret']:.2f}%</td>"
+            html_text += f"<td>{row['turnover']:.2%}</td></tr>\n"
+        html_text += "</table>\n"
+
+        html_text += "<h3>Latest Portfolio</h3>\n"
+        html_text += "<table class='table-metrics'>"
+        html_text += "<tr><th>Component</th><th>Weight</th></tr>\n"
+        for etf, weight in data["rebalances"][-1]["weights"].items():
+            html_text += f"<tr><td>{etf}</td><td>{weight:.2%}</td></tr>\n"
+        html_text += "</table>\n"
+        html_text += "</div>\n"
+        return html_text
@@ -0,0 +1,252 @@
+"""
+Sources of the ETF list, ETF metadata and prices
+
+The provider is chosen with the DATA_PROVIDER environment variable:
+- "yahoo" (default): pyetfdb_scraper for the ETF list and Yahoo Finance for
+  the metadata and prices
+- "local": files recorded in DATA_DIR, so that runs do not depend on Yahoo
+  and can be reproduced offline
+- "record": Yahoo, and everything it returns is also recorded in DATA_DIR,
+  e.g. when building the nightly caches to keep a local mirror in sync
+- "http": the same files served from DATA_URL, e.g. by the Yahoo stand-in
+  of loadtest.py
+
+DATA_DIR has etfs.csv with one row per ETF (its metadata is empty until it
+is fetched) and prices/<symbol>.csv with the daily prices of every ETF, in
+the columns returned by yf.download.
+
+"""
+
+import functools
+import os
+import urllib.error
+import urllib.parse
+import urllib.request
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+import yfinance as yf
+from filelock import FileLock
+from pyetfdb_scraper.etf import load_etfs
+from yfinance.exceptions import YFTickerMissingError
+
+from cache import CACHE_DIR
+
+DATA_PROVIDER = os.getenv("DATA_PROVIDER", "yahoo")
+DATA_DIR = Path(os.getenv("DATA_DIR", str(CACHE_DIR / "market_data")))
+DATA_URL = os.getenv("DATA_URL", "http://127.0.0.1:8081")
+DATA_TIMEOUT = float(os.getenv("DATA_TIMEOUT", "30"))
+# metadata rows recorded before etfs.csv is rewritten
+RECORD_BATCH_SIZE = 100
+ETF_INFO_KEYS = [
+    "quoteType",
+    "exchange",
+    "three_month_average_volume",
+    "fifty_day_average",
+    "currency",
+]
+
+
+class DataProvider(object):
+    def list_etfs(self) -> List[str]:
+        raise NotImplementedError
+
+    def get_etf_info(self, symbol: str) -> Dict[str, Any]:
+        # the values of ETF_INFO_KEYS, as in yf.Ticker(symbol).fast_info
+        raise NotImplementedError
+
+    def download_prices(self, tickers: List[str], start: str, end: str):
+        # daily prices from start to end (excluded) with (field, ticker)
+        # columns, as returned by yf.download
+        raise NotImplementedError
+
+    def flush(self) -> None:
+        # save what was recorded and not saved yet, if anything
+        pass
+
+
+class YahooProvider(DataProvider):
+    def list_etfs(self) -> List[str]:
+        return load_etfs()
+
+    def get_etf_info(self, symbol: str) -> Dict[str, Any]:
+        try:
+            info = yf.Ticker(symbol).fast_info
+            return {key: info[key] for key in ETF_INFO_KEYS}
+        except YFTickerMissingError:
+            info = yf.Ticker(symbol).info
+            return {key: info[key] for key in ETF_INFO_KEYS}
+
+    def download_prices(self, tickers: List[str], start: str, end: str):
+        return yf.download(tickers, start=start, end=end)
+
+
+class LocalProvider(DataProvider):
+    def __init__(self, data_dir: Path = DATA_DIR):
+        self.data_dir = data_dir
+        self.etfs_csv = data_dir / "etfs.csv"
+        self.price_dir = data_dir / "prices"
+        # etfs.csv indexed by symbol, and its mtime when it was read
+        self.etf_index: Optional[pd.DataFrame] = None
+        self.etf_mtime: Optional[float] = None
+
+    def get_price_csv(self, ticker: str) -> Path:
+        return self.price_dir / f"{ticker}.csv"
+
+    def load_etf_df(self) -> pd.DataFrame:
+        if not self.etfs_csv.exists():
+            return pd.DataFrame(columns=["symbol"] + ETF_INFO_KEYS)
+        return pd.read_csv(self.etfs_csv)
+
+    def list_etfs(self) -> List[str]:
+        return list(self.load_etf_df()["symbol"])
+
+    def get_etf_index(self) -> pd.DataFrame:
+        # only read again when another process changed the file
+        mtime = self.etfs_csv.stat().st_mtime if self.etfs_csv.exists() else None
+        if (self.etf_index is None) or (self.etf_mtime != mtime):
+            self.etf_index = self.load_etf_df().set_index("symbol")
+            self.etf_mtime = mtime
+        return self.etf_index
+
+    def get_etf_info(self, symbol: str) -> Dict[str, Any]:
+        etf_df = self.get_etf_index()
+        if (symbol not in etf_df.index) or etf_df.loc[symbol].isna().any():
+            raise KeyError(f"No recorded metadata for {symbol}")
+        return {key: etf_df.loc[symbol, key] for key in ETF_INFO_KEYS}
+
+    def read_price_df(self, ticker: str) -> Optional[pd.DataFrame]:
+        if not self.get_price_csv(ticker).exists():
+            return None
+        return pd.read_csv(self.get_price_csv(ticker), index_col=0, parse_dates=True)
+
+    def download_prices(self, tickers: List[str], start: str, end: str):
+        price_dfs = {}
+        for ticker in tickers:
+            price_df = self.read_price_df(ticker)
+            if price_df is not None:
+                price_dfs[ticker] = price_df[
+                    (price_df.index >= start) & (price_df.index < end)
+                ]
+        if not price_dfs:
+            return pd.DataFrame()
+        return pd.concat(price_dfs, axis=1).swaplevel(axis=1).sort_index(axis=1)
+
+
+class RecordingProvider(LocalProvider):
+    """Yahoo, with everything it returns added to the local files"""
+
+    def __init__(self, data_dir: Path = DATA_DIR):
+        super().__init__(data_dir)
+        self.yahoo = YahooProvider()
+        self.price_dir.mkdir(parents=True, exist_ok=True)
+        # metadata fetched since etfs.csv was last saved
+        self.etf_rows: List[Dict[str, Any]] = []
+
+    def save_etf_rows(self, etf_df: pd.DataFrame) -> None:
+        # updates the rows of etf_df in place and adds the new ones at the end
+        with FileLock(str(self.etfs_csv) + ".lock", timeout=20):
+            old_df = self.load_etf_df().set_index("symbol")
+            new_df = etf_df.set_index("symbol")
+            symbols = list(old_df.index)
+            symbols += [x for x in new_df.index if x not in old_df.index]
+            etf_df = new_df.combine_first(old_df).reindex(symbols)
+            tmp_csv = self.etfs_csv.with_suffix(".tmp")
+            etf_df[ETF_INFO_KEYS].to_csv(tmp_csv, index_label="symbol")
+            os.replace(tmp_csv, self.etfs_csv)
+
+    def list_etfs(self) -> List[str]:
+        etf_list = self.yahoo.list_etfs()
+        # the metadata that is already recorded is kept
+        known = set(self.load_etf_df()["symbol"])
+        new_etfs = [x for x in etf_list if x not in known]
+        if new_etfs:
+            self.save_etf_rows(pd.DataFrame({"symbol": new_etfs}))
+        return etf_list
+
+    def get_etf_info(self, symbol: str) -> Dict[str, Any]:
+        info = self.yahoo.get_etf_info(symbol)
+        self.etf_rows.append({"symbol": symbol, **info})
+        if len(self.etf_rows) >= RECORD_BATCH_SIZE:
+            self.flush()
+        return info
+
+    def flush(self) -> None:
+        if self.etf_rows:
+            # the last metadata of a symbol fetched twice wins
+            etf_df = pd.DataFrame(self.etf_rows).drop_duplicates("symbol", keep="last")
+            self.etf_rows = []
+            self.save_etf_rows(etf_df)
+
+    def download_prices(self, tickers: List[str], start: str, end: str):
+        price_df = self.yahoo.download_prices(tickers, start, end)
+        if isinstance(price_df, pd.DataFrame) and not price_df.empty:
+            for ticker in price_df.columns.get_level_values(1).unique():
+                ticker_df = price_df.xs(ticker, axis=1, level=1)
+                assert isinstance(ticker_df, pd.DataFrame)
+                ticker_df = ticker_df.dropna(how="all")
+                if ticker_df.empty:
+                    continue
+                price_csv = self.get_price_csv(ticker)
+                with FileLock(str(price_csv) + ".lock", timeout=20):
+                    if price_csv.exists():
+                        old_df = pd.read_csv(price_csv, index_col=0, parse_dates=True)
+                        ticker_df = ticker_df.combine_first(old_df)
+                    tmp_csv = price_csv.with_suffix(".tmp")
+                    ticker_df.to_csv(tmp_csv)
+                    os.replace(tmp_csv, price_csv)
+        return price_df
+
+
+class HttpProvider(LocalProvider):
+    """Files in the layout of DATA_DIR served over HTTP from DATA_URL
+
+    Used with loadtest.py, which serves them with injected latency and
+    errors as a stand-in for Yahoo. Like yf.download, the tickers that fail
+    are missing from the prices instead of raising.
+    """
+
+    def __init__(self, data_url: str = DATA_URL, timeout: float = DATA_TIMEOUT):
+        super().__init__()
+        self.data_url = data_url.rstrip("/")
+        self.timeout = timeout
+        self.etf_df: Optional[pd.DataFrame] = None
+
+    def read_url(self, path: str) -> Optional[pd.DataFrame]:
+        try:
+            with urllib.request.urlopen(
+                f"{self.data_url}/{path}", timeout=self.timeout
+            ) as response:
+                return pd.read_csv(response, index_col=0)
+        except (OSError, urllib.error.URLError):
+            return None
+
+    def load_etf_df(self) -> pd.DataFrame:
+        # the served files do not change, the ETF list is only fetched once
+        if self.etf_df is None:
+            etf_df = self.read_url("etfs.csv")
+            if etf_df is None:
+                return pd.DataFrame(columns=["symbol"] + ETF_INFO_KEYS)
+            self.etf_df = etf_df.reset_index()
+        return self.etf_df
+
+    def read_price_df(self, ticker: str) -> Optional[pd.DataFrame]:
+        price_df = self.read_url(f"prices/{urllib.parse.quote(ticker)}.csv")
+        if price_df is not None:
+            price_df.index = pd.to_datetime(price_df.index)
+        return price_df
+
+
+PROVIDERS = {
+    "yahoo": YahooProvider,
+    "local": LocalProvider,
+    "record": RecordingProvider,
+    "http": HttpProvider,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def get_data_provider() -> DataProvider:
+    assert DATA_PROVIDER in PROVIDERS, f"Unknown data provider {DATA_PROVIDER}"
+    return PROVIDERS[DATA_PROVIDER]()
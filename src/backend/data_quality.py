@@ -0,0 +1,112 @@
+"""
+Data-quality checks of a panel of daily returns
+
+The returns are the log returns in percent of YFReturnsCache, computed from
+forward-filled prices, so a missing or stale price shows up as a return of
+exactly 0. Every ticker of the panel gets a row of statistics in one
+vectorized pass, and a verdict with the first check it fails:
+- outliers: a daily return larger than max_return in magnitude
+- splits: a daily return matching a split ratio, a split that is not
+  reflected in the adjusted prices
+- missing values: less than MIN_VALID_RATIO of the days have a return
+- stale prices: more than MAX_STALE_DAYS days in a row without a change
+
+"""
+
+import numpy as np
+import pandas as pd
+
+MAX_DAILY_RETURN = 50
+MIN_VALID_RATIO = 0.8
+MAX_STALE_DAYS = 10
+SPLIT_FACTORS = (1.5, 2, 3, 4, 5, 10, 20)
+# distance to the log return of a split, in percent
+SPLIT_TOLERANCE = 0.25
+VERDICT_COLUMNS = [
+    "mean_return",
+    "valid_ratio",
+    "max_abs_return",
+    "max_stale_days",
+    "num_splits",
+    "reason",
+    "ok",
+]
+
+
+def get_max_run(mask: np.ndarray) -> np.ndarray:
+    # length of the longest run of True in every column
+    counts = np.cumsum(mask, axis=0)
+    resets = np.maximum.accumulate(np.where(mask, 0, counts), axis=0)
+    return (counts - resets).max(axis=0, initial=0)
+
+
+def get_reasons(stats_df: pd.DataFrame, max_return=MAX_DAILY_RETURN) -> pd.Series:
+    """First check failed by every ticker, "" for the ones that pass
+
+    Parameters
+    ----------
+    stats_df : pd.DataFrame
+        Statistics of check_returns, one row per ticker
+    max_return : float
+        Largest daily return in percent, in magnitude
+
+    Returns
+    -------
+    pd.Series
+        Reasons to reject the tickers, indexed like stats_df
+    """
+    reasons = np.select(
+        [
+            stats_df["max_abs_return"] > max_return,
+            stats_df["num_splits"] > 0,
+            stats_df["valid_ratio"] < MIN_VALID_RATIO,
+            stats_df["max_stale_days"] > MAX_STALE_DAYS,
+        ],
+        [
+            f"has at least one daily return > {max_return} in magnitude",
+            "has a daily return like an unadjusted split",
+            "has too many missing values",
+            f"has more than {MAX_STALE_DAYS} days in a row of unchanged prices",
+        ],
+        default="",
+    )
+    return pd.Series(reasons, index=stats_df.index, dtype=str)
+
+
+def check_returns(
+    returns_df: pd.DataFrame, max_return=MAX_DAILY_RETURN
+) -> pd.DataFrame:
+    """Verdicts of the data-quality checks of every ticker
+
+    Parameters
+    ----------
+    returns_df : pd.DataFrame
+        Daily log returns in percent, one column per ticker
+    max_return : float
+        Largest daily return in percent, in magnitude
+
+    Returns
+    -------
+    pd.DataFrame
+        VERDICT_COLUMNS indexed by ticker, with ok False for the tickers
+        that fail a check and the first one they fail in reason
+    """
+    returns = returns_df.to_numpy(dtype=float)
+    abs_returns = np.abs(returns)
+    is_split = np.zeros(returns.shape, dtype=bool)
+    for factor in SPLIT_FACTORS:
+        is_split |= np.abs(abs_returns - 100 * np.log(factor)) < SPLIT_TOLERANCE
+    num_days = max(len(returns_df), 1)
+    verdict_df = pd.DataFrame(
+        {
+            "mean_return": returns_df.mean(),
+            "valid_ratio": returns_df.notnull().sum() / num_days,
+            "max_abs_return": returns_df.abs().max(),
+            "max_stale_days": get_max_run(returns == 0),
+            "num_splits": is_split.sum(axis=0),
+        },
+        index=returns_df.columns,
+    )
+    verdict_df["reason"] = get_reasons(verdict_df, max_return)
+    verdict_df["ok"] = verdict_df["reason"] == ""
+    return verdict_df
@@ -1,14 +1,126 @@
-from typing import List, Optional
+import dataclasses
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 
 import numpy as np
 import pandas as pd
-from pyetfdb_scraper.etf import load_etfs
 
-import web.optimizer
-from backend.yf_utils import YFDataQualityError, YFReturnsCache
+from backend.data_provider import get_data_provider
+from backend.yf_utils import (
+    YFDataQualityError,
+    YFDownloadError,
+    YFError,
+    YFReturnsCache,
+)
+from cache.corr_index import CorrelationIndex, CorrelationIndexCache
 from cache.etf_volume import ETFVolumeCache
-from opt import calc_eff_front, find_min_var_portfolio
+from cache.failed_tickers import FailedTickerCache, Failure
+from cache.moment_snapshot import MomentSnapshotCache
+from hrp import find_hrp_portfolio
+from memory import SCAN_DEPTH
+from metrics import TaskTimings
+from moments import (
+    FactorCovariance,
+    ledoit_wolf_shrinkage,
+    nearest_psd,
+    pairwise_moments,
+)
+from opt import Covariance, find_max_sharpe_portfolio
 from portfolio import Asset, Portfolio
+from solver_telemetry import SolverTelemetry
+from task_control import CancelToken, TimeBudget
+from web.tasks import TaskDB
+
+NUM_FACTORS = 10
+# change of a correlation per day of new returns that a refresh assumes, the
+# pairs closer than that to the cutoff are compared again. It is a heuristic,
+# not a bound: a few outliers entering or leaving the window can move a
+# correlation further, so REFRESH_CHECK_PAIRS of the reused ones are checked
+REFRESH_CORR_MARGIN = 0.01
+REFRESH_CHECK_PAIRS = 100
+# a refresh after more days than this computes all the correlations again
+REFRESH_MAX_DAYS = 7
+EPS = 1e-6
+
+
+def write_to_log(task_id: str, msg: str):
+    log_text = TaskDB.get("log", task_id)
+    assert log_text is not None
+    ts = pd.Timestamp.now("UTC").strftime("%Y-%m-%d %H:%M:%S")
+    new_msg = f"{log_text.rstrip()}\n{ts}: {msg}"
+    TaskDB.put("log", task_id, new_msg)
+
+
+@dataclasses.dataclass
+class RefreshState(object):
+    """What a run of the optimizer leaves to the run of the next day
+
+    Only sweep.py --state keeps it between runs. The web tasks do not: each
+    of them selects from the correlation index built by the nightly job, or
+    computes its correlations from scratch.
+    """
+
+    end_date: str
+    # correlations of the pairs compared by the selection
+    corr_cache: Dict[Tuple[str, str], float]
+    portfolio: Optional[Portfolio]
+    # end date of the returns each correlation was computed on, if before
+    # end_date because it was reused since
+    corr_dates: Dict[Tuple[str, str], str] = dataclasses.field(default_factory=dict)
+
+    def get_corr_date(self, key: Tuple[str, str]) -> str:
+        return self.corr_dates.get(key, self.end_date)
+
+    def get_corr_cache(
+        self, end_date: str, correlation_cutoffs: Sequence[float]
+    ) -> Dict[Tuple[str, str], float]:
+        # the correlations that cannot have crossed any of the cutoffs by
+        # end_date since they were computed, the selection computes the
+        # others again
+        num_days = {
+            date: (pd.Timestamp(end_date) - pd.Timestamp(date)).days
+            for date in set(self.corr_dates.values()) | {self.end_date}
+        }
+        corr_cache = {}
+        for key, corr in self.corr_cache.items():
+            days = num_days[self.get_corr_date(key)]
+            if not 0 <= days <= REFRESH_MAX_DAYS:
+                continue
+            margin = REFRESH_CORR_MARGIN * max(days, 1)
+            if all(abs(corr - x) > margin for x in correlation_cutoffs):
+                corr_cache[key] = corr
+        return corr_cache
+
+    @staticmethod
+    def check_corr_cache(
+        corr_cache: Dict[Tuple[str, str], float],
+        returns_cache: YFReturnsCache,
+        start_date: str,
+        correlation_cutoffs: Sequence[float],
+        num_pairs: int = REFRESH_CHECK_PAIRS,
+    ) -> Optional[Tuple[str, str]]:
+        """Compute a random sample of the reused correlations again
+
+        Returns the first pair of the sample whose correlation from
+        start_date is on the other side of a cutoff than the reused one,
+        None if there is none.
+        """
+        keys = sorted(corr_cache)
+        rng = np.random.default_rng(0)
+        for i in rng.permutation(len(keys))[:num_pairs]:
+            etf1, etf2 = keys[i]
+            try:
+                series1 = returns_cache.get_return_series(etf1)
+                series2 = returns_cache.get_return_series(etf2)
+            except (YFError, KeyError):
+                continue
+            corr = series1[series1.index >= start_date].corr(
+                series2[series2.index >= start_date]
+            )
+            if any(
+                (corr > x) != (corr_cache[keys[i]] > x) for x in correlation_cutoffs
+            ):
+                return keys[i]
+        return None
 
 
 class ETFOptimizer:
@@ -19,11 +131,34 @@ class ETFOptimizer:
         num_contracts: int,
         correlation_cutoff: float,
         num_years: float,
+        shrinkage: bool = False,
+        covariance: str = "sample",
+        num_factors: int = NUM_FACTORS,
+        method: str = "mean_variance",
+        cancel_token: Optional[CancelToken] = None,
+        refresh_state: Optional[RefreshState] = None,
     ):
+        # covariance is "sample" for the pairwise-complete covariance or
+        # "factor" for a PCA factor model with num_factors factors; method is
+        # "mean_variance" for the max-sharpe portfolio on the efficient
+        # frontier or "hrp" for Hierarchical Risk Parity; with the
+        # refresh_state of a recent run, only the correlations that may have
+        # crossed the cutoff are computed again and the solver starts from
+        # the previous frontier
+        assert covariance in ("sample", "factor"), covariance
+        # the factor model is already a regularized estimate
+        assert not (
+            shrinkage and covariance == "factor"
+        ), "Shrinkage only applies to the sample covariance"
+        assert method in ("mean_variance", "hrp"), method
         self.currency = currency
         self.num_contracts = num_contracts
         self.correlation_cutoff = correlation_cutoff
         self.num_years = num_years
+        self.shrinkage = shrinkage
+        self.covariance = covariance
+        self.num_factors = num_factors
+        self.method = method
         self.contract_list: Optional[List[str]] = None
         self.now = pd.Timestamp.now("UTC")
         self.cache_cutoff_time = self.now - pd.Timedelta(days=7)
@@ -34,39 +169,121 @@ class ETFOptimizer:
         self.portfolio: Optional[Portfolio] = None
         self.returns_df: Optional[pd.DataFrame] = None
         self.etf_volume_cache: Optional[ETFVolumeCache] = None
+        self.budget = TimeBudget(None)
+        self.cancel_token = CancelToken() if cancel_token is None else cancel_token
+        self.timings = TaskTimings()
+        self.solver_telemetry = SolverTelemetry()
+        self.corr_cache: Dict[Tuple[str, str], float] = {}
+        # when the reused correlations were computed
+        self.corr_dates: Dict[Tuple[str, str], str] = {}
+        self.prev_portfolio: Optional[Portfolio] = None
+        if refresh_state is not None:
+            self.corr_cache = refresh_state.get_corr_cache(
+                self.end_date, [correlation_cutoff]
+            )
+            self.corr_dates = {
+                key: refresh_state.get_corr_date(key) for key in self.corr_cache
+            }
+            self.prev_portfolio = refresh_state.portfolio
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # sweep.py optimizes in worker processes, where the optimizer gets a
+        # token, timings and telemetry of its own
+        state = self.__dict__.copy()
+        for key in ("cancel_token", "timings", "solver_telemetry"):
+            del state[key]
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self.cancel_token = CancelToken()
+        self.timings = TaskTimings()
+        self.solver_telemetry = SolverTelemetry()
 
     def set_contract_list(self, logger):
         assert self.etf_volume_cache is not None
-        df = self.etf_volume_cache.as_dataframe()
-        df = df[
-            pd.notnull(df["volume"])
-            & pd.notnull(df["price"])
-            & pd.notnull(df["currency"])
-            & (df["volume"] > 0)
-            & (df["price"] > 0)
-            & (df["currency"] == self.currency)
-        ]
-        df["notional"] = df["volume"] * df["price"]
-        df = df.sort_values("notional", ascending=False)
-        self.contract_list = list(df["symbol"].values)
+        self.contract_list = self.etf_volume_cache.ranked_symbols(self.currency)
         assert self.contract_list is not None
+        num_skipped = len(self.skip_failed_tickers())
+        if num_skipped > 0:
+            logger.info(f"Skipping {num_skipped} ETFs that failed recently")
         logger.info(f"Using {len(self.contract_list)} ETFs in {self.currency}")
 
-    def set_top_etf_return_df(self, logger) -> List[str]:
+    def skip_failed_tickers(self) -> List[str]:
+        # the ETFs that recently failed to download or failed the data-quality
+        # checks are removed from the contract list without downloading them
+        assert self.contract_list is not None
+        failures = FailedTickerCache.get_failures(self.contract_list, self.start_date)
+        self.contract_list = [x for x in self.contract_list if x not in failures]
+        return [f"Skipping {etf}: {reason}" for etf, reason in failures.items()]
+
+    def set_top_etf_return_df(
+        self,
+        logger,
+        returns_cache: Optional[YFReturnsCache] = None,
+        corr_cache: Optional[Dict[Tuple[str, str], float]] = None,
+        use_corr_index: bool = True,
+    ) -> List[str]:
+        # returns_cache may cover a longer period than this optimizer and can
+        # be shared between optimizers; corr_cache can only be shared between
+        # optimizers with the same start and end dates. The correlation index
+        # is computed on the latest returns, so a selection that ends earlier
+        # must not use it
+        if corr_cache is None:
+            corr_cache = self.corr_cache
         returns_df = None
-        msg_list = []
+        # in case the contract list was set before they failed
+        msg_list = self.skip_failed_tickers()
         assert self.contract_list is not None
-        returns_cache = YFReturnsCache(
-            self.start_date,
-            self.end_date,
-            self.contract_list,
-        )
+        failures: List[Failure] = []
+        checked = []
+        # the selections that download the candidates themselves show how
+        # deep they scan
+        observe_scan = returns_cache is None
+        if returns_cache is None:
+            corr_index = CorrelationIndexCache.load() if use_corr_index else None
+            if (corr_index is not None) and corr_index.covers(
+                self.currency, self.num_years, self.correlation_cutoff
+            ):
+                index_msg_list = self.select_from_corr_index(corr_index, logger)
+                if index_msg_list is not None:
+                    return msg_list + index_msg_list
+                logger.info("Correlation index does not cover the selection")
+            returns_cache = YFReturnsCache(
+                self.start_date,
+                self.end_date,
+                self.contract_list,
+                cancel_token=self.cancel_token,
+                timings=self.timings,
+            )
         for etf in self.contract_list:
+            self.cancel_token.check()
+            if (
+                (returns_df is not None)
+                and (len(returns_df.columns) >= 2)
+                and self.budget.should_stop()
+            ):
+                msg_list.append(
+                    f"Out of time, stopped selection at {len(returns_df.columns)} "
+                    "ETFs"
+                )
+                break
             try:
                 return_series = returns_cache.get_return_series(etf)
             except YFDataQualityError as e:
                 msg_list.append(f"Ignoring dta for {etf}: {e}")
+                failures.append(
+                    (etf, "data_quality", e.message, returns_cache.start_date)
+                )
+                continue
+            verdict = returns_cache.get_verdicts(self.start_date).loc[etf]
+            if not verdict["ok"]:
+                reason = str(verdict["reason"])
+                msg_list.append(f"{etf} {reason}")
+                failures.append((etf, "data_quality", reason, self.start_date))
                 continue
+            checked.append(etf)
+            return_series = return_series[return_series.index >= self.start_date]
             if returns_df is None:
                 returns_df = pd.DataFrame(index=return_series.index)
             else:
@@ -75,13 +292,10 @@ class ETFOptimizer:
                 combined_index = sorted(old_index.union(new_index))
                 if len(combined_index) > len(old_index):
                     returns_df = returns_df.reindex(combined_index)
-            if return_series.notnull().sum() < 0.8 * len(return_series):
-                msg_list.append(f"{etf} has too many missing values")
-                continue
             returns_df[etf] = return_series
             for col in returns_df:
                 if col != etf:
-                    corr = returns_df[etf].corr(returns_df[col])
+                    corr = self.get_corr(returns_df, etf, str(col), corr_cache)
                     if corr > self.correlation_cutoff:
                         logger.info(f"{etf} and {col} have high correlation: {corr}")
                         avg_return = returns_df[[etf, col]].mean().sort_values()
@@ -97,38 +311,205 @@ class ETFOptimizer:
                         break
             if len(returns_df.columns) >= self.num_contracts:
                 break
+        if returns_cache.record_failures:
+            FailedTickerCache.record(failures)
+            FailedTickerCache.clear(checked, self.start_date)
         assert returns_df is not None
+        if observe_scan:
+            SCAN_DEPTH.observe(len(returns_cache.data), len(returns_df.columns))
         returns_df = returns_df.dropna(axis=0, how="all")
         self.returns_df = returns_df
         return msg_list
 
-    def run_optimizer(self, task_id: str, logger):
-        def write_to_log(msg: str):
-            log_text = web.optimizer.TaskDB.get("log", task_id)
-            assert log_text is not None
-            ts = pd.Timestamp.now("UTC").strftime("%Y-%m-%d %H:%M:%S")
-            new_msg = f"{log_text.rstrip()}\n{ts}: {msg}"
-            web.optimizer.TaskDB.put("log", task_id, new_msg)
-
-        write_to_log("Starting optimizer")
-        ETFVolumeCache.process_cache(logger, days_to_prune_after=7, chunk_size=100)
-        write_to_log("Updated ETF metadata cache")
-        etf_list = load_etfs()
-        self.etf_volume_cache = ETFVolumeCache(etf_list)
-        self.set_contract_list(logger)
-        msg_list = self.set_top_etf_return_df(logger)
+    def select_from_corr_index(
+        self, corr_index: CorrelationIndex, logger
+    ) -> Optional[List[str]]:
+        # same selection as set_top_etf_return_df, with the statistics and
+        # correlations looked up in the index, so that only the selected ETFs
+        # are downloaded; None if the selection runs past the index
+        msg_list = []
+        selected: List[str] = []
+        assert self.contract_list is not None
+        for etf in self.contract_list:
+            if etf not in corr_index:
+                return None
+            if corr_index.reasons[etf]:
+                msg_list.append(f"{etf} {corr_index.reasons[etf]}")
+                continue
+            selected.append(etf)
+            for col in selected[:-1]:
+                corr = corr_index.get_corr(etf, col)
+                if (corr is not None) and (corr > self.correlation_cutoff):
+                    logger.info(f"{etf} and {col} have high correlation: {corr}")
+                    lower_return_col, higher_return_col = sorted(
+                        [etf, col], key=lambda x: corr_index.stats[x]["mean_return"]
+                    )
+                    msg_list.append(
+                        f"Removing {lower_return_col} in favour of "
+                        f"{higher_return_col} from returns_df due to high corr",
+                    )
+                    selected.remove(lower_return_col)
+                    break
+            if len(selected) >= self.num_contracts:
+                break
+        logger.info(f"Selected {len(selected)} ETFs from the correlation index")
+
+        returns_cache = YFReturnsCache(
+            self.start_date,
+            self.end_date,
+            selected,
+            cancel_token=self.cancel_token,
+            timings=self.timings,
+        )
+        return_series: Dict[str, pd.Series] = {}
+        for etf in selected:
+            self.cancel_token.check()
+            if (len(return_series) >= 2) and self.budget.should_stop():
+                msg_list.append(
+                    f"Out of time, stopped download at {len(return_series)} ETFs"
+                )
+                break
+            try:
+                return_series[etf] = returns_cache.get_return_series(etf)
+            except YFDataQualityError as e:
+                msg_list.append(f"Ignoring dta for {etf}: {e}")
+            except KeyError as e:
+                raise YFDownloadError(f"Failed to download data for {etf}") from e
+        returns_df = pd.DataFrame(return_series)
+        self.returns_df = returns_df.dropna(axis=0, how="all")
+        return msg_list
+
+    @staticmethod
+    def get_corr(
+        returns_df: pd.DataFrame,
+        etf1: str,
+        etf2: str,
+        corr_cache: Optional[Dict[Tuple[str, str], float]] = None,
+    ) -> float:
+        key = (min(etf1, etf2), max(etf1, etf2))
+        if (corr_cache is not None) and (key in corr_cache):
+            return corr_cache[key]
+        corr = returns_df[etf1].corr(returns_df[etf2])
+        if corr_cache is not None:
+            corr_cache[key] = corr
+        return corr
+
+    def should_stop(self) -> bool:
+        # checkpoint for the long stages, raises TaskCancelledError if the
+        # task was cancelled and returns True if it ran out of time
+        self.cancel_token.check()
+        return self.budget.should_stop()
+
+    def load_returns(self, task_id: str, logger, use_corr_index: bool = True):
+        self.budget.start_stage("cache")
+        with self.timings.stage("process_cache"):
+            ETFVolumeCache.process_cache(
+                logger,
+                days_to_prune_after=7,
+                chunk_size=100,
+                should_stop=self.should_stop,
+            )
+        write_to_log(task_id, "Updated ETF metadata cache")
+        with self.timings.stage("load_etfs"):
+            etf_list = get_data_provider().list_etfs()
+        with self.timings.stage("set_contract_list"):
+            self.etf_volume_cache = ETFVolumeCache(etf_list)
+            self.set_contract_list(logger)
+        self.budget.start_stage("selection")
+        # the downloads are timed separately, in their own stage
+        with self.timings.stage("screening"):
+            msg_list = self.set_top_etf_return_df(logger, use_corr_index=use_corr_index)
         for msg in msg_list:
-            write_to_log(msg)
-        write_to_log("ETF data from Yahoo Finance loaded")
+            write_to_log(task_id, msg)
+        write_to_log(task_id, "ETF data from Yahoo Finance loaded")
+
+    def get_moments(self, logger) -> Tuple[np.ndarray, np.ndarray]:
+        # the snapshot has the same moments as returns_df for a standard
+        # lookback if it was taken today
+        assert self.returns_df is not None
+        symbols = list(self.returns_df.columns)
+        snapshot = MomentSnapshotCache.load()
+        if (snapshot is not None) and snapshot.covers(
+            self.currency, self.num_years, self.start_date, self.end_date, symbols
+        ):
+            logger.info(f"Using moments from snapshot {snapshot.path}")
+            return snapshot.get_moments(self.num_years, symbols)
+        return pairwise_moments(self.returns_df.to_numpy())
+
+    def get_covariance(self, logger) -> Tuple[np.ndarray, Covariance]:
+        # mean and covariance ready for the solver
+        assert self.returns_df is not None
+        if self.covariance == "factor":
+            returns = self.returns_df.to_numpy()
+            factor_cov = FactorCovariance.from_returns(returns, self.num_factors)
+            logger.info(
+                f"Using a factor covariance with {factor_cov.loadings.shape[1]} "
+                "factors"
+            )
+            return np.nanmean(returns, axis=0), factor_cov
+        if self.shrinkage:
+            mean_returns, covar_matrix = pairwise_moments(self.returns_df.to_numpy())
+            self.check_covariance(covar_matrix)
+            covar_matrix, intensity = ledoit_wolf_shrinkage(
+                self.returns_df.to_numpy(), covar_matrix
+            )
+            logger.info(f"Shrunk the covariance with intensity {intensity:.3f}")
+        else:
+            mean_returns, covar_matrix = self.get_moments(logger)
+            self.check_covariance(covar_matrix)
+        return mean_returns, nearest_psd(covar_matrix)
+
+    def check_covariance(self, covar_matrix: np.ndarray) -> None:
+        # the pairwise covariance of two ETFs with fewer than 2 days of
+        # returns in common is NaN, which nearest_psd cannot repair
+        assert self.returns_df is not None
+        missing = np.argwhere(~np.isfinite(covar_matrix))
+        if len(missing) > 0:
+            i, j = missing[0]
+            raise ValueError(
+                f"No covariance of {self.returns_df.columns[i]} and "
+                f"{self.returns_df.columns[j]}, which have fewer than 2 days of "
+                "returns in common"
+            )
+
+    def get_refresh_state(self) -> RefreshState:
+        return RefreshState(
+            self.end_date, dict(self.corr_cache), self.portfolio, dict(self.corr_dates)
+        )
+
+    def get_warm_start(
+        self,
+    ) -> Tuple[Optional[np.ndarray], Optional[Dict[str, list]]]:
+        # the optimum and frontier of the previous portfolio over the ETFs of
+        # returns_df, the ETFs that were not in it start at 0
+        assert self.returns_df is not None
+        prev = self.prev_portfolio
+        if (prev is None) or (prev.frontier is None):
+            return None, None
+        prev_idx = {x: i for i, x in enumerate(prev.weight_map)}
+        idx = np.array([prev_idx.get(x, -1) for x in self.returns_df.columns])
+
+        def reindex(w) -> np.ndarray:
+            return np.where(idx >= 0, np.asarray(w)[idx], 0.0)
+
+        w0 = reindex(list(prev.weight_map.values()))
+        prev_frontier = {
+            "rets": list(prev.frontier["rets"]),
+            "weights": [reindex(w) for w in prev.frontier["weights"]],
+        }
+        return (w0 / w0.sum() if w0.sum() > EPS else None), prev_frontier
+
+    def optimize(self, logger):
         assert self.returns_df is not None
         logger.info(
             f"Using the following ETFs for optimization: {self.returns_df.columns}",
         )
-        mean_returns = self.returns_df.mean().to_numpy()
+        with self.timings.stage("moments"):
+            mean_returns, covar_matrix = self.get_covariance(logger)
         assert np.isfinite(mean_returns).all()
-        covar_matrix = self.returns_df.cov().to_numpy()
-        assert np.isfinite(covar_matrix).all()
-        individual_volatility = np.sqrt(np.diag(covar_matrix))
+        if isinstance(covar_matrix, np.ndarray):
+            assert np.isfinite(covar_matrix).all()
+        individual_volatility = np.sqrt(covar_matrix.diagonal())
         num_days_per_year = len(self.returns_df) / self.num_years
 
         zero_vol = sorted(
@@ -144,22 +525,27 @@ class ETFOptimizer:
             f"rate (sigma: {annualized_min_volatility:.2f}%, sym: {zero_vol[2]})",
         )
 
-        min_ret = risk_free_rate
-        max_ret = mean_returns.max()
-        efficient_frontier = calc_eff_front(
-            mean_returns, covar_matrix, logger, min_ret, max_ret
-        )
-        write_to_log("Calculated efficient frontier")
-        best_output = sorted(
-            zip(efficient_frontier["rets"], efficient_frontier["vols"]),
-            key=lambda x: (x[0] - risk_free_rate) / x[1],
-            reverse=True,
-        )[0]
-        weights, mu, sigma = find_min_var_portfolio(
-            mean_returns,
-            covar_matrix,
-            r_min=best_output[0] * 0.99,
-        )
+        if self.method == "hrp":
+            if isinstance(covar_matrix, FactorCovariance):
+                covar_matrix = covar_matrix.to_dense()
+            with self.timings.stage("hrp"):
+                weights, mu, sigma = find_hrp_portfolio(mean_returns, covar_matrix)
+            frontier = None
+        else:
+            w0, prev_frontier = self.get_warm_start()
+            if prev_frontier is not None:
+                logger.info("Starting the solver from the previous frontier")
+            with self.timings.stage("calc_eff_front"):
+                weights, mu, sigma, frontier = find_max_sharpe_portfolio(
+                    mean_returns,
+                    covar_matrix,
+                    logger,
+                    risk_free_rate,
+                    w0=w0,
+                    should_stop=self.should_stop,
+                    telemetry=self.solver_telemetry,
+                    prev_frontier=prev_frontier,
+                )
         logger.info(f"Best Portfolio: mu: {mu:.2f}%, sigma: {sigma:.2f}%")
 
         weight_map = zip(self.returns_df.columns, weights)
@@ -173,7 +559,33 @@ class ETFOptimizer:
                 annualized_min_volatility,
             ),
             num_days_per_year=num_days_per_year,
+            frontier=frontier,
         )
         logger.info(f"Mean returns: {mean_returns}")
         logger.info(f"Num days per year: {num_days_per_year}")
-        write_to_log("Finished optimization")
+
+    def run_optimizer(self, task_id: str, logger, time_budget: Optional[float] = None):
+        # with a time budget in seconds, the stages that run out of time stop
+        # early and the result is marked as partial
+        write_to_log(task_id, "Starting optimizer")
+        self.budget = TimeBudget(time_budget)
+        self.load_returns(task_id, logger)
+        self.budget.start_stage("frontier")
+        self.optimize(logger)
+        if self.method == "hrp":
+            write_to_log(task_id, "Calculated hierarchical risk parity weights")
+        else:
+            write_to_log(task_id, "Calculated efficient frontier")
+        if self.budget.cut_stages:
+            msg = (
+                f"Time budget of {time_budget:g}s ran out in: "
+                f"{', '.join(self.budget.cut_stages)}"
+            )
+            write_to_log(task_id, msg)
+            # after the note of a task downsized to fit in the memory budget
+            partial = TaskDB.get("partial", task_id)
+            TaskDB.put("partial", task_id, f"{partial}. {msg}" if partial else msg)
+        if self.method != "hrp":
+            write_to_log(task_id, f"Solver: {self.solver_telemetry}")
+        write_to_log(task_id, f"Time per stage: {self.timings}")
+        write_to_log(task_id, "Finished optimization")
@@ -0,0 +1,161 @@
+"""
+Process-wide store of the downloaded return series, shared by all tasks
+
+YFReturnsCache looks up every ticker here before downloading it, keyed by
+everything its returns depend on: the provider, the ticker, the date range,
+the price column and whether prices are imputed. A ticker that another
+cache is downloading is waited for instead of being downloaded again, so
+concurrent tasks make one download per ticker ("single flight").
+
+The series are shared read-only, with the data-quality verdicts of each of
+them by the start date they were checked from. Every cache holds a reference
+to the series it uses until it is garbage collected, and the series that no
+cache references are evicted with their verdicts, in least recently used
+order, once the store is larger than RETURNS_CACHE_MB.
+
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from metrics import Counter, Gauge
+from task_control import CancelToken
+
+RETURNS_CACHE_MB = float(os.getenv("RETURNS_CACHE_MB", "256"))
+
+ReturnsKey = Tuple[Any, ...]
+
+RETURNS_LOOKUPS_TOTAL = Counter(
+    "etf_optimizer_returns_lookups_total",
+    "Lookups of return series in the shared store: hit, wait for another "
+    "download, or miss",
+    ["result"],
+)
+RETURNS_CACHE_BYTES = Gauge(
+    "etf_optimizer_returns_cache_bytes", "Size of the shared return series"
+)
+
+
+class Flight(object):
+    """Download of a ticker by one cache, waited for by the others"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.series: Optional[pd.Series] = None
+        # why the download failed, raised again by the waiting caches
+        self.error: Optional[str] = None
+        # caches waiting for it, which hold a reference once it lands
+        self.num_waiters = 0
+
+    def wait(self, cancel_token: Optional[CancelToken]) -> None:
+        while not self.event.wait(timeout=1):
+            if cancel_token is not None:
+                cancel_token.check()
+
+
+class SharedReturns(object):
+    def __init__(self, max_mb: float = RETURNS_CACHE_MB):
+        self.max_bytes = max_mb * 2**20
+        self.entries: "OrderedDict[ReturnsKey, pd.Series]" = OrderedDict()
+        self.refs: Dict[ReturnsKey, int] = {}
+        self.sizes: Dict[ReturnsKey, int] = {}
+        self.flights: Dict[ReturnsKey, Flight] = {}
+        # verdict rows of check_returns by key and start date
+        self.verdicts: Dict[ReturnsKey, Dict[str, pd.DataFrame]] = {}
+        self.num_bytes = 0
+        self.lock = threading.Lock()
+
+    def claim(
+        self, keys: List[ReturnsKey]
+    ) -> Tuple[Dict[ReturnsKey, pd.Series], List[ReturnsKey], Dict[ReturnsKey, Flight]]:
+        """Look up keys, holding a reference to every series found
+
+        Returns the series found, the keys the caller must download and
+        publish(), and the flights of the keys other caches are downloading.
+        """
+        found, claimed, flights = {}, [], {}
+        with self.lock:
+            for key in keys:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    self.refs[key] += 1
+                    found[key] = self.entries[key]
+                    RETURNS_LOOKUPS_TOTAL.inc(result="hit")
+                elif key in self.flights:
+                    self.flights[key].num_waiters += 1
+                    flights[key] = self.flights[key]
+                    RETURNS_LOOKUPS_TOTAL.inc(result="wait")
+                else:
+                    self.flights[key] = Flight()
+                    claimed.append(key)
+                    RETURNS_LOOKUPS_TOTAL.inc(result="miss")
+        return found, claimed, flights
+
+    def publish(
+        self, key: ReturnsKey, series: Optional[pd.Series], error: Optional[str] = None
+    ) -> None:
+        # the result of a claimed download, None if the ticker is missing or
+        # the download failed with error
+        with self.lock:
+            flight = self.flights.pop(key)
+            if series is not None:
+                if isinstance(series.values, np.ndarray):
+                    series.values.flags.writeable = False
+                self.entries[key] = series
+                self.refs[key] = 1 + flight.num_waiters
+                self.sizes[key] = int(series.memory_usage(index=True))
+                self.num_bytes += self.sizes[key]
+            flight.series = series
+            flight.error = error
+            flight.event.set()
+            self.evict()
+
+    def release(self, keys: List[ReturnsKey]) -> None:
+        # called when a cache holding keys is garbage collected
+        with self.lock:
+            for key in keys:
+                if key in self.refs:
+                    self.refs[key] -= 1
+                elif key in self.flights:
+                    self.flights[key].num_waiters -= 1
+            self.evict()
+
+    def get_verdicts(
+        self, keys: List[ReturnsKey], start_date: str
+    ) -> Dict[ReturnsKey, pd.DataFrame]:
+        # the verdicts of the keys already checked from start_date
+        with self.lock:
+            return {
+                key: self.verdicts[key][start_date]
+                for key in keys
+                if start_date in self.verdicts.get(key, {})
+            }
+
+    def add_verdicts(
+        self, verdicts: Dict[ReturnsKey, pd.DataFrame], start_date: str
+    ) -> None:
+        with self.lock:
+            for key, verdict in verdicts.items():
+                # the series may have failed or been evicted meanwhile
+                if key in self.entries:
+                    self.verdicts.setdefault(key, {})[start_date] = verdict
+
+    def evict(self) -> None:
+        # least recently used first, skipping the series still referenced
+        for key in list(self.entries):
+            if self.num_bytes <= self.max_bytes:
+                break
+            if self.refs[key] > 0:
+                continue
+            del self.entries[key], self.refs[key]
+            self.verdicts.pop(key, None)
+            self.num_bytes -= self.sizes.pop(key)
+        RETURNS_CACHE_BYTES.set(self.num_bytes)
+
+
+SHARED_RETURNS = SharedReturns()
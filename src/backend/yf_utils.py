@@ -1,7 +1,16 @@
 import time
+import weakref
+from typing import Dict, List, Optional
+
 import numpy as np
 import pandas as pd
-import yfinance as yf
+
+from backend.data_provider import DataProvider, get_data_provider
+from backend.data_quality import MAX_DAILY_RETURN, VERDICT_COLUMNS, check_returns
+from backend.shared_returns import SHARED_RETURNS, ReturnsKey
+from cache.failed_tickers import FailedTickerCache
+from metrics import TaskTimings
+from task_control import CancelToken
 
 
 class YFError(Exception):
@@ -32,6 +41,9 @@ class YFReturnsCache(object):
         return_column="Adj Close",
         num_retries=3,
         chunk_size=25,
+        cancel_token: Optional[CancelToken] = None,
+        timings: Optional[TaskTimings] = None,
+        provider: Optional[DataProvider] = None,
     ):
         self.start_date = start_date
         self.end_date = end_date
@@ -40,8 +52,40 @@ class YFReturnsCache(object):
         self.return_column = return_column
         self.num_retries = num_retries
         self.chunk_size = chunk_size
-        self.data = {}
-        self.retry_count = {}
+        self.cancel_token = cancel_token
+        self.timings = TaskTimings() if timings is None else timings
+        # only the failures of the configured provider are shared, not the
+        # ones of e.g. synthetic data
+        self.record_failures = provider is None
+        self.provider = get_data_provider() if provider is None else provider
+        self.data: Dict[str, pd.Series] = {}
+        self.retry_count: Dict[str, int] = {}
+        # data-quality verdicts of the downloaded tickers by start date, the
+        # ones from the start of the cache are checked as they are downloaded;
+        # they are shared with the other caches through SHARED_RETURNS
+        self.verdicts: Dict[str, pd.DataFrame] = {}
+        # series of data shared with the other caches, released when this
+        # cache is garbage collected
+        self.shared_keys: List[ReturnsKey] = []
+        weakref.finalize(self, SHARED_RETURNS.release, self.shared_keys)
+
+    def get_key(self, tickr: str) -> ReturnsKey:
+        return (
+            self.provider,
+            tickr,
+            self.start_date,
+            self.end_date,
+            self.impute_prices,
+            self.return_column,
+        )
+
+    def add_series(self, tickr: str, series: Optional[pd.Series]) -> None:
+        # series is None if tickr could not be downloaded
+        if series is None:
+            self.retry_count[tickr] = self.retry_count.get(tickr, 0) + 1
+        else:
+            self.data[tickr] = series
+            self.shared_keys.append(self.get_key(tickr))
 
     def fetch_price_data(self):
         tickers = [
@@ -51,7 +95,61 @@ class YFReturnsCache(object):
         ][: self.chunk_size]
         if not tickers:
             return
-        price_df = yf.download(tickers, start=self.start_date, end=self.end_date)
+        if self.cancel_token is not None:
+            self.cancel_token.check()
+        # the tickers other caches have or are downloading are not downloaded
+        tickers_by_key = {self.get_key(x): x for x in tickers}
+        found, claimed, flights = SHARED_RETURNS.claim(list(tickers_by_key))
+        waiting = list(flights)
+        try:
+            for key, series in found.items():
+                self.add_series(tickers_by_key[key], series)
+            downloaded: Dict[str, pd.Series] = {}
+            error = None
+            try:
+                if claimed:
+                    downloaded = self.download_returns(
+                        [tickers_by_key[x] for x in claimed]
+                    )
+            except Exception as e:
+                # e.g. a network error or a cancellation of this task, but
+                # the retries of tickers that were missing from a download
+                # that succeeded are just missing again
+                if not (
+                    isinstance(e, YFDownloadError)
+                    and all(self.retry_count.get(tickers_by_key[x], 0) for x in claimed)
+                ):
+                    error = e.message if isinstance(e, YFError) else str(e)
+                    raise
+            finally:
+                for key in claimed:
+                    SHARED_RETURNS.publish(
+                        key, downloaded.get(tickers_by_key[key]), error
+                    )
+            for key in claimed:
+                self.add_series(
+                    tickers_by_key[key], downloaded.get(tickers_by_key[key])
+                )
+            errors = []
+            for key, flight in flights.items():
+                flight.wait(self.cancel_token)
+                waiting.remove(key)
+                if flight.error is not None:
+                    errors.append(flight.error)
+                else:
+                    self.add_series(tickers_by_key[key], flight.series)
+            if errors:
+                raise YFDownloadError(errors[0])
+        finally:
+            # the flights that did not land are no longer waited for
+            SHARED_RETURNS.release(waiting)
+        self.get_verdicts()
+
+    def download_returns(self, tickers: List[str]) -> Dict[str, pd.Series]:
+        # returns of the tickers that could be downloaded
+        price_df = self.provider.download_prices(
+            tickers, self.start_date, self.end_date
+        )
         if (
             (price_df is None)
             or not isinstance(price_df, pd.DataFrame)
@@ -60,28 +158,88 @@ class YFReturnsCache(object):
             raise YFDownloadError(
                 "Failed to download price data for tickers: %s" % tickers
             )
+        # yfinance returns the tickers it failed to download, e.g. when rate
+        # limited, as columns without any price
+        columns = [
+            (self.return_column, x)
+            for x in tickers
+            if ((self.return_column, x) in price_df.columns)
+            and price_df[(self.return_column, x)].notna().any()
+        ]
+        if not columns:
+            raise YFDownloadError(
+                "Failed to download price data for tickers: %s" % tickers
+            )
         if self.impute_prices:
             price_df = price_df.ffill()
-        for tickr in tickers:
-            if (self.return_column, tickr) in price_df.columns:
-                return_series = (
-                    price_df[(self.return_column, tickr)].apply(np.log).diff() * 100
-                )
-                self.data[tickr] = return_series
-            else:
-                self.retry_count[tickr] = self.retry_count.get(tickr, 0) + 1
+        return {
+            tickr: price_df[(column, tickr)].apply(np.log).diff() * 100
+            for column, tickr in columns
+        }
+
+    def get_verdicts(self, start_date: Optional[str] = None) -> pd.DataFrame:
+        """Data-quality verdicts of the downloaded tickers from start_date
 
-    def get_return_series(self, tickr, max_return=50):
+        Only the tickers downloaded since the last call are looked up, and the
+        ones no other cache checked from start_date are checked, all at once.
+        start_date defaults to the start of the cache.
+        """
+        start_date = self.start_date if start_date is None else start_date
+        verdict_df = self.verdicts.get(start_date)
+        if verdict_df is None:
+            verdict_df = pd.DataFrame(columns=VERDICT_COLUMNS)
+        # tickers are only ever added to data
+        if len(verdict_df) < len(self.data):
+            new_tickers = [x for x in self.data if x not in verdict_df.index]
+            keys = {x: self.get_key(x) for x in new_tickers}
+            shared = SHARED_RETURNS.get_verdicts(list(keys.values()), start_date)
+            unchecked = [x for x in new_tickers if keys[x] not in shared]
+            if unchecked:
+                returns_df = pd.DataFrame({x: self.data[x] for x in unchecked})
+                returns_df = returns_df[returns_df.index >= start_date]
+                checked_df = check_returns(returns_df)
+                checked = {keys[x]: checked_df.loc[[x]] for x in unchecked}
+                SHARED_RETURNS.add_verdicts(checked, start_date)
+                shared.update(checked)
+            new_df = pd.concat([shared[keys[x]] for x in new_tickers])
+            verdict_df = new_df if verdict_df.empty else pd.concat([verdict_df, new_df])
+            self.verdicts[start_date] = verdict_df
+        return verdict_df
+
+    def get_return_series(self, tickr, max_return=MAX_DAILY_RETURN) -> pd.Series:
         if tickr not in self.data:
-            for _ in range(self.num_retries):
-                self.fetch_price_data()
-                if tickr in self.data:
-                    break
-                else:
-                    time.sleep(30)
+            with self.timings.stage("download"):
+                for _ in range(self.num_retries):
+                    self.fetch_price_data()
+                    if tickr in self.data:
+                        break
+                    elif self.cancel_token is not None:
+                        self.cancel_token.sleep(30)
+                    else:
+                        time.sleep(30)
+            # it was missing from every retry, a download that fails as a
+            # whole (maybe rate limiting) or a cancellation raises instead
+            if (
+                (tickr not in self.data)
+                and (self.retry_count.get(tickr, 0) > 0)
+                and self.record_failures
+            ):
+                FailedTickerCache.record(
+                    [(tickr, "download", "could not be downloaded", "")]
+                )
         return_series = self.data[tickr]
-        if return_series.abs().max() > max_return:
+        if self.get_verdicts().loc[tickr, "max_abs_return"] > max_return:
             raise YFDataQualityError(
                 f"{tickr} has at least one daily return > {max_return} in magnitude"
             )
         return return_series
+
+    def get_return_df(self, logger, max_return=MAX_DAILY_RETURN) -> pd.DataFrame:
+        # returns of every ticker that could be downloaded
+        return_series = {}
+        for tickr in self.ticker_list:
+            try:
+                return_series[tickr] = self.get_return_series(tickr, max_return)
+            except (YFError, KeyError) as e:
+                logger.info(f"Skipping {tickr}: {e}")
+        return pd.DataFrame(return_series)
@@ -0,0 +1,233 @@
+"""
+Benchmark the optimizer, selection and backtest hot paths on synthetic data
+
+Usage: cd src && python benchmark.py --num-assets 10 100 1000 --num-years 1 5 20
+           --output bench.json [--compare old_bench.json]
+
+Every benchmark runs on a seeded SyntheticMarket, once under tracemalloc for
+its peak memory and then --repeat times for its wall time. The results are
+written as JSON with the commit they were measured on, and --compare prints
+the ratio of every time to the one in an earlier results file.
+"""
+
+import argparse
+import functools
+import json
+import logging
+import pickle
+import platform
+import subprocess
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from backend.etf import ETFOptimizer
+from backend.yf_utils import YFReturnsCache
+from moments import nearest_psd, pairwise_moments
+from opt import calc_eff_front, find_min_var_portfolio
+from portfolio import Portfolio
+from synthetic import SyntheticMarket, SyntheticProvider
+from web.plot import PlotPortfolio
+
+logger = logging.getLogger("benchmark")
+# used for the benchmarks that only depend on the number of assets or years
+DEFAULT_NUM_ASSETS = 100
+DEFAULT_NUM_YEARS = 5
+NUM_CONTRACTS = 100
+
+
+@functools.lru_cache(maxsize=4)
+def get_market(num_assets: int, num_years: float, seed: int) -> SyntheticMarket:
+    return SyntheticMarket(num_assets, num_years, seed=seed)
+
+
+def get_moments(market: SyntheticMarket) -> Tuple[np.ndarray, np.ndarray]:
+    mu, cov = pairwise_moments(market.returns_df.to_numpy())
+    return mu, nearest_psd(cov)
+
+
+def setup_min_var(market: SyntheticMarket) -> Callable[[], Any]:
+    mu, cov = get_moments(market)
+    return lambda: find_min_var_portfolio(mu, cov, r_min=float(np.median(mu)))
+
+
+def setup_eff_front(market: SyntheticMarket) -> Callable[[], Any]:
+    mu, cov = get_moments(market)
+    return lambda: calc_eff_front(mu, cov, logger, mu.min(), mu.max())
+
+
+def get_optimizer(market: SyntheticMarket) -> Tuple[ETFOptimizer, YFReturnsCache]:
+    num_years = len(market.dates) / 252
+    optimizer = ETFOptimizer("USD", NUM_CONTRACTS, 0.95, num_years)
+    optimizer.contract_list = list(market.symbols)
+    returns_cache = YFReturnsCache(
+        optimizer.start_date,
+        optimizer.end_date,
+        optimizer.contract_list,
+        provider=SyntheticProvider(market),
+    )
+    # the downloads are not part of the benchmark
+    returns_cache.get_return_df(logger)
+    return optimizer, returns_cache
+
+
+def setup_selection(market: SyntheticMarket) -> Callable[[], Any]:
+    optimizer, returns_cache = get_optimizer(market)
+    return lambda: optimizer.set_top_etf_return_df(logger, returns_cache=returns_cache)
+
+
+def setup_pickle_optimizer(market: SyntheticMarket) -> Callable[[], Any]:
+    # what sweep.py sends to every worker process
+    optimizer, returns_cache = get_optimizer(market)
+    optimizer.set_top_etf_return_df(logger, returns_cache=returns_cache)
+    return lambda: pickle.loads(pickle.dumps(optimizer))
+
+
+def setup_moments(market: SyntheticMarket) -> Callable[[], Any]:
+    return lambda: get_moments(market)
+
+
+def setup_to_html(market: SyntheticMarket) -> Callable[[], Any]:
+    mu, cov = get_moments(market)
+    rng = np.random.default_rng(0)
+    weights = rng.dirichlet(np.ones(len(mu)))
+    portfolio = Portfolio(
+        dict(zip(market.symbols, weights)), exp_ret=mu, cov=cov, num_days_per_year=252
+    )
+    return portfolio.to_html
+
+
+def setup_value_series(market: SyntheticMarket) -> Callable[[], Any]:
+    portfolio = Portfolio(dict.fromkeys(market.symbols, 1 / len(market.symbols)))
+    plotter = PlotPortfolio(
+        portfolio,
+        f"{market.dates[0]:%Y-%m-%d}",
+        f"{market.dates[-1]:%Y-%m-%d}",
+        sip_amount=1000,
+        sip_frequency_days=30,
+        logger=logger,
+    )
+    plotter.return_series = market.returns_df.fillna(0).mean(axis=1)
+    return plotter.get_portfolio_value_series
+
+
+# name: (setup, whether it depends on the number of assets, and of years)
+BENCHMARKS: Dict[str, Tuple[Callable[[SyntheticMarket], Callable], bool, bool]] = {
+    "find_min_var_portfolio": (setup_min_var, True, False),
+    "calc_eff_front": (setup_eff_front, True, False),
+    "set_top_etf_return_df": (setup_selection, True, True),
+    "pickle_optimizer": (setup_pickle_optimizer, True, True),
+    "moments": (setup_moments, True, True),
+    "to_html": (setup_to_html, True, False),
+    "get_portfolio_value_series": (setup_value_series, False, True),
+}
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--num-assets", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--num-years", type=float, nargs="+", default=[1, 5, 20])
+    parser.add_argument(
+        "--benchmarks", nargs="+", choices=list(BENCHMARKS), default=list(BENCHMARKS)
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench.json")
+    parser.add_argument("--compare", help="Results of an earlier run")
+    return parser.parse_args()
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run_benchmark(
+    name: str, num_assets: int, num_years: float, repeat: int, seed: int
+) -> Dict[str, Any]:
+    setup = BENCHMARKS[name][0]
+    run = setup(get_market(num_assets, num_years, seed))
+    # the first run also warms up the caches
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    seconds = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        run()
+        seconds.append(time.perf_counter() - start_time)
+    return {
+        "benchmark": name,
+        "num_assets": num_assets,
+        "num_years": num_years,
+        "median_seconds": float(np.median(seconds)),
+        "min_seconds": min(seconds),
+        "peak_mb": peak / 2**20,
+        "repeat": repeat,
+    }
+
+
+def compare(results: List[Dict[str, Any]], old_path: str) -> None:
+    with open(old_path) as f:
+        old_results = json.load(f)["results"]
+    keys = ["benchmark", "num_assets", "num_years"]
+    df = pd.DataFrame(results).merge(
+        pd.DataFrame(old_results), on=keys, suffixes=("", "_old")
+    )
+    df["time_ratio"] = df["median_seconds"] / df["median_seconds_old"]
+    df["memory_ratio"] = df["peak_mb"] / df["peak_mb_old"]
+    columns = keys + ["median_seconds_old", "median_seconds", "time_ratio"]
+    print(df[columns + ["memory_ratio"]].to_string(index=False))
+
+
+def main() -> None:
+    args = parse_args()
+    results = []
+    for name in args.benchmarks:
+        _, uses_assets, uses_years = BENCHMARKS[name]
+        assets = args.num_assets if uses_assets else [DEFAULT_NUM_ASSETS]
+        years = args.num_years if uses_years else [DEFAULT_NUM_YEARS]
+        for num_assets in assets:
+            for num_years in years:
+                result = run_benchmark(
+                    name, num_assets, num_years, args.repeat, args.seed
+                )
+                print(
+                    f"{name} N={num_assets} T={num_years:g}: "
+                    f"{result['median_seconds']:.4f}s, {result['peak_mb']:.1f}MB",
+                    flush=True,
+                )
+                results.append(result)
+    output = {
+        "meta": {
+            "commit": get_commit(),
+            "time": pd.Timestamp.now("UTC").isoformat(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "machine": platform.machine(),
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+    print(f"Wrote {len(results)} results to {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    main()
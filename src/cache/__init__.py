@@ -10,6 +10,31 @@ ETF_VOLUME_CACHE_HEADER = [
     "currency",
     "entry_time",
 ]
+CORR_INDEX_CSV = CACHE_DIR / "corr_index.csv"
+CORR_INDEX_HEADER = [
+    "symbol",
+    "mean_return",
+    "valid_ratio",
+    "max_abs_return",
+    "max_stale_days",
+    "num_splits",
+    "neighbours",
+    "currency",
+    "num_years",
+    "min_corr",
+    "entry_time",
+]
+MOMENT_SNAPSHOT_DIR = CACHE_DIR / "moment_snapshots"
+FAILED_TICKERS_CSV = CACHE_DIR / "failed_tickers.csv"
+FAILED_TICKERS_HEADER = [
+    "symbol",
+    "kind",
+    "reason",
+    "start_date",
+    "num_failures",
+    "last_failure",
+    "retry_after",
+]
 
 
 class Cache(object):
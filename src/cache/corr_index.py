@@ -0,0 +1,207 @@
+import os
+import time
+from typing import Dict, Hashable, List, Optional
+
+import numpy as np
+import pandas as pd
+from filelock import FileLock, Timeout
+
+from backend.data_provider import get_data_provider
+from backend.data_quality import check_returns, get_reasons
+from backend.yf_utils import YFError, YFReturnsCache
+from cache import CACHE_DIR, CORR_INDEX_CSV, CORR_INDEX_HEADER, Cache
+from cache.etf_volume import ETFVolumeCache
+from moments import RollingMoments
+
+CORR_INDEX_UNIVERSE_SIZE = 2000
+CORR_INDEX_NUM_YEARS = 5
+CORR_INDEX_MIN_CORR = 0.9
+CORR_INDEX_MAX_AGE_DAYS = 1
+
+
+class CorrelationIndex(object):
+    """Highly correlated neighbours of every ETF in the ranked universe
+
+    Pairs with a correlation below min_corr are not stored, so the index can
+    tell whether an ETF is redundant at any cutoff >= min_corr.
+    """
+
+    def __init__(self, index_df: pd.DataFrame):
+        self.currency = index_df["currency"].iloc[0]
+        self.num_years = float(index_df["num_years"].iloc[0])
+        self.min_corr = float(index_df["min_corr"].iloc[0])
+        self.entry_time = pd.to_datetime(index_df["entry_time"]).min()
+        stats_df = index_df.set_index("symbol")[
+            [
+                "mean_return",
+                "valid_ratio",
+                "max_abs_return",
+                "max_stale_days",
+                "num_splits",
+            ]
+        ]
+        self.stats: Dict[Hashable, Dict] = stats_df.to_dict(orient="index")
+        # the data-quality checks that every ETF fails, "" if it passes them
+        self.reasons: Dict[Hashable, str] = get_reasons(stats_df).to_dict()
+        self.neighbours: Dict[str, Dict[str, float]] = {}
+        for symbol, neighbours in zip(index_df["symbol"], index_df["neighbours"]):
+            self.neighbours[symbol] = {}
+            if isinstance(neighbours, str) and neighbours:
+                for item in neighbours.split("|"):
+                    neighbour, corr = item.split(":")
+                    self.neighbours[symbol][neighbour] = float(corr)
+
+    def __contains__(self, symbol: str) -> bool:
+        return symbol in self.stats
+
+    def covers(self, currency: str, num_years: float, correlation_cutoff: float):
+        max_age = pd.Timedelta(days=CORR_INDEX_MAX_AGE_DAYS + 1)
+        return (
+            (currency == self.currency)
+            and (abs(num_years - self.num_years) < 1e-6)
+            and (correlation_cutoff >= self.min_corr)
+            and (pd.Timestamp.now("UTC") - self.entry_time < max_age)
+        )
+
+    def get_corr(self, etf1: str, etf2: str) -> Optional[float]:
+        # None if the correlation is below min_corr
+        return self.neighbours.get(etf1, {}).get(etf2)
+
+
+class CorrelationIndexCache(Cache):
+
+    cache_version = 2
+    loaded: Optional[CorrelationIndex] = None
+    loaded_mtime: Optional[float] = None
+
+    def __init__(
+        self,
+        contract_list: List[str],
+        currency: str,
+        num_years: float = CORR_INDEX_NUM_YEARS,
+        min_corr: float = CORR_INDEX_MIN_CORR,
+    ):
+        self.contract_list = contract_list
+        self.currency = currency
+        self.num_years = num_years
+        self.min_corr = min_corr
+
+    def prune(self, cutoff_time, logger) -> int:
+        # the index is built as a whole and a stale index stays in use until
+        # it is atomically replaced, so this only reports if it is fresh
+        if not CORR_INDEX_CSV.exists():
+            return 0
+        lock = FileLock(str(CORR_INDEX_CSV) + ".lock")
+        with lock.acquire(timeout=20):
+            index_df = pd.read_csv(CORR_INDEX_CSV)
+        if (
+            (set(index_df.columns) != set(CORR_INDEX_HEADER))
+            or index_df.empty
+            or (pd.to_datetime(index_df["entry_time"]).min() < cutoff_time)
+            or (index_df["currency"].iloc[0] != self.currency)
+            or (float(index_df["num_years"].iloc[0]) != self.num_years)
+            or (float(index_df["min_corr"].iloc[0]) != self.min_corr)
+        ):
+            logger.info(f"Correlation index {CORR_INDEX_CSV} is stale")
+            return 0
+        return index_df.shape[0]
+
+    def _populate(self, max_new_entries, logger) -> int:
+        now = pd.Timestamp.now("UTC")
+        start_date = (now - pd.Timedelta(days=int(365 * self.num_years))).strftime(
+            "%Y-%m-%d"
+        )
+        universe = self.contract_list[:max_new_entries]
+        returns_cache = YFReturnsCache(start_date, now.strftime("%Y-%m-%d"), universe)
+        return_series = {}
+        for etf in universe:
+            try:
+                # data quality is checked against the stored statistics
+                return_series[etf] = returns_cache.get_return_series(
+                    etf, max_return=np.inf
+                )
+            except (YFError, KeyError) as e:
+                logger.info(f"Skipping {etf} in correlation index: {e}")
+        returns_df = pd.DataFrame(return_series)
+        verdict_df = check_returns(returns_df)
+        logger.info(f"Computing correlations for {returns_df.shape} returns")
+        returns = returns_df.to_numpy()
+        moments = RollingMoments(returns.shape[1], shift=np.nanmean(returns, axis=0))
+        moments.add(returns)
+        corr = moments.corr()
+        np.fill_diagonal(corr, np.nan)
+
+        rows = []
+        symbols = np.array(returns_df.columns)
+        for idx, etf in enumerate(symbols):
+            verdict = verdict_df.loc[etf]
+            close = np.flatnonzero(corr[idx] >= self.min_corr)
+            close = close[np.argsort(-corr[idx, close])]
+            rows.append(
+                {
+                    "symbol": etf,
+                    "mean_return": verdict["mean_return"],
+                    "valid_ratio": verdict["valid_ratio"],
+                    "max_abs_return": verdict["max_abs_return"],
+                    "max_stale_days": verdict["max_stale_days"],
+                    "num_splits": verdict["num_splits"],
+                    "neighbours": "|".join(
+                        f"{symbols[j]}:{corr[idx, j]:.6f}" for j in close
+                    ),
+                    "currency": self.currency,
+                    "num_years": self.num_years,
+                    "min_corr": self.min_corr,
+                    "entry_time": now,
+                }
+            )
+        index_df = pd.DataFrame(rows, columns=CORR_INDEX_HEADER)
+        # readers do not take the lock, so replace the index atomically
+        tmp_csv = CORR_INDEX_CSV.with_suffix(".tmp")
+        index_df.to_csv(tmp_csv, index=False)
+        os.replace(tmp_csv, CORR_INDEX_CSV)
+        logger.info(f"Saved correlation index to {CORR_INDEX_CSV}: {index_df.shape}")
+        return index_df.shape[0]
+
+    def populate(self, max_new_entries=CORR_INDEX_UNIVERSE_SIZE, logger=None) -> int:
+        assert CACHE_DIR.exists(), f"{CACHE_DIR} does not exist"
+        lock = FileLock(str(CORR_INDEX_CSV) + ".lock")
+        with lock.acquire(timeout=20):
+            return self._populate(max_new_entries, logger)
+
+    @classmethod
+    def load(cls) -> Optional[CorrelationIndex]:
+        if not CORR_INDEX_CSV.exists():
+            return None
+        mtime = CORR_INDEX_CSV.stat().st_mtime
+        if cls.loaded_mtime != mtime:
+            index_df = pd.read_csv(CORR_INDEX_CSV)
+            cls.loaded = CorrelationIndex(index_df) if not index_df.empty else None
+            cls.loaded_mtime = mtime
+        return cls.loaded
+
+    @classmethod
+    def process_cache(
+        cls,
+        logger,
+        currency="USD",
+        universe_size=CORR_INDEX_UNIVERSE_SIZE,
+        days_to_prune_after=CORR_INDEX_MAX_AGE_DAYS,
+        num_retries=3,
+    ) -> None:
+        etf_volume_cache = ETFVolumeCache(get_data_provider().list_etfs())
+        corr_index_cache = CorrelationIndexCache(
+            etf_volume_cache.ranked_symbols(currency), currency
+        )
+        cache_cutoff_time = pd.Timestamp.now("UTC") - pd.Timedelta(
+            days=days_to_prune_after
+        )
+        for _ in range(num_retries):
+            try:
+                num_entries = corr_index_cache.prune(cache_cutoff_time, logger)
+                if num_entries == 0:
+                    num_entries = corr_index_cache.populate(universe_size, logger)
+                logger.info(f"Correlation index has {num_entries} entries")
+                break
+            except Timeout:
+                logger.info("Another process is building the index, waiting...")
+                time.sleep(10)
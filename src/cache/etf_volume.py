@@ -1,11 +1,10 @@
 import time
+from typing import Callable, List, Optional
 
 import pandas as pd
-import yfinance as yf
 from filelock import FileLock, Timeout
-from pyetfdb_scraper.etf import load_etfs
-from yfinance.exceptions import YFTickerMissingError
 
+from backend.data_provider import get_data_provider
 from cache import CACHE_DIR, ETF_VOLUME_CACHE_CSV, ETF_VOLUME_CACHE_HEADER, Cache
 
 
@@ -51,27 +50,14 @@ class ETFVolumeCache(Cache):
             )
         else:
             volume_df = None
+        known = set() if volume_df is None else set(volume_df["symbol"])
         volume_list = []
+        provider = get_data_provider()
         for etf in self.etf_list:
-            if (volume_df is None) or (etf not in volume_df["symbol"].values):
+            if etf not in known:
                 logger.info("Fetching volume for %s", etf)
                 try:
-                    info = yf.Ticker(etf).fast_info
-                    assert info["quoteType"] in [
-                        "ETF"
-                    ], f"{etf} is not an ETF but {info['quoteType']}"
-                    volume_list.append(
-                        {
-                            "symbol": etf,
-                            "exchange": info["exchange"],
-                            "volume": info["three_month_average_volume"],
-                            "price": info["fifty_day_average"],
-                            "currency": info["currency"],
-                            "entry_time": pd.Timestamp.now("UTC"),
-                        }
-                    )
-                except YFTickerMissingError:
-                    info = yf.Ticker(etf).info
+                    info = provider.get_etf_info(etf)
                     assert info["quoteType"] in [
                         "ETF"
                     ], f"{etf} is not an ETF but {info['quoteType']}"
@@ -99,6 +85,7 @@ class ETFVolumeCache(Cache):
                     )
             if len(volume_list) > max_new_entries:
                 break
+        provider.flush()
         if len(volume_list) > 0:
             additional_volume_df = pd.DataFrame(volume_list)
             assert set(additional_volume_df.columns) == set(ETF_VOLUME_CACHE_HEADER), (
@@ -122,11 +109,31 @@ class ETFVolumeCache(Cache):
     def as_dataframe(self) -> pd.DataFrame:
         return pd.read_csv(ETF_VOLUME_CACHE_CSV)
 
+    def ranked_symbols(self, currency: str) -> List[str]:
+        # symbols trading in currency sorted by traded notional
+        df = self.as_dataframe()
+        df = df[
+            pd.notnull(df["volume"])
+            & pd.notnull(df["price"])
+            & pd.notnull(df["currency"])
+            & (df["volume"] > 0)
+            & (df["price"] > 0)
+            & (df["currency"] == currency)
+        ]
+        df["notional"] = df["volume"] * df["price"]
+        df = df.sort_values("notional", ascending=False)
+        return list(df["symbol"].values)
+
     @classmethod
     def process_cache(
-        cls, logger, days_to_prune_after=7, chunk_size=100, num_retries=3
+        cls,
+        logger,
+        days_to_prune_after=7,
+        chunk_size=100,
+        num_retries=3,
+        should_stop: Optional[Callable[[], bool]] = None,
     ) -> None:
-        etf_list = load_etfs()
+        etf_list = get_data_provider().list_etfs()
         etf_volume_cache = ETFVolumeCache(etf_list)
         cache_cutoff_time = pd.Timestamp.now("UTC") - pd.Timedelta(
             days=days_to_prune_after
@@ -156,6 +163,9 @@ class ETFVolumeCache(Cache):
                 )
                 if added_entries < chunk_size:
                     break
+                if (should_stop is not None) and should_stop():
+                    logger.info("Stopped populating ETF Volume cache early")
+                    break
             except Timeout:
                 logger.info("Another process is populating the cache, waiting...")
                 time.sleep(10)
@@ -0,0 +1,157 @@
+"""
+Tickers that could not be downloaded or failed the data-quality checks
+
+The failures are shared by all the processes in FAILED_TICKERS_CSV, so that
+a delisted or broken ticker near the top of the ranked ETFs is skipped by
+the next tasks instead of being downloaded again. A failure is skipped until
+its retry_after, then the ticker is probed again: another failure doubles
+the time until the next probe, from RETRY_HOURS up to MAX_RETRY_HOURS, and
+a success removes it.
+
+A data-quality failure depends on the returns it was checked on, so it only
+applies to the selections that start on or before its start_date, whose
+returns include the ones it failed on.
+
+"""
+
+import os
+from typing import Dict, List, Optional, Tuple
+
+import pandas as pd
+from filelock import FileLock
+
+from cache import CACHE_DIR, FAILED_TICKERS_CSV, FAILED_TICKERS_HEADER
+
+RETRY_HOURS = 6
+MAX_RETRY_HOURS = 24 * 7
+
+# symbol, kind ("download" or "data_quality"), reason, and the start date of
+# the returns that failed, "" if it does not depend on them
+Failure = Tuple[str, str, str, str]
+
+
+class FailedTickerCache(object):
+
+    loaded: Optional[pd.DataFrame] = None
+    loaded_mtime: Optional[float] = None
+
+    @staticmethod
+    def read() -> pd.DataFrame:
+        if not FAILED_TICKERS_CSV.exists():
+            return pd.DataFrame(columns=FAILED_TICKERS_HEADER)
+        failed_df = pd.read_csv(FAILED_TICKERS_CSV, dtype={"start_date": str})
+        assert set(failed_df.columns) == set(FAILED_TICKERS_HEADER), (
+            failed_df.columns,
+            FAILED_TICKERS_HEADER,
+        )
+        failed_df["start_date"] = failed_df["start_date"].fillna("")
+        for col in ["last_failure", "retry_after"]:
+            # a time on a whole second is written without its microseconds
+            failed_df[col] = pd.to_datetime(failed_df[col], utc=True, format="ISO8601")
+        return failed_df
+
+    @staticmethod
+    def write(failed_df: pd.DataFrame) -> None:
+        tmp_csv = FAILED_TICKERS_CSV.with_suffix(".tmp")
+        failed_df[FAILED_TICKERS_HEADER].to_csv(tmp_csv, index=False)
+        os.replace(tmp_csv, FAILED_TICKERS_CSV)
+
+    @classmethod
+    def load(cls) -> pd.DataFrame:
+        # only read again when another process changed the file
+        if not FAILED_TICKERS_CSV.exists():
+            return pd.DataFrame(columns=FAILED_TICKERS_HEADER)
+        mtime = FAILED_TICKERS_CSV.stat().st_mtime
+        if (cls.loaded is None) or (cls.loaded_mtime != mtime):
+            cls.loaded = cls.read()
+            cls.loaded_mtime = mtime
+        return cls.loaded
+
+    @classmethod
+    def get_failures(cls, symbols: List[str], start_date: str) -> Dict[str, str]:
+        """Reasons of the symbols to skip in a selection from start_date
+
+        The failures that are due to be probed again are not returned.
+        """
+        failed_df = cls.load()
+        if failed_df.empty:
+            return {}
+        now = pd.Timestamp.now("UTC")
+        failed_df = failed_df[
+            failed_df["symbol"].isin(symbols)
+            & (failed_df["retry_after"] > now)
+            & (
+                (failed_df["start_date"] == "")
+                | (failed_df["start_date"] >= start_date)
+            )
+        ]
+        return {
+            symbol: f"{reason}, not retried until {retry_after:%Y-%m-%d %H:%M} UTC"
+            for symbol, reason, retry_after in zip(
+                failed_df["symbol"], failed_df["reason"], failed_df["retry_after"]
+            )
+        }
+
+    @classmethod
+    def record(cls, failures: List[Failure]) -> None:
+        if (not failures) or (not CACHE_DIR.exists()):
+            return
+        now = pd.Timestamp.now("UTC")
+        with FileLock(str(FAILED_TICKERS_CSV) + ".lock", timeout=20):
+            failed_df = cls.read()
+            records = {
+                (x["symbol"], x["kind"]): x for x in failed_df.to_dict(orient="records")
+            }
+            for symbol, kind, reason, start_date in failures:
+                record = records.get((symbol, kind))
+                num_failures = 1
+                if record is not None:
+                    start_date = max(start_date, record["start_date"])
+                    if record["retry_after"] > now:
+                        # the same failure, seen by another task before the
+                        # next probe
+                        record["start_date"] = start_date
+                        continue
+                    num_failures = record["num_failures"] + 1
+                hours = min(RETRY_HOURS * 2 ** (num_failures - 1), MAX_RETRY_HOURS)
+                records[(symbol, kind)] = {
+                    "symbol": symbol,
+                    "kind": kind,
+                    "reason": reason,
+                    "start_date": start_date,
+                    "num_failures": num_failures,
+                    "last_failure": now,
+                    "retry_after": now + pd.Timedelta(hours=hours),
+                }
+            cls.write(
+                pd.DataFrame(list(records.values()), columns=FAILED_TICKERS_HEADER)
+            )
+
+    @classmethod
+    def clear(cls, symbols: List[str], start_date: str) -> None:
+        # symbols downloaded and checked from start_date, which also pass the
+        # data-quality checks of the returns from any later date
+        known = set(cls.load()["symbol"])
+        symbols = [x for x in symbols if x in known]
+        if not symbols:
+            return
+        with FileLock(str(FAILED_TICKERS_CSV) + ".lock", timeout=20):
+            failed_df = cls.read()
+            cleared = failed_df["symbol"].isin(symbols) & (
+                (failed_df["kind"] == "download")
+                | (failed_df["start_date"] >= start_date)
+            )
+            cls.write(failed_df[~cleared])
+
+    @classmethod
+    def prune(cls, cutoff_time, logger) -> int:
+        # failures that were due to be probed before cutoff_time, e.g. of
+        # tickers that are no longer ranked
+        if not FAILED_TICKERS_CSV.exists():
+            return 0
+        with FileLock(str(FAILED_TICKERS_CSV) + ".lock", timeout=20):
+            failed_df = cls.read()
+            failed_df = failed_df[failed_df["retry_after"] > cutoff_time]
+            cls.write(failed_df)
+        logger.info(f"Pruned failed tickers to {FAILED_TICKERS_CSV}: {failed_df.shape}")
+        return failed_df.shape[0]
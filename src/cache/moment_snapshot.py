@@ -0,0 +1,303 @@
+import json
+import os
+import shutil
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from filelock import FileLock, Timeout
+
+from backend.data_provider import get_data_provider
+from backend.yf_utils import YFReturnsCache
+from cache import MOMENT_SNAPSHOT_DIR, Cache
+from cache.etf_volume import ETFVolumeCache
+from moments import RollingMoments
+
+MOMENT_SNAPSHOT_UNIVERSE_SIZE = 1000
+MOMENT_SNAPSHOT_LOOKBACKS: List[float] = [1, 3, 5, 10]
+MOMENT_SNAPSHOT_REBUILD_DAYS = 7
+# trading days downloaded before the last snapshot date on an update, so that
+# the first new return is not lost to the diff of the prices
+MOMENT_SNAPSHOT_OVERLAP_DAYS = 10
+MOMENT_SNAPSHOT_STATS = ["shift", "n", "sx", "sxx", "sxy"]
+MOMENT_SNAPSHOT_POINTER = MOMENT_SNAPSHOT_DIR / "CURRENT"
+
+
+def get_start_date(end_date: pd.Timestamp, num_years: float) -> str:
+    # same window as ETFOptimizer
+    return (end_date - pd.Timedelta(days=int(365 * num_years))).strftime("%Y-%m-%d")
+
+
+def get_window_start(dates: pd.Index, start_date: str) -> int:
+    # the first return downloaded from start_date is the diff against a price
+    # that was not downloaded, i.e. NaN for every ETF, so it is not in the
+    # window an optimizer would see
+    return int(np.searchsorted(dates.to_numpy(), np.datetime64(start_date))) + 1
+
+
+class MomentSnapshot(object):
+    """Mean and covariance of the daily returns of the ranked universe
+
+    The moments are stored for a fixed set of lookbacks ending on the same
+    date and memory-mapped, so all the workers share one copy in the page
+    cache and a task only reads the rows and columns of the ETFs it selected.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path / "meta.json") as f:
+            self.meta = json.load(f)
+        self.currency: str = self.meta["currency"]
+        self.end_date: str = self.meta["end_date"]
+        self.symbols: List[str] = self.meta["symbols"]
+        self.symbol_idx = {symbol: idx for idx, symbol in enumerate(self.symbols)}
+        self.lookbacks: Dict[str, Dict] = self.meta["lookbacks"]
+        self.arrays: Dict[str, np.ndarray] = {}
+
+    def load_array(self, name: str) -> np.ndarray:
+        if name not in self.arrays:
+            self.arrays[name] = np.load(self.path / f"{name}.npy", mmap_mode="r")
+        return self.arrays[name]
+
+    def covers(
+        self,
+        currency: str,
+        num_years: float,
+        start_date: str,
+        end_date: str,
+        symbols: List[str],
+    ) -> bool:
+        lookback = self.lookbacks.get(f"{num_years:g}")
+        return (
+            (currency == self.currency)
+            and (lookback is not None)
+            and (lookback["start_date"] == start_date)
+            and (end_date == self.end_date)
+            and all(symbol in self.symbol_idx for symbol in symbols)
+        )
+
+    def get_moments(
+        self, num_years: float, symbols: List[str]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        idx = np.array([self.symbol_idx[symbol] for symbol in symbols])
+        mean = self.load_array(f"{num_years:g}y_mean")[idx]
+        cov = self.load_array(f"{num_years:g}y_cov")[np.ix_(idx, idx)]
+        return mean, cov
+
+
+class MomentSnapshotCache(Cache):
+
+    cache_version = 1
+    loaded: Optional[MomentSnapshot] = None
+    loaded_version: Optional[str] = None
+
+    def __init__(
+        self,
+        contract_list: List[str],
+        currency: str,
+        lookbacks: List[float] = MOMENT_SNAPSHOT_LOOKBACKS,
+    ):
+        self.contract_list = contract_list
+        self.currency = currency
+        self.lookbacks = lookbacks
+        self.prune_cutoff_time: Optional[pd.Timestamp] = None
+
+    def prune(self, cutoff_time, logger) -> int:
+        # a snapshot is rebuilt from scratch once it is older than cutoff_time
+        # and updated with the new days otherwise, so this only reports the
+        # number of ETFs in a snapshot that can be updated
+        snapshot = self.load()
+        if snapshot is None:
+            return 0
+        if (
+            (pd.Timestamp(snapshot.meta["build_time"]) < cutoff_time)
+            or (snapshot.currency != self.currency)
+            or (sorted(snapshot.lookbacks) != sorted(f"{x:g}" for x in self.lookbacks))
+        ):
+            logger.info(f"Moment snapshot {snapshot.path} is stale")
+            return 0
+        return len(snapshot.symbols)
+
+    def _build(self, max_new_entries, logger) -> Tuple[pd.DataFrame, Dict, Dict]:
+        now = pd.Timestamp.now("UTC")
+        end_date = now.strftime("%Y-%m-%d")
+        start_date = get_start_date(now, max(self.lookbacks))
+        universe = self.contract_list[:max_new_entries]
+        returns_cache = YFReturnsCache(start_date, end_date, universe)
+        returns_df = returns_cache.get_return_df(logger, max_return=np.inf)
+        returns_df = returns_df.sort_index()
+        returns_df.index = pd.DatetimeIndex(returns_df.index).tz_localize(None)
+        logger.info(f"Computing moment snapshot for {returns_df.shape} returns")
+
+        returns = returns_df.to_numpy()
+        lookbacks: Dict[str, Dict] = {}
+        moments: Dict[str, RollingMoments] = {}
+        for num_years in self.lookbacks:
+            window_start_date = get_start_date(now, num_years)
+            window_start = get_window_start(returns_df.index, window_start_date)
+            window = returns[window_start:]
+            key = f"{num_years:g}"
+            moments[key] = RollingMoments(
+                window.shape[1], shift=np.nanmean(window, axis=0)
+            )
+            moments[key].add(window)
+            lookbacks[key] = {"start_date": window_start_date, "start": window_start}
+        return returns_df, lookbacks, moments
+
+    def _update(
+        self, snapshot: MomentSnapshot, logger
+    ) -> Optional[Tuple[pd.DataFrame, Dict, Dict]]:
+        now = pd.Timestamp.now("UTC")
+        end_date = now.strftime("%Y-%m-%d")
+        if end_date == snapshot.end_date:
+            logger.info(f"Moment snapshot {snapshot.path} is up to date")
+            return None
+        old_returns = snapshot.load_array("returns")
+        old_dates = pd.DatetimeIndex(snapshot.meta["dates"])
+        download_start = old_dates[
+            max(0, len(old_dates) - MOMENT_SNAPSHOT_OVERLAP_DAYS)
+        ]
+        returns_cache = YFReturnsCache(
+            download_start.strftime("%Y-%m-%d"), end_date, snapshot.symbols
+        )
+        new_df = returns_cache.get_return_df(logger, max_return=np.inf)
+        new_df = new_df.sort_index().reindex(columns=snapshot.symbols)
+        new_df.index = pd.DatetimeIndex(new_df.index).tz_localize(None)
+        new_df = new_df[new_df.index > old_dates[-1]]
+        logger.info(f"Adding {len(new_df)} days to moment snapshot")
+        returns_df = pd.concat(
+            [
+                pd.DataFrame(old_returns, index=old_dates, columns=snapshot.symbols),
+                new_df,
+            ]
+        )
+
+        returns = returns_df.to_numpy()
+        lookbacks: Dict[str, Dict] = {}
+        moments: Dict[str, RollingMoments] = {}
+        for key, old_lookback in snapshot.lookbacks.items():
+            window_start_date = get_start_date(now, float(key))
+            window_start = get_window_start(returns_df.index, window_start_date)
+            moments[key] = RollingMoments(len(snapshot.symbols))
+            for stat in MOMENT_SNAPSHOT_STATS:
+                setattr(
+                    moments[key], stat, np.array(snapshot.load_array(f"{key}y_{stat}"))
+                )
+            # slide the window [old start, old end) to [new start, new end)
+            moments[key].add(returns[len(old_dates) :])
+            moments[key].remove(returns[old_lookback["start"] : window_start])
+            lookbacks[key] = {"start_date": window_start_date, "start": window_start}
+
+        # drop the rows that are no longer in any window
+        first_row = min(lookback["start"] for lookback in lookbacks.values())
+        for lookback in lookbacks.values():
+            lookback["start"] -= first_row
+        return returns_df.iloc[first_row:], lookbacks, moments
+
+    def _save(
+        self,
+        returns_df: pd.DataFrame,
+        lookbacks: Dict[str, Dict],
+        moments: Dict[str, RollingMoments],
+        build_time: str,
+        logger,
+    ) -> int:
+        end_date = pd.Timestamp.now("UTC").strftime("%Y-%m-%d")
+        version = f"{end_date}_{time.time_ns()}"
+        path = MOMENT_SNAPSHOT_DIR / version
+        path.mkdir(parents=True)
+        np.save(path / "returns.npy", returns_df.to_numpy())
+        for key, rolling_moments in moments.items():
+            for stat in MOMENT_SNAPSHOT_STATS:
+                np.save(path / f"{key}y_{stat}.npy", getattr(rolling_moments, stat))
+            np.save(path / f"{key}y_mean.npy", rolling_moments.mean())
+            np.save(path / f"{key}y_cov.npy", rolling_moments.cov())
+        meta = {
+            "cache_version": self.cache_version,
+            "currency": self.currency,
+            "end_date": end_date,
+            "build_time": build_time,
+            "symbols": list(returns_df.columns),
+            "dates": [f"{date:%Y-%m-%d}" for date in returns_df.index],
+            "lookbacks": lookbacks,
+        }
+        with open(path / "meta.json", "w") as f:
+            json.dump(meta, f)
+
+        # readers do not take the lock, so switch to the new version
+        # atomically; the old versions are still mapped by the readers that
+        # loaded them, which is fine since unlinking does not unmap them
+        tmp_pointer = MOMENT_SNAPSHOT_POINTER.with_suffix(".tmp")
+        tmp_pointer.write_text(version)
+        os.replace(tmp_pointer, MOMENT_SNAPSHOT_POINTER)
+        for old_path in MOMENT_SNAPSHOT_DIR.iterdir():
+            if old_path.is_dir() and old_path.name != version:
+                shutil.rmtree(old_path, ignore_errors=True)
+        logger.info(f"Saved moment snapshot to {path}: {returns_df.shape}")
+        return returns_df.shape[1]
+
+    def _populate(self, max_new_entries, logger) -> int:
+        snapshot = self.load()
+        if (snapshot is not None) and (self.prune_cutoff_time is not None):
+            if pd.Timestamp(snapshot.meta["build_time"]) >= self.prune_cutoff_time:
+                update = self._update(snapshot, logger)
+                if update is None:
+                    return len(snapshot.symbols)
+                return self._save(*update, snapshot.meta["build_time"], logger)
+        build_time = str(pd.Timestamp.now("UTC"))
+        return self._save(*self._build(max_new_entries, logger), build_time, logger)
+
+    def populate(
+        self,
+        max_new_entries=MOMENT_SNAPSHOT_UNIVERSE_SIZE,
+        logger=None,
+        prune_cutoff_time=None,
+    ) -> int:
+        # with prune_cutoff_time, a snapshot built after it is updated with the
+        # days since it was last saved instead of being rebuilt
+        MOMENT_SNAPSHOT_DIR.mkdir(parents=True, exist_ok=True)
+        self.prune_cutoff_time = prune_cutoff_time
+        lock = FileLock(str(MOMENT_SNAPSHOT_DIR) + ".lock")
+        with lock.acquire(timeout=20):
+            return self._populate(max_new_entries, logger)
+
+    @classmethod
+    def load(cls) -> Optional[MomentSnapshot]:
+        if not MOMENT_SNAPSHOT_POINTER.exists():
+            return None
+        version = MOMENT_SNAPSHOT_POINTER.read_text().strip()
+        if cls.loaded_version != version:
+            cls.loaded = MomentSnapshot(MOMENT_SNAPSHOT_DIR / version)
+            cls.loaded_version = version
+        return cls.loaded
+
+    @classmethod
+    def process_cache(
+        cls,
+        logger,
+        currency="USD",
+        universe_size=MOMENT_SNAPSHOT_UNIVERSE_SIZE,
+        days_to_rebuild_after=MOMENT_SNAPSHOT_REBUILD_DAYS,
+        num_retries=3,
+    ) -> None:
+        etf_volume_cache = ETFVolumeCache(get_data_provider().list_etfs())
+        moment_snapshot_cache = MomentSnapshotCache(
+            etf_volume_cache.ranked_symbols(currency), currency
+        )
+        cache_cutoff_time = pd.Timestamp.now("UTC") - pd.Timedelta(
+            days=days_to_rebuild_after
+        )
+        for _ in range(num_retries):
+            try:
+                if moment_snapshot_cache.prune(cache_cutoff_time, logger) == 0:
+                    num_entries = moment_snapshot_cache.populate(universe_size, logger)
+                else:
+                    num_entries = moment_snapshot_cache.populate(
+                        universe_size, logger, prune_cutoff_time=cache_cutoff_time
+                    )
+                logger.info(f"Moment snapshot has {num_entries} ETFs")
+                break
+            except Timeout:
+                logger.info("Another process is building the snapshot, waiting...")
+                time.sleep(10)
@@ -1,6 +1,25 @@
+import pandas as pd
+
+from cache.corr_index import CorrelationIndexCache
 from cache.etf_volume import ETFVolumeCache
+from cache.failed_tickers import MAX_RETRY_HOURS, FailedTickerCache
+from cache.moment_snapshot import MomentSnapshotCache
+from solver_telemetry import SLOW_SOLVE_DAYS, prune_slow_solves
 
 
 def populate_all_caches(logger):
     # ETF Volume cache
     ETFVolumeCache.process_cache(logger, days_to_prune_after=3, chunk_size=50)
+    FailedTickerCache.prune(
+        pd.Timestamp.now("UTC") - pd.Timedelta(hours=MAX_RETRY_HOURS), logger
+    )
+    prune_slow_solves(
+        pd.Timestamp.now("UTC") - pd.Timedelta(days=SLOW_SOLVE_DAYS), logger
+    )
+
+
+def populate_nightly_caches(logger):
+    # caches that are too slow to build on server startup
+    populate_all_caches(logger)
+    CorrelationIndexCache.process_cache(logger)
+    MomentSnapshotCache.process_cache(logger)
@@ -0,0 +1,99 @@
+"""
+Hierarchical Risk Parity
+
+López de Prado, "Building Diversified Portfolios that Outperform Out of
+Sample" (2016). The assets are clustered on the correlation distance, ordered
+so that similar assets are next to each other, and the weights are split
+between the two halves of every cluster in inverse proportion to their
+variance. No optimization problem is solved, so it scales to large universes
+and does not need an invertible covariance matrix.
+
+"""
+
+import numpy as np
+import scipy.cluster.hierarchy as sch
+from scipy.spatial.distance import squareform
+
+
+def get_quasi_diag_order(cov: np.ndarray) -> np.ndarray:
+    """Order of the assets given by single-linkage clustering
+
+    Parameters
+    ----------
+        cov: covariance matrix
+
+    Returns
+    -------
+        order: permutation of range(N) that puts the leaves of the same
+            cluster next to each other
+    """
+    std = np.sqrt(np.diag(cov))
+    corr = np.clip(cov / np.outer(std, std), -1.0, 1.0)
+    dist = np.sqrt((1 - corr) / 2)
+    np.fill_diagonal(dist, 0.0)
+    link = sch.linkage(squareform(dist, checks=False), method="single")
+    return sch.leaves_list(link)
+
+
+def get_recursive_bisection_weights(cov: np.ndarray) -> np.ndarray:
+    """Split the weights between the halves of every cluster
+
+    All the clusters of one level of the bisection are handled at once: the
+    variance of every cluster under inverse-variance weights is a sum over
+    the blocks on the diagonal of cov, which takes O(N^2) per level and
+    O(N^2 log N) in total.
+
+    Parameters
+    ----------
+        cov: covariance matrix, with the assets in quasi-diagonal order
+
+    Returns
+    -------
+        w: weights in the same order as cov
+    """
+    num_assets = len(cov)
+    inv_var = 1 / np.diag(cov)
+    w = np.ones(num_assets)
+    bounds = np.array([0, num_assets])
+    while (np.diff(bounds) > 1).any():
+        starts, ends = bounds[:-1], bounds[1:]
+        split = ends - starts > 1
+        mids = (starts[split] + ends[split]) // 2
+        bounds = np.sort(np.concatenate([bounds, mids]))
+        # cluster of every asset and its variance with inverse-variance weights
+        cluster = np.searchsorted(bounds, np.arange(num_assets), side="right") - 1
+        cluster_inv_var = np.bincount(cluster, weights=inv_var)
+        ivp = inv_var / cluster_inv_var[cluster]
+        same_cluster = cluster[:, None] == cluster[None, :]
+        cluster_var = np.bincount(cluster, weights=((cov * same_cluster) @ ivp) * ivp)
+        # the left half of a split cluster starts at its old start
+        left = np.searchsorted(bounds, starts[split])
+        alpha = 1 - cluster_var[left] / (cluster_var[left] + cluster_var[left + 1])
+        factor = np.ones(len(bounds) - 1)
+        factor[left] = alpha
+        factor[left + 1] = 1 - alpha
+        w *= factor[cluster]
+    return w
+
+
+def find_hrp_portfolio(exp_rets: np.ndarray, cov: np.ndarray):
+    """Find the Hierarchical Risk Parity portfolio
+
+    Parameters
+    ----------
+        exp_rets: expected returns
+        cov: covariance matrix
+
+    Returns
+    -------
+        (w, r_opt, vol_opt)
+        w: portfolio weights
+        r_opt: return of the portfolio
+        vol_opt: volatility of the portfolio
+    """
+    order = get_quasi_diag_order(cov)
+    w = np.zeros(len(cov))
+    w[order] = get_recursive_bisection_weights(cov[np.ix_(order, order)])
+    r_opt = np.dot(w, exp_rets)
+    vol_opt = np.sqrt(max(np.dot(w, cov @ w), 0.0))
+    return w, r_opt, vol_opt
@@ -0,0 +1,423 @@
+"""
+Load test of the web app against a local stand-in for Yahoo
+
+Usage: cd src && python loadtest.py --users 16 --duration 300
+           [--data-dir __cache__/market_data] [--latency 0.2] [--error-rate 0.05]
+           [--output loadtest.json]
+
+The stand-in serves the files recorded with DATA_PROVIDER=record in
+--data-dir, or a synthetic market if it is not given, with an exponentially
+distributed latency and a share of 503 errors. app.py is started against it
+with DATA_PROVIDER=http in a scratch directory, so that it starts with empty
+caches. The simulated users submit optimizer and backtest tasks, reload the
+pages of their tasks and render plots, with a random think time in between.
+
+The report has the throughput, errors and latency percentiles of every
+route, the completion time of the tasks, and the RSS and CPU of the app.
+"""
+
+import argparse
+import functools
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter, defaultdict
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from benchmark import get_commit
+from synthetic import SyntheticMarket
+
+SRC_DIR = Path(__file__).resolve().parent
+PERCENTILES = (50, 95, 99)
+# the states of a finished task in the API
+FINISHED_STATES = ("SUCCESS", "FAILURE", "NOT_FOUND")
+
+
+class StandIn(object):
+    """HTTP server of a data directory with injected latency and errors"""
+
+    def __init__(
+        self, data_dir: Path, port: int, latency: float, error_rate: float, seed=0
+    ):
+        self.data_dir = data_dir
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts: Counter = Counter()
+        handler = functools.partial(StandInHandler, stand_in=self)
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self) -> None:
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def draw(self) -> Tuple[float, bool]:
+        # the latency of a request and whether it fails
+        with self.lock:
+            delay = self.rng.expovariate(1 / self.latency) if self.latency > 0 else 0
+            fail = self.rng.random() < self.error_rate
+            self.counts["errors" if fail else "requests"] += 1
+        return delay, fail
+
+
+class StandInHandler(SimpleHTTPRequestHandler):
+    def __init__(self, *args, stand_in: StandIn, **kwargs):
+        self.stand_in = stand_in
+        super().__init__(*args, directory=str(stand_in.data_dir), **kwargs)
+
+    def do_GET(self):
+        delay, fail = self.stand_in.draw()
+        time.sleep(delay)
+        if fail:
+            self.send_error(503)
+        else:
+            super().do_GET()
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+def read_process_stats(pid: int) -> Tuple[float, float]:
+    # RSS in MB and CPU time in seconds of a process, from /proc on Linux
+    with open(f"/proc/{pid}/status") as f:
+        rss_kb = next(int(x.split()[1]) for x in f if x.startswith("VmRSS:"))
+    with open(f"/proc/{pid}/stat") as f:
+        # utime and stime are the 14th and 15th fields, after the command name
+        fields = f.read().rsplit(")", 1)[1].split()
+    cpu_seconds = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    return rss_kb / 1024, cpu_seconds
+
+
+class LoadTest(object):
+    def __init__(self, base_url: str, symbols: List[str], args: argparse.Namespace):
+        self.base_url = base_url
+        self.symbols = symbols
+        self.args = args
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Counter = Counter()
+        # submit time of the tasks, and the time they took once finished
+        self.submitted: Dict[str, float] = {}
+        self.finished: Dict[str, Tuple[str, float]] = {}
+        self.samples: List[Tuple[float, float, float]] = []
+
+    def request(
+        self,
+        route: str,
+        path: str,
+        data: Optional[bytes] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> Tuple[int, bytes]:
+        req = urllib.request.Request(
+            self.base_url + path, data=data, headers=headers or {}
+        )
+        start_time = time.perf_counter()
+        try:
+            with urllib.request.urlopen(req, timeout=self.args.timeout) as response:
+                status, body = response.status, response.read()
+        except urllib.error.HTTPError as e:
+            status, body = e.code, e.read()
+        except OSError:
+            status, body = 0, b""
+        seconds = time.perf_counter() - start_time
+        with self.lock:
+            self.latencies[route].append(seconds)
+            if (status == 0) or (status >= 500):
+                self.errors[route] += 1
+        return status, body
+
+    def submit(self, rng: random.Random) -> None:
+        body = {
+            "universe": "etf_vol",
+            "mode": (
+                "backtest" if rng.random() < self.args.backtest_ratio else "optimize"
+            ),
+            "method": "hrp" if rng.random() < self.args.hrp_ratio else "mean_variance",
+        }
+        if self.args.num_contracts is not None:
+            body["num_contracts"] = self.args.num_contracts
+        status, data = self.request(
+            "POST /api/v1/tasks",
+            "/api/v1/tasks",
+            data=json.dumps(body).encode(),
+            headers={"Content-Type": "application/json"},
+        )
+        if status == 202:
+            with self.lock:
+                self.submitted[json.loads(data)["task_id"]] = time.perf_counter()
+
+    def poll(self, rng: random.Random) -> None:
+        with self.lock:
+            task_ids = [x for x in self.submitted if x not in self.finished]
+        if task_ids:
+            self.request("GET /task/<id>", f"/task/{rng.choice(task_ids)}")
+        else:
+            self.plot(rng)
+
+    def plot(self, rng: random.Random) -> None:
+        symbols = rng.sample(self.symbols, min(4, len(self.symbols)))
+        end = pd.Timestamp.now()
+        start = end - pd.Timedelta(days=int(365 * self.args.plot_years))
+        query = {
+            "portfolio": "|".join(f"{x}:{1 / len(symbols)}" for x in symbols),
+            "start_date": f"{start:%Y-%m-%d}",
+            "end_date": f"{end:%Y-%m-%d}",
+            "sip_amount": "1000",
+            "sip_frequency_days": "30",
+        }
+        self.request(
+            "GET /plot.html",
+            "/plot.html?" + urllib.parse.urlencode(query),
+            headers={"Cookie": "cookies_allowed=T"},
+        )
+
+    def run_user(self, seed: int) -> None:
+        rng = random.Random(seed)
+        actions = [self.submit, self.poll, self.plot]
+        weights = [
+            self.args.submit_weight,
+            self.args.poll_weight,
+            self.args.plot_weight,
+        ]
+        while not self.stop_event.wait(rng.expovariate(1 / self.args.think_time)):
+            rng.choices(actions, weights)[0](rng)
+
+    def monitor_tasks(self, finish_event: threading.Event) -> None:
+        # the status of every running task, which also keeps it from being
+        # cancelled for not being polled
+        while not finish_event.wait(1):
+            with self.lock:
+                task_ids = [x for x in self.submitted if x not in self.finished]
+            for task_id in task_ids:
+                status, data = self.request(
+                    "GET /api/v1/tasks/<id>", f"/api/v1/tasks/{task_id}"
+                )
+                if status in (200, 404):
+                    state = json.loads(data).get("state", "NOT_FOUND")
+                    if state in FINISHED_STATES:
+                        with self.lock:
+                            seconds = time.perf_counter() - self.submitted[task_id]
+                            self.finished[task_id] = (state, seconds)
+
+    def sample_process(self, pid: int, finish_event: threading.Event) -> None:
+        while not finish_event.wait(1):
+            try:
+                rss_mb, cpu_seconds = read_process_stats(pid)
+            except OSError:
+                return
+            self.samples.append((time.perf_counter(), rss_mb, cpu_seconds))
+
+    def num_running(self) -> int:
+        with self.lock:
+            return len(self.submitted) - len(self.finished)
+
+    def run(self, pid: int) -> float:
+        finish_event = threading.Event()
+        background = [
+            threading.Thread(target=self.monitor_tasks, args=(finish_event,)),
+            threading.Thread(target=self.sample_process, args=(pid, finish_event)),
+        ]
+        users = [
+            threading.Thread(target=self.run_user, args=(self.args.seed + i,))
+            for i in range(self.args.users)
+        ]
+        start_time = time.perf_counter()
+        for thread in background + users:
+            thread.start()
+        time.sleep(self.args.duration)
+        self.stop_event.set()
+        for thread in users:
+            thread.join()
+        duration = time.perf_counter() - start_time
+        # the tasks that are still running are given time to finish
+        drain_end = time.perf_counter() + self.args.drain
+        while (self.num_running() > 0) and (time.perf_counter() < drain_end):
+            time.sleep(1)
+        finish_event.set()
+        for thread in background:
+            thread.join()
+        return duration
+
+    def report(self, duration: float) -> Dict:
+        routes = []
+        for route, latencies in sorted(self.latencies.items()):
+            percentiles = np.percentile(latencies, PERCENTILES)
+            routes.append(
+                {
+                    "route": route,
+                    "requests": len(latencies),
+                    "errors": self.errors[route],
+                    "requests_per_second": len(latencies) / duration,
+                    **{f"p{p}_ms": 1000 * x for p, x in zip(PERCENTILES, percentiles)},
+                    "max_ms": 1000 * max(latencies),
+                }
+            )
+        seconds = [x[1] for x in self.finished.values()]
+        tasks: Dict[str, float] = {
+            "submitted": len(self.submitted),
+            "unfinished": len(self.submitted) - len(self.finished),
+            **Counter(x[0].lower() for x in self.finished.values()),
+        }
+        if seconds:
+            percentiles = np.percentile(seconds, PERCENTILES)
+            tasks.update(
+                {f"p{p}_seconds": float(x) for p, x in zip(PERCENTILES, percentiles)}
+            )
+            tasks["max_seconds"] = max(seconds)
+        process = {}
+        if len(self.samples) > 1:
+            times, rss_mb, cpu_seconds = map(np.array, zip(*self.samples))
+            cpu_percent = 100 * np.diff(cpu_seconds) / np.diff(times)
+            process = {
+                "mean_rss_mb": float(rss_mb.mean()),
+                "max_rss_mb": float(rss_mb.max()),
+                "mean_cpu_percent": float(cpu_percent.mean()),
+                "max_cpu_percent": float(cpu_percent.max()),
+            }
+        return {"routes": routes, "tasks": tasks, "process": process}
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=120, help="Seconds")
+    parser.add_argument("--drain", type=float, default=300, help="Seconds")
+    parser.add_argument("--think-time", type=float, default=2, help="Mean seconds")
+    parser.add_argument("--submit-weight", type=float, default=1)
+    parser.add_argument("--poll-weight", type=float, default=8)
+    parser.add_argument("--plot-weight", type=float, default=2)
+    parser.add_argument("--backtest-ratio", type=float, default=0.1)
+    parser.add_argument("--hrp-ratio", type=float, default=0.2)
+    parser.add_argument("--num-contracts", type=int)
+    parser.add_argument("--plot-years", type=float, default=3)
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds")
+    parser.add_argument("--data-dir", type=Path, help="Recorded data to serve")
+    parser.add_argument("--num-assets", type=int, default=300)
+    parser.add_argument("--num-years", type=float, default=9)
+    parser.add_argument("--latency", type=float, default=0.05, help="Mean seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument(
+        "--startup-mode", choices=["blocking", "background"], default="blocking"
+    )
+    parser.add_argument("--startup-timeout", type=float, default=600)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="loadtest.json")
+    return parser.parse_args()
+
+
+def wait_until_ready(
+    url: str, app: subprocess.Popen, timeout: float
+) -> Tuple[float, float]:
+    # seconds until the first response of the app and until it is ready, the
+    # same unless it populates its caches in the background
+    start_time = time.perf_counter()
+    first_byte_seconds = None
+    while time.perf_counter() - start_time < timeout:
+        assert app.poll() is None, f"The app exited with {app.returncode}"
+        try:
+            with urllib.request.urlopen(f"{url}/ready", timeout=5):
+                seconds = time.perf_counter() - start_time
+                return first_byte_seconds or seconds, seconds
+        except urllib.error.HTTPError:
+            if first_byte_seconds is None:
+                first_byte_seconds = time.perf_counter() - start_time
+        except OSError:
+            pass
+        time.sleep(0.1)
+    raise TimeoutError(f"The app was not ready in {timeout}s")
+
+
+def main() -> None:
+    args = parse_args()
+    work_dir = Path(tempfile.mkdtemp(prefix="loadtest_"))
+    # the app expects its cache directory to exist
+    (work_dir / "__cache__").mkdir()
+    data_dir = args.data_dir
+    if data_dir is None:
+        data_dir = work_dir / "market_data"
+        SyntheticMarket(args.num_assets, args.num_years, seed=args.seed).save(data_dir)
+    symbols = list(pd.read_csv(data_dir / "etfs.csv")["symbol"])
+    stand_in = StandIn(data_dir, 0, args.latency, args.error_rate, seed=args.seed)
+    stand_in.start()
+    env = dict(
+        os.environ,
+        DATA_PROVIDER="http",
+        DATA_URL=stand_in.url,
+        PORT=str(args.port),
+        STARTUP_MODE=args.startup_mode,
+        THREADS=str(args.threads),
+    )
+    with open(work_dir / "app.log", "w") as log_file:
+        app = subprocess.Popen(
+            [sys.executable, str(SRC_DIR / "app.py")],
+            cwd=work_dir,
+            env=env,
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+        )
+    url = f"http://127.0.0.1:{args.port}"
+    try:
+        first_byte_seconds, ready_seconds = wait_until_ready(
+            url, app, args.startup_timeout
+        )
+        print(
+            f"App answered in {first_byte_seconds:.1f}s and was ready in "
+            f"{ready_seconds:.1f}s, logs in {work_dir / 'app.log'}"
+        )
+        load_test = LoadTest(url, symbols, args)
+        duration = load_test.run(app.pid)
+        report = load_test.report(duration)
+    finally:
+        app.terminate()
+        app.wait()
+        stand_in.stop()
+    report["process"]["first_byte_seconds"] = first_byte_seconds
+    report["process"]["ready_seconds"] = ready_seconds
+    report["stand_in"] = dict(stand_in.counts)
+    output = {
+        "meta": {
+            "commit": get_commit(),
+            "time": pd.Timestamp.now("UTC").isoformat(),
+            "duration": duration,
+            "args": {
+                k: str(v) if isinstance(v, Path) else v for k, v in vars(args).items()
+            },
+        },
+        **report,
+    }
+    print(
+        pd.DataFrame(report["routes"]).to_string(
+            index=False, float_format="{:.1f}".format
+        )
+    )
+    print(f"Tasks: {report['tasks']}")
+    print(f"App: {report['process']}")
+    print(f"Stand-in: {report['stand_in']}")
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2, default=float)
+    print(f"Wrote the report to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
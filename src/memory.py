@@ -0,0 +1,384 @@
+"""
+Memory accounting and admission control of the optimizer tasks
+
+The resident memory of the process is sampled by one thread while tasks or
+plots run, and every one of them records the peak it saw and how much it is
+above the memory at its start. The tasks share the process, so the increase
+of a task also includes what the tasks running next to it allocate.
+
+Before a task starts, its footprint is estimated from its number of ETFs, the
+number of candidates its selection is expected to scan, and its days of
+returns, and reserved from MEMORY_BUDGET_MB while it runs:
+- a task that fits in what is left of the budget starts right away
+- a task that only fits once running tasks finish waits for them, in the
+  order the tasks were submitted
+- a task larger than the whole budget is downsized to fewer ETFs
+- a task is rejected if MAX_QUEUED_TASKS are already waiting, or if it would
+  have to be downsized below MIN_CONTRACTS ETFs
+
+The results kept for the finished tasks are also counted in the budget, until
+they are evicted.
+
+"""
+
+import math
+import os
+import resource
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Deque, Dict, Iterator, Optional, Set
+
+from metrics import Counter, Gauge, Histogram
+from task_control import CancelToken
+
+MEMORY_BUDGET_MB = float(os.getenv("MEMORY_BUDGET_MB", "2048"))
+MAX_QUEUED_TASKS = int(os.getenv("MAX_QUEUED_TASKS", "8"))
+MIN_CONTRACTS = 10
+# share of the budget the results of the finished tasks may take before the
+# oldest ones are evicted early
+MAX_RETAINED_RATIO = 0.25
+SAMPLE_SECONDS = 0.1
+NUM_DAYS_PER_YEAR = 252
+# fitted on the peaks traced while optimizing synthetic markets: the returns
+# of every candidate scanned are kept by the returns cache, their copies in
+# the selection and the optimizer grow with the days times the ETFs, the
+# covariance matrices and the frontier with the square of the ETFs
+BYTES_PER_SCANNED_RETURN = 16
+BYTES_PER_RETURN = 48
+BYTES_PER_COVARIANCE = 144
+# candidates scanned per ETF selected, until the first selections are seen
+SCAN_RATIO = 1.5
+# the resident memory is above the traced peak, for the allocator and the
+# buffers of numpy that are not traced
+OVERHEAD_RATIO = 1.5
+MIN_FOOTPRINT_MB = 32
+
+MB = 2**20
+# bytes, from a plot to the largest tasks
+MEMORY_BUCKETS = tuple(x * MB for x in (8, 32, 128, 256, 512, 1024, 2048, 4096))
+
+RESIDENT_BYTES = Gauge(
+    "etf_optimizer_resident_memory_bytes",
+    "Resident memory of the process, sampled while tasks or plots run",
+)
+RESERVED_BYTES = Gauge(
+    "etf_optimizer_reserved_memory_bytes",
+    "Estimated footprints of the running tasks, out of the memory budget",
+)
+RETAINED_BYTES = Gauge(
+    "etf_optimizer_retained_memory_bytes",
+    "Size of the results kept for the finished tasks, out of the memory budget",
+)
+QUEUED_TASKS = Gauge(
+    "etf_optimizer_queued_tasks", "Tasks waiting for memory before they start"
+)
+ADMISSIONS_TOTAL = Counter(
+    "etf_optimizer_admissions_total",
+    "Admission decisions of the submitted tasks",
+    ["decision"],
+)
+PEAK_MEMORY_BYTES = Histogram(
+    "etf_optimizer_peak_memory_bytes",
+    "Peak resident memory of a task or plot above the memory at its start",
+    ["kind"],
+    buckets=MEMORY_BUCKETS,
+)
+
+
+class AdmissionError(Exception):
+    pass
+
+
+def get_resident_mb() -> float:
+    # current resident memory from /proc on Linux, else the peak so far
+    try:
+        with open("/proc/self/statm") as f:
+            num_pages = int(f.read().split()[1])
+        return num_pages * os.sysconf("SC_PAGE_SIZE") / MB
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class ScanDepth(object):
+    """Candidates the selections scan per ETF they select
+
+    Every candidate is downloaded and kept until the task ends, whether it
+    is selected or dropped for its data or its correlation, so the memory of
+    a task depends on how deep its selection scans. The ratio is a moving
+    average over the recent selections.
+    """
+
+    def __init__(self, ratio: float = SCAN_RATIO, weight: float = 0.2):
+        self.ratio = ratio
+        self.weight = weight
+        self.lock = threading.Lock()
+
+    def observe(self, num_scanned: int, num_selected: int) -> None:
+        if num_selected <= 0:
+            return
+        with self.lock:
+            ratio = max(1.0, num_scanned / num_selected)
+            self.ratio += self.weight * (ratio - self.ratio)
+
+
+SCAN_DEPTH = ScanDepth()
+
+
+def estimate_footprint_mb(
+    num_contracts: int, num_years: float, scan_ratio: Optional[float] = None
+) -> float:
+    """Estimated peak memory of a task, in MB
+
+    Parameters
+    ----------
+    num_contracts : int
+        Number of ETFs of the portfolio
+    num_years : float
+        Years of daily returns the task downloads, including the backtest
+        years of a backtest
+    scan_ratio : float, optional
+        Candidates scanned per ETF selected, by default the ratio of the
+        recent selections
+
+    Returns
+    -------
+    float
+        Resident memory the task adds to the process at its peak
+    """
+    scan_ratio = SCAN_DEPTH.ratio if scan_ratio is None else scan_ratio
+    num_days = num_years * NUM_DAYS_PER_YEAR
+    traced_bytes = (
+        BYTES_PER_RETURN + BYTES_PER_SCANNED_RETURN * scan_ratio
+    ) * num_days * num_contracts + BYTES_PER_COVARIANCE * num_contracts**2
+    return MIN_FOOTPRINT_MB + OVERHEAD_RATIO * traced_bytes / MB
+
+
+def get_max_contracts(
+    num_years: float, footprint_mb: float, scan_ratio: Optional[float] = None
+) -> int:
+    # largest number of ETFs with an estimated footprint <= footprint_mb, the
+    # positive root of the quadratic of estimate_footprint_mb
+    scan_ratio = SCAN_DEPTH.ratio if scan_ratio is None else scan_ratio
+    traced_bytes = max(0.0, footprint_mb - MIN_FOOTPRINT_MB) * MB / OVERHEAD_RATIO
+    b = (
+        (BYTES_PER_RETURN + BYTES_PER_SCANNED_RETURN * scan_ratio)
+        * num_years
+        * NUM_DAYS_PER_YEAR
+    )
+    a = BYTES_PER_COVARIANCE
+    return int((-b + math.sqrt(b**2 + 4 * a * traced_bytes)) / (2 * a))
+
+
+def get_size(value: Any) -> int:
+    # bytes of a result of to_dict() or to_html(), with the dicts, lists and
+    # strings it contains
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(get_size(k) + get_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(get_size(x) for x in value)
+    return size
+
+
+class MemoryUsage(object):
+    """Resident memory of the process while a task or plot runs, in MB"""
+
+    def __init__(self, kind: str, footprint_mb: Optional[float] = None):
+        self.kind = kind
+        self.footprint_mb = footprint_mb
+        self.start_mb = get_resident_mb()
+        self.peak_mb = self.start_mb
+
+    def update(self, resident_mb: float) -> None:
+        self.peak_mb = max(self.peak_mb, resident_mb)
+
+    def to_dict(self) -> Dict[str, Optional[float]]:
+        return {
+            "start_mb": round(self.start_mb, 1),
+            "peak_mb": round(self.peak_mb, 1),
+            "increase_mb": round(self.peak_mb - self.start_mb, 1),
+            # estimated before the task started
+            "footprint_mb": self.footprint_mb,
+        }
+
+    def __str__(self) -> str:
+        return f"peak {self.peak_mb:.0f}MB, +{self.peak_mb - self.start_mb:.0f}MB"
+
+
+class MemorySampler(object):
+    """Thread sampling the resident memory for the usages being tracked
+
+    The thread only runs while there is something to track.
+    """
+
+    def __init__(self, interval: float = SAMPLE_SECONDS):
+        self.interval = interval
+        self.usages: Set[MemoryUsage] = set()
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+
+    def sample(self) -> None:
+        resident_mb = get_resident_mb()
+        RESIDENT_BYTES.set(resident_mb * MB)
+        with self.lock:
+            for usage in self.usages:
+                usage.update(resident_mb)
+
+    def run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            self.sample()
+            with self.lock:
+                if not self.usages:
+                    self.thread = None
+                    return
+
+    @contextmanager
+    def track(
+        self, kind: str, footprint_mb: Optional[float] = None
+    ) -> Iterator[MemoryUsage]:
+        usage = MemoryUsage(kind, footprint_mb)
+        with self.lock:
+            self.usages.add(usage)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        try:
+            yield usage
+        finally:
+            self.sample()
+            with self.lock:
+                self.usages.discard(usage)
+            PEAK_MEMORY_BYTES.observe(
+                (usage.peak_mb - usage.start_mb) * MB, kind=usage.kind
+            )
+
+
+class Reservation(object):
+    def __init__(self, footprint_mb: float):
+        self.footprint_mb = footprint_mb
+        self.granted = False
+
+
+class MemoryBudget(object):
+    """Footprints of the running tasks and results of the finished ones,
+    reserved out of budget_mb"""
+
+    def __init__(
+        self, budget_mb: float = MEMORY_BUDGET_MB, max_queued: int = MAX_QUEUED_TASKS
+    ):
+        self.budget_mb = budget_mb
+        self.max_queued = max_queued
+        self.reserved_mb = 0.0
+        # results of the finished tasks, by task ID
+        self.retained: Dict[str, float] = {}
+        self.retained_mb = 0.0
+        self.queue: Deque[Reservation] = deque()
+        self.condition = threading.Condition()
+
+    def fits(self, reservation: Reservation) -> bool:
+        return (
+            self.reserved_mb + self.retained_mb + reservation.footprint_mb
+            <= self.budget_mb
+        )
+
+    def grant(self, reservation: Reservation) -> None:
+        reservation.granted = True
+        self.reserved_mb += reservation.footprint_mb
+        RESERVED_BYTES.set(self.reserved_mb * MB)
+
+    def downsize(self, num_contracts: int, num_years: float) -> int:
+        # number of ETFs of a task that fits in the whole budget
+        if estimate_footprint_mb(num_contracts, num_years) <= self.budget_mb:
+            return num_contracts
+        max_contracts = get_max_contracts(num_years, self.budget_mb)
+        if max_contracts < MIN_CONTRACTS:
+            ADMISSIONS_TOTAL.inc(decision="rejected")
+            raise AdmissionError(
+                f"{num_years:g} years of returns do not fit in the memory budget "
+                f"of {self.budget_mb:.0f}MB with {MIN_CONTRACTS} ETFs or more"
+            )
+        ADMISSIONS_TOTAL.inc(decision="downsized")
+        return max_contracts
+
+    def admit(self, footprint_mb: float) -> Reservation:
+        """Reserve footprint_mb, or queue it until it fits
+
+        Raises AdmissionError if footprint_mb is larger than the budget or the
+        queue is full. The reservation is granted right away if nothing is
+        waiting before it, else wait() waits for it.
+        """
+        if footprint_mb > self.budget_mb:
+            ADMISSIONS_TOTAL.inc(decision="rejected")
+            raise AdmissionError(
+                f"The task needs about {footprint_mb:.0f}MB, more than the "
+                f"memory budget of {self.budget_mb:.0f}MB"
+            )
+        reservation = Reservation(footprint_mb)
+        with self.condition:
+            if (not self.queue) and self.fits(reservation):
+                self.grant(reservation)
+                ADMISSIONS_TOTAL.inc(decision="admitted")
+                return reservation
+            if len(self.queue) >= self.max_queued:
+                ADMISSIONS_TOTAL.inc(decision="rejected")
+                raise AdmissionError(
+                    f"The server is busy with {len(self.queue)} tasks waiting "
+                    "for memory, please try again later"
+                )
+            self.queue.append(reservation)
+            QUEUED_TASKS.set(len(self.queue))
+            ADMISSIONS_TOTAL.inc(decision="queued")
+            return reservation
+
+    def wait(self, reservation: Reservation, cancel_token: CancelToken) -> None:
+        # wait until the reservation is at the head of the queue and fits,
+        # raises TaskCancelledError if the task is cancelled meanwhile
+        with self.condition:
+            try:
+                while not reservation.granted:
+                    cancel_token.check()
+                    if (self.queue[0] is reservation) and self.fits(reservation):
+                        self.queue.popleft()
+                        self.grant(reservation)
+                        self.condition.notify_all()
+                    else:
+                        self.condition.wait(timeout=1)
+            finally:
+                if not reservation.granted:
+                    self.queue.remove(reservation)
+                    self.condition.notify_all()
+                QUEUED_TASKS.set(len(self.queue))
+
+    def release(self, reservation: Reservation) -> None:
+        with self.condition:
+            if reservation.granted:
+                reservation.granted = False
+                self.reserved_mb -= reservation.footprint_mb
+                RESERVED_BYTES.set(self.reserved_mb * MB)
+                self.condition.notify_all()
+
+    def retain(self, task_id: str, size_mb: float) -> None:
+        # more memory kept for a finished task, e.g. its rendered page
+        with self.condition:
+            self.retained[task_id] = self.retained.get(task_id, 0.0) + size_mb
+            self.retained_mb += size_mb
+            RETAINED_BYTES.set(self.retained_mb * MB)
+
+    def forget(self, task_id: str) -> None:
+        # the result of the task was evicted
+        with self.condition:
+            if task_id in self.retained:
+                self.retained_mb -= self.retained.pop(task_id)
+                RETAINED_BYTES.set(self.retained_mb * MB)
+                self.condition.notify_all()
+
+    def is_over_retained(self) -> bool:
+        return self.retained_mb > MAX_RETAINED_RATIO * self.budget_mb
+
+
+MEMORY_SAMPLER = MemorySampler()
+MEMORY_BUDGET = MemoryBudget()
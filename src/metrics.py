@@ -0,0 +1,215 @@
+"""
+Prometheus metrics of the optimizer tasks
+
+Minimal counters, gauges and histograms rendered in the Prometheus text
+exposition format at /metrics, and TaskTimings, which times the stages of
+one task for both the metrics and the task record.
+
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+# seconds, from a cached lookup to a full download of the universe
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+REGISTRY: List["Metric"] = []
+
+
+class Metric(object):
+    type_name = ""
+
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def get_key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        assert set(labels) == set(self.label_names), labels
+        return tuple(str(labels[x]) for x in self.label_names)
+
+    def format_labels(
+        self, key: Tuple[str, ...], extra: Optional[Dict[str, str]] = None
+    ) -> str:
+        pairs = list(zip(self.label_names, key)) + list((extra or {}).items())
+        if not pairs:
+            return ""
+        escaped = [
+            (k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for k, v in pairs
+        ]
+        return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+    def get_samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help_text}"]
+        lines.append(f"# TYPE {self.name} {self.type_name}")
+        with self.lock:
+            lines.extend(self.get_samples())
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = ()):
+        super().__init__(name, help_text, label_names)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        assert amount >= 0, amount
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def get_samples(self) -> List[str]:
+        return [
+            f"{self.name}{self.format_labels(key)} {value:g}"
+            for key, value in sorted(self.values.items())
+        ]
+
+
+class Gauge(Counter):
+    type_name = "gauge"
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = STAGE_BUCKETS,
+    ):
+        super().__init__(name, help_text, label_names)
+        self.buckets = sorted(buckets)
+        # non-cumulative count of every bucket and of +Inf, and the sum
+        self.counts: Dict[Tuple[str, ...], List[int]] = {}
+        self.sums: Dict[Tuple[str, ...], float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self.get_key(labels)
+        with self.lock:
+            if key not in self.counts:
+                self.counts[key] = [0] * (len(self.buckets) + 1)
+                self.sums[key] = 0.0
+            self.counts[key][bisect.bisect_left(self.buckets, value)] += 1
+            self.sums[key] += value
+
+    def get_samples(self) -> List[str]:
+        lines = []
+        for key, counts in sorted(self.counts.items()):
+            total = 0
+            for bound, count in zip(self.buckets + [float("inf")], counts):
+                total += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                labels = self.format_labels(key, {"le": le})
+                lines.append(f"{self.name}_bucket{labels} {total}")
+            lines.append(f"{self.name}_sum{self.format_labels(key)} {self.sums[key]:g}")
+            lines.append(f"{self.name}_count{self.format_labels(key)} {total}")
+        return lines
+
+
+def render_metrics() -> str:
+    return "".join(metric.render() for metric in REGISTRY)
+
+
+STAGE_SECONDS = Histogram(
+    "etf_optimizer_stage_seconds",
+    "Time spent in a stage, excluding the stages nested in it",
+    ["stage"],
+)
+STAGES_IN_PROGRESS = Gauge(
+    "etf_optimizer_stages_in_progress", "Stages that are running", ["stage"]
+)
+STAGE_EXCEPTIONS = Counter(
+    "etf_optimizer_stage_exceptions_total",
+    "Stages that ended with an exception, including cancellations",
+    ["stage"],
+)
+TASKS_IN_PROGRESS = Gauge(
+    "etf_optimizer_tasks_in_progress", "Optimizer and backtest tasks that are running"
+)
+TASKS_TOTAL = Counter(
+    "etf_optimizer_tasks_total", "Finished tasks by outcome", ["outcome"]
+)
+
+
+class TaskTimings(object):
+    """Time spent in every stage of a task
+
+    Stages can be nested, e.g. the downloads within the screening, and the
+    time of a nested stage is not counted in the stage around it, so the
+    times of a task add up to its duration. Every stage is also observed in
+    STAGE_SECONDS when it ends.
+    """
+
+    def __init__(self):
+        self.seconds: Dict[str, float] = {}
+        self.lock = threading.Lock()
+        # stages running in every thread as [start time, elapsed time]
+        self.local = threading.local()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        stack = self.local.stack
+        now = time.monotonic()
+        if stack:
+            # pause the stage around this one
+            stack[-1][1] += now - stack[-1][0]
+        entry: List[float] = [now, 0.0]
+        stack.append(entry)
+        STAGES_IN_PROGRESS.inc(stage=name)
+        try:
+            yield
+        except BaseException:
+            STAGE_EXCEPTIONS.inc(stage=name)
+            raise
+        finally:
+            now = time.monotonic()
+            stack.pop()
+            elapsed = entry[1] + now - entry[0]
+            if stack:
+                stack[-1][0] = now
+            STAGES_IN_PROGRESS.dec(stage=name)
+            STAGE_SECONDS.observe(elapsed, stage=name)
+            with self.lock:
+                self.seconds[name] = self.seconds.get(name, 0.0) + elapsed
+
+    def to_dict(self) -> Dict[str, float]:
+        with self.lock:
+            return dict(self.seconds)
+
+    def __str__(self) -> str:
+        return ", ".join(f"{k}: {v:.2f}s" for k, v in self.to_dict().items())
+
+
+STARTUP_SECONDS = Gauge(
+    "etf_optimizer_startup_seconds",
+    "Seconds from the start of the server to each startup event",
+    ["event"],
+)
@@ -0,0 +1,201 @@
+"""
+Moments of return panels with missing values
+
+The mean and covariance match pandas' `DataFrame.mean()` and
+`DataFrame.cov()`, i.e. every pair of columns uses the rows where both are
+present. They are computed from sufficient statistics that are sums over
+rows, so rows can be added to and removed from a window with rank-k updates.
+A pairwise-complete covariance need not be positive semi-definite, so it can
+be shrunk and repaired before it is handed to the solver, or approximated by
+a low-rank factor model for large universes.
+
+"""
+
+from typing import Optional, Tuple
+
+import numpy as np
+import scipy.sparse.linalg as sla
+
+
+class RollingMoments(object):
+    def __init__(self, num_assets: int, shift: Optional[np.ndarray] = None):
+        # returns are shifted by a constant (e.g. a rough mean) before being
+        # accumulated to avoid cancellation in the raw second moments
+        self.shift = np.zeros(num_assets) if shift is None else np.asarray(shift)
+        self.shift = np.where(np.isfinite(self.shift), self.shift, 0.0)
+        # counts, sums, sums of squares and cross products over rows where
+        # both assets exist
+        self.n = np.zeros((num_assets, num_assets))
+        self.sx = np.zeros((num_assets, num_assets))
+        self.sxx = np.zeros((num_assets, num_assets))
+        self.sxy = np.zeros((num_assets, num_assets))
+
+    def _update(self, rows: np.ndarray, sign: float) -> None:
+        rows = np.atleast_2d(rows) - self.shift
+        mask = np.isfinite(rows).astype(float)
+        x = np.where(mask > 0, rows, 0.0)
+        self.n += sign * (mask.T @ mask)
+        self.sx += sign * (x.T @ mask)
+        self.sxx += sign * ((x * x).T @ mask)
+        self.sxy += sign * (x.T @ x)
+
+    def add(self, rows: np.ndarray) -> None:
+        self._update(rows, 1.0)
+
+    def remove(self, rows: np.ndarray) -> None:
+        self._update(rows, -1.0)
+
+    def count(self) -> np.ndarray:
+        return np.diag(self.n).round()
+
+    def mean(self) -> np.ndarray:
+        n = self.count()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(n > 0, np.diag(self.sx) / n, np.nan) + self.shift
+
+    def cov(self) -> np.ndarray:
+        n = self.n.round()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            cov = (self.sxy - self.sx * self.sx.T / n) / (n - 1)
+        return np.where(n > 1, cov, np.nan)
+
+    def corr(self) -> np.ndarray:
+        # the variances are also computed over the rows where both exist
+        n = self.n.round()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            cov = self.sxy - self.sx * self.sx.T / n
+            var = self.sxx - self.sx * self.sx / n
+            corr = cov / np.sqrt(var * var.T)
+        return np.where(n > 1, np.clip(corr, -1.0, 1.0), np.nan)
+
+
+def pairwise_moments(returns: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Mean and pairwise-complete covariance of a panel with missing values
+
+    Same as `DataFrame.mean()` and `DataFrame.cov()`, with a few matrix
+    products over the NaN mask instead of a loop over pairs.
+    """
+    moments = RollingMoments(returns.shape[1], shift=np.nanmean(returns, axis=0))
+    moments.add(returns)
+    return moments.mean(), moments.cov()
+
+
+def ledoit_wolf_shrinkage(
+    returns: np.ndarray, cov: np.ndarray
+) -> Tuple[np.ndarray, float]:
+    """Shrink the off-diagonal covariances towards zero
+
+    The intensity is the Ledoit-Wolf estimate for a diagonal target, i.e. the
+    sum of the estimated variances of the sample covariances divided by the
+    sum of their squares, computed over the rows where both assets exist.
+
+    Returns
+    -------
+        (cov, intensity)
+        cov: (1 - intensity) * cov + intensity * diag(cov)
+        intensity: shrinkage intensity in [0, 1]
+    """
+    mask = np.isfinite(returns).astype(float)
+    x = np.where(mask > 0, returns - np.nanmean(returns, axis=0), 0.0)
+    n = (mask.T @ mask).round()
+    # sum over rows of (x_i x_j - cov_ij)^2, where both exist
+    sum_xy = x.T @ x
+    sum_xy2 = (x * x).T @ (x * x)
+    cov = np.nan_to_num(cov)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        pi = (sum_xy2 - 2 * cov * sum_xy + n * cov * cov) / n
+        var_cov = np.where(n > 1, pi / n, 0.0)
+    off_diagonal = ~np.eye(len(cov), dtype=bool)
+    scale = (cov[off_diagonal] ** 2).sum()
+    intensity = var_cov[off_diagonal].sum() / scale if scale > 0 else 1.0
+    intensity = float(np.clip(intensity, 0.0, 1.0))
+    shrunk = (1 - intensity) * cov + intensity * np.diag(np.diag(cov))
+    return shrunk, intensity
+
+
+def nearest_psd(cov: np.ndarray, min_eigenvalue: float = 0.0) -> np.ndarray:
+    """Clip the eigenvalues of a symmetric matrix and keep its diagonal
+
+    A pairwise-complete covariance need not be positive semi-definite. The
+    negative eigenvalues are raised to min_eigenvalue and the result is
+    rescaled to the original variances, which keeps it PSD.
+    """
+    cov = (cov + cov.T) / 2
+    eigenvalues, eigenvectors = np.linalg.eigh(cov)
+    if eigenvalues[0] >= min_eigenvalue:
+        return cov
+    eigenvalues = np.maximum(eigenvalues, min_eigenvalue)
+    psd = (eigenvectors * eigenvalues) @ eigenvectors.T
+    with np.errstate(invalid="ignore", divide="ignore"):
+        scale = np.sqrt(np.diag(cov) / np.diag(psd))
+    scale = np.where(np.isfinite(scale), scale, 1.0)
+    return psd * np.outer(scale, scale)
+
+
+class FactorCovariance(object):
+    """Covariance of the form B F B^T + diag(D), never materialized
+
+    B (N x k) are the loadings of the assets on k factors, F (k x k) the
+    covariance of the factors and D (N) the specific variances, so products
+    with a vector and the diagonal take O(Nk). Supports `cov @ w`,
+    `cov[i, j]` and `cov.diagonal()` like a dense covariance matrix.
+    """
+
+    def __init__(
+        self, loadings: np.ndarray, factor_cov: np.ndarray, specific_var: np.ndarray
+    ):
+        self.loadings = loadings
+        self.factor_cov = factor_cov
+        self.specific_var = specific_var
+        self.shape = (len(specific_var), len(specific_var))
+
+    def __matmul__(self, w: np.ndarray) -> np.ndarray:
+        specific = (self.specific_var * w.T).T
+        return self.loadings @ (self.factor_cov @ (self.loadings.T @ w)) + specific
+
+    def __getitem__(self, key: Tuple[int, int]) -> float:
+        i, j = key
+        value = self.loadings[i] @ self.factor_cov @ self.loadings[j]
+        return value + self.specific_var[i] if i == j else value
+
+    def diagonal(self) -> np.ndarray:
+        factor_var = np.einsum(
+            "ik,kl,il->i", self.loadings, self.factor_cov, self.loadings
+        )
+        return factor_var + self.specific_var
+
+    def subset(self, idx: np.ndarray) -> "FactorCovariance":
+        return FactorCovariance(
+            self.loadings[idx], self.factor_cov, self.specific_var[idx]
+        )
+
+    def to_dense(self) -> np.ndarray:
+        return self.loadings @ self.factor_cov @ self.loadings.T + np.diag(
+            self.specific_var
+        )
+
+    @classmethod
+    def from_returns(
+        cls, returns: np.ndarray, num_factors: int, min_specific: float = 0.01
+    ) -> "FactorCovariance":
+        """PCA of the returns, with missing values treated as the mean
+
+        The specific variances make up the difference to the variance of each
+        asset, and are at least min_specific times the variance so that the
+        covariance is positive definite.
+        """
+        num_obs, num_assets = returns.shape
+        num_factors = min(num_factors, num_obs - 1, num_assets - 1)
+        var = np.nanvar(returns, axis=0, ddof=1)
+        if num_factors < 1:
+            # e.g. a single asset, all of its variance is specific
+            return cls(np.zeros((num_assets, 0)), np.eye(0), var)
+        mask = np.isfinite(returns)
+        x = np.where(mask, returns - np.nanmean(returns, axis=0), 0.0)
+        # truncated SVD with a fixed starting vector to be reproducible
+        _, s, vt = sla.svds(x, k=num_factors, v0=np.ones(min(x.shape)))
+        loadings = vt.T * (s / np.sqrt(num_obs - 1))
+        factor_cov = np.eye(num_factors)
+        factor_var = (loadings**2).sum(axis=1)
+        specific_var = np.maximum(var - factor_var, min_specific * var)
+        return cls(loadings, factor_cov, specific_var)
@@ -0,0 +1,17 @@
+"""
+Build the caches that are too slow to build on server startup
+
+Meant to be run once a day, e.g. from cron: cd src && python nightly.py
+"""
+
+import logging
+
+import yfinance as yf
+
+from cache.utils import populate_nightly_caches
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    logger = yf.utils.get_yf_logger()
+    logger.setLevel(logging.INFO)
+    populate_nightly_caches(logger)
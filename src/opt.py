@@ -8,19 +8,30 @@ src: https://github.com/MarekOzana/streamlit_markowitz/blob/main/src/optimizatio
 
 """
 
+import time
 import traceback
 import typing
+from typing import Callable, Optional, Union
 
 import numpy as np
 import scipy.optimize as sco
 
+from moments import FactorCovariance
+from solver_telemetry import SolverTelemetry
+
+# a dense matrix or a factor model, anything with `cov @ w`
+Covariance = Union[np.ndarray, FactorCovariance]
+
 
 @typing.no_type_check
 def find_min_var_portfolio(
     exp_rets: np.ndarray,
-    cov: np.ndarray,
+    cov: Covariance,
     r_min: float = 0,
     w_max: float = 1,
+    w0: Optional[np.ndarray] = None,
+    telemetry: Optional[SolverTelemetry] = None,
+    logger=None,
 ):
     """Find portfolio with minimum variance given constraint return
     Solve the following optimization problem
@@ -31,9 +42,14 @@ def find_min_var_portfolio(
     Parameters
     ==========
         exp_rets: annualized expected returns
-        cov: covariance matrix
+        cov: covariance matrix, or a FactorCovariance to evaluate the
+            objective and its gradient in O(Nk)
         r_min: minimum portfolio return (constraint)
         w_max: maximum individual weight (constraint)
+        w0: initial guess for the weights, e.g. a previous optimum
+        telemetry: records the iterations, wall time and constraint
+            violation of the solve, and saves its inputs if it is slow
+        logger: warns about slow or failed solves when telemetry is given
     Returns
     =======
         (w, r_opt, vol_opt)
@@ -44,25 +60,41 @@ def find_min_var_portfolio(
 
     def calc_var(w, cov) -> np.float64:
         """Calculate portfolio Variance"""
-        variance = np.dot(w.T, np.dot(cov, w))
+        variance = np.dot(w.T, cov @ w)
         assert variance > -1e-9
         return max(variance, 0.0)
 
+    def calc_var_grad(w, cov) -> np.ndarray:
+        """Gradient of the portfolio Variance"""
+        return 2 * (cov @ w)
+
     n_assets = len(exp_rets)
     constraints = [
         # sum(w_i) = 1
-        {"type": "eq", "fun": lambda x: np.sum(x) - 1},
+        {
+            "type": "eq",
+            "fun": lambda x: np.sum(x) - 1,
+            "jac": lambda x: np.ones(n_assets),
+        },
         # sum(r_i * w_i >= r_min)
-        {"type": "ineq", "fun": lambda x: np.dot(x.T, exp_rets) - r_min},
+        {
+            "type": "ineq",
+            "fun": lambda x: np.dot(x.T, exp_rets) - r_min,
+            "jac": lambda x: exp_rets,
+        },
     ]
     bounds = tuple((0, w_max) for asset in range(n_assets))  # sequence of (min,max)
 
-    pos_rets = [np.sqrt(max(ret, 0.0)) for ret in exp_rets]
+    if w0 is None:
+        pos_rets = [np.sqrt(max(ret, 0.0)) for ret in exp_rets]
+        w0 = [x / sum(pos_rets) for x in pos_rets]
+    start_time = time.perf_counter()
     opts = sco.minimize(
         # Objective Function
         fun=calc_var,
+        jac=calc_var_grad,
         # Initial guess
-        x0=[x / sum(pos_rets) for x in pos_rets],
+        x0=w0,
         # Extra Arguments to objective function
         args=(cov,),
         method="SLSQP",
@@ -71,14 +103,174 @@ def find_min_var_portfolio(
         constraints=constraints,
         tol=1e-6,
     )
+    if telemetry is not None:
+        telemetry.record(
+            opts,
+            time.perf_counter() - start_time,
+            exp_rets,
+            cov,
+            r_min,
+            w_max,
+            w0,
+            logger=logger,
+        )
     w = opts["x"]
     r_opt = np.dot(w, exp_rets)
     vol_opt = np.sqrt(calc_var(w, cov))
     return w, r_opt, vol_opt
 
 
+def subset_cov(cov: Covariance, idx: np.ndarray) -> Covariance:
+    """Covariance of the assets in idx"""
+    if isinstance(cov, FactorCovariance):
+        return cov.subset(idx)
+    return cov[np.ix_(idx, idx)]
+
+
+def screen_dominated_assets(exp_rets: np.ndarray, cov: Covariance) -> np.ndarray:
+    """Find the assets that are not dominated by another asset
+
+    An asset is dominated if another one has at least the same return and at
+    most the same volatility, and is better in one of them. A dominated asset
+    can still enter the optimum through its correlations, so this is only a
+    starting point for find_min_var_portfolio_screened.
+
+    Returns
+    =======
+        mask: True for the assets that are not dominated
+    """
+    vol = np.sqrt(cov.diagonal())
+    ret_ge = exp_rets[None, :] >= exp_rets[:, None]
+    vol_le = vol[None, :] <= vol[:, None]
+    better = (exp_rets[None, :] > exp_rets[:, None]) | (vol[None, :] < vol[:, None])
+    return ~(ret_ge & vol_le & better).any(axis=1)
+
+
+def find_kkt_violations(
+    exp_rets: np.ndarray,
+    cov: Covariance,
+    w: np.ndarray,
+    r_min: float,
+    w_max: float = 1,
+    tol: float = 1e-4,
+) -> np.ndarray:
+    """Find the assets at zero weight that would lower the variance
+
+    At the optimum of find_min_var_portfolio, 2 * COV * w = lam + gam * r_ann
+    for the assets strictly between the bounds and is at least that for the
+    assets at zero weight, with gam >= 0 only if the return constraint is
+    active. The multipliers are estimated from the assets between the bounds
+    by least squares.
+
+    Returns
+    =======
+        mask: True for the assets at zero weight that violate the conditions
+    """
+    grad = 2 * (cov @ w)
+    free = (w > 1e-6) & (w < w_max - 1e-6)
+    if not free.any():
+        free = w > 1e-6
+    ret_active = np.dot(w, exp_rets) <= r_min + 1e-6
+    if ret_active and free.sum() >= 2:
+        a = np.column_stack([np.ones(free.sum()), exp_rets[free]])
+        (lam, gam), *_ = np.linalg.lstsq(a, grad[free], rcond=None)
+        if gam < 0:
+            lam, gam = grad[free].mean(), 0.0
+    elif ret_active:
+        # one asset between the bounds, e.g. the highest return at r_min near
+        # it, does not determine gam: take the smallest gam for which the
+        # assets with lower returns do not lower the variance at that return
+        f = np.flatnonzero(free)[0]
+        lower = exp_rets < exp_rets[f]
+        gam = 0.0
+        if lower.any():
+            gam = max(
+                0.0,
+                np.max((grad[f] - grad[lower]) / (exp_rets[f] - exp_rets[lower])),
+            )
+        lam = grad[f] - gam * exp_rets[f]
+    else:
+        lam, gam = grad[free].mean(), 0.0
+    reduced_cost = grad - lam - gam * exp_rets
+    # relative to the marginal variance, not to the residual of the solve,
+    # which would hide violations as large as its own inaccuracy
+    tol = tol * np.abs(grad[free]).max()
+    return (w <= 1e-6) & (reduced_cost < -tol)
+
+
+def find_min_var_portfolio_screened(
+    exp_rets: np.ndarray,
+    cov: Covariance,
+    r_min: float = 0,
+    w_max: float = 1,
+    w0: Optional[np.ndarray] = None,
+    active: Optional[np.ndarray] = None,
+    max_rounds: int = 20,
+    telemetry: Optional[SolverTelemetry] = None,
+    logger=None,
+):
+    """Solve find_min_var_portfolio over an active set of assets
+
+    The problem is solved over the assets in active (by default the assets
+    that are not dominated), and the assets that violate the optimality
+    conditions of the full problem are added back until there are none, so
+    the cost of a solve depends on the number of assets in the optimum.
+
+    Parameters
+    ==========
+        active: initial set of assets as a boolean mask, e.g. the support of
+            the previous point on the frontier
+        max_rounds: maximum number of times assets are added back
+        (other parameters as in find_min_var_portfolio)
+    Returns
+    =======
+        (w, r_opt, vol_opt, active)
+        w, r_opt, vol_opt: as returned by find_min_var_portfolio
+        active: the final active set
+    """
+    n_assets = len(exp_rets)
+    if active is None:
+        active = screen_dominated_assets(exp_rets, cov)
+    active = active.copy()
+    # the problem stays feasible as long as the highest return is included
+    active[np.argmax(exp_rets)] = True
+    for _ in range(max_rounds):
+        idx = np.flatnonzero(active)
+        sub_w0 = None
+        if (w0 is not None) and (w0[idx].sum() > 1e-6):
+            sub_w0 = w0[idx] / w0[idx].sum()
+        sub_w, r_opt, vol_opt = find_min_var_portfolio(
+            exp_rets[idx],
+            subset_cov(cov, idx),
+            r_min=r_min,
+            w_max=w_max,
+            w0=sub_w0,
+            telemetry=telemetry,
+            logger=logger,
+        )
+        w = np.zeros(n_assets)
+        w[idx] = sub_w
+        # the violations within the active set are the inaccuracy of the
+        # solve, solving again over the same assets would not remove them
+        violations = find_kkt_violations(exp_rets, cov, w, r_min, w_max) & ~active
+        if not violations.any():
+            break
+        active |= violations
+        w0 = w
+    return w, r_opt, vol_opt, active
+
+
 def calc_eff_front(
-    exp_rets: np.ndarray, cov: np.ndarray, logger, min_ret: float, max_ret: float
+    exp_rets: np.ndarray,
+    cov: Covariance,
+    logger,
+    min_ret: float,
+    max_ret: float,
+    w0: Optional[np.ndarray] = None,
+    screen: bool = True,
+    should_stop: Optional[Callable[[], bool]] = None,
+    telemetry: Optional[SolverTelemetry] = None,
+    prev_frontier: Optional[dict[str, list]] = None,
 ) -> dict[str, list]:
     """Calculate effective frontier
 
@@ -88,25 +280,155 @@ def calc_eff_front(
     ----------
         exp_rets: annualized expected returns
         cov: covariance matrix
+        w0: initial guess for the weights of every point
+        screen: solve over an active set of assets, starting from the assets
+            that are not dominated and the support of the previous point
+        should_stop: called before every point, the frontier found so far is
+            returned if it returns True once there is a point; it may also
+            raise to abort, e.g. when the task is cancelled
+        telemetry: records every solve, see find_min_var_portfolio
+        prev_frontier: frontier of a previous solve with weights over the
+            same assets, e.g. of the day before; every point starts from the
+            point of prev_frontier with the closest return and its support,
+            instead of from w0
 
     Returns
     -------
-        frnt: dict("ret":list(float), "vol":list(float))
+        frnt: dict("ret":list(float), "vol":list(float), "weights":list)
         Dictionary with points on the efficient frontier
     """
     N_STEPS: int = 25
-    frnt: dict[str, list] = {"rets": list(), "vols": list(), "sharpe": list()}
+    frnt: dict[str, list] = {
+        "rets": list(),
+        "vols": list(),
+        "sharpe": list(),
+        "weights": list(),
+    }
+    screened = screen_dominated_assets(exp_rets, cov) if screen else None
+    active = screened
     for r_min in np.linspace(min_ret, max_ret, N_STEPS):
+        if (should_stop is not None) and should_stop() and frnt["rets"]:
+            logger.info(f"Stopped the frontier at r_min: {r_min:.3f}%")
+            break
+        num_solves = len(telemetry.records) if telemetry is not None else 0
+        point_w0 = w0
+        point_active = active
+        if (prev_frontier is not None) and prev_frontier["rets"]:
+            closest = np.argmin(np.abs(np.array(prev_frontier["rets"]) - r_min))
+            prev_w = prev_frontier["weights"][closest]
+            point_w0 = prev_w
+            if active is not None:
+                point_active = active | (prev_w > 1e-6)
         try:
-            _, ret, vol = find_min_var_portfolio(
-                exp_rets=exp_rets, cov=cov, r_min=r_min
-            )
+            if screen:
+                w, ret, vol, solved = find_min_var_portfolio_screened(
+                    exp_rets=exp_rets,
+                    cov=cov,
+                    r_min=r_min,
+                    w0=point_w0,
+                    active=point_active,
+                    telemetry=telemetry,
+                    logger=logger,
+                )
+                logger.info(f"r_min: {r_min:.3f}%, active assets: {solved.sum()}")
+                active = screened | (w > 1e-6)
+            else:
+                w, ret, vol = find_min_var_portfolio(
+                    exp_rets=exp_rets,
+                    cov=cov,
+                    r_min=r_min,
+                    w0=point_w0,
+                    telemetry=telemetry,
+                    logger=logger,
+                )
+            if telemetry is not None:
+                point = telemetry.records[num_solves:]
+                logger.info(
+                    f"r_min: {r_min:.3f}%, solves: {len(point)}, "
+                    f"nit: {sum(x.nit for x in point)}, "
+                    f"nfev: {sum(x.nfev for x in point)}, "
+                    f"time: {sum(x.seconds for x in point):.3f}s"
+                )
             if ret >= r_min:
                 logger.info(f"r_min: {r_min:.3f}%, ret: {ret:.3f}%, vol: {vol:.2f}%")
                 frnt["vols"].append(vol)
                 frnt["rets"].append(ret)
                 frnt["sharpe"].append(ret / vol)
+                frnt["weights"].append(w)
         except Exception as e:  # pylint: disable=broad-except
             logger.error(f"Error in optimization for r_min: {r_min:.3f}%: {e}")
             logger.error(traceback.format_exc())
     return frnt
+
+
+def find_max_sharpe_portfolio(
+    exp_rets: np.ndarray,
+    cov: Covariance,
+    logger,
+    risk_free_rate: float,
+    w0: Optional[np.ndarray] = None,
+    screen: bool = True,
+    should_stop: Optional[Callable[[], bool]] = None,
+    telemetry: Optional[SolverTelemetry] = None,
+    prev_frontier: Optional[dict[str, list]] = None,
+):
+    """Find the portfolio on the efficient frontier with the highest sharpe ratio
+
+    Parameters
+    ----------
+        exp_rets: expected returns
+        cov: covariance matrix
+        risk_free_rate: return of the risk-free asset, also the lowest
+            return on the frontier
+        w0: initial guess for the weights, e.g. a previous optimum
+        screen: as in calc_eff_front
+        should_stop: as in calc_eff_front, the best point of the frontier
+            is returned as is if it returns True
+        telemetry: as in calc_eff_front
+        prev_frontier: as in calc_eff_front
+
+    Returns
+    -------
+        (w, r_opt, vol_opt, frnt)
+        w, r_opt, vol_opt: as returned by find_min_var_portfolio
+        frnt: the efficient frontier as returned by calc_eff_front
+    """
+    frnt = calc_eff_front(
+        exp_rets,
+        cov,
+        logger,
+        risk_free_rate,
+        exp_rets.max(),
+        w0=w0,
+        screen=screen,
+        should_stop=should_stop,
+        telemetry=telemetry,
+        prev_frontier=prev_frontier,
+    )
+    best_output = sorted(
+        zip(frnt["rets"], frnt["vols"], frnt["weights"]),
+        key=lambda x: (x[0] - risk_free_rate) / x[1],
+        reverse=True,
+    )[0]
+    if (should_stop is not None) and should_stop():
+        r_opt, vol_opt, w = best_output
+        logger.info("Using the best point of the frontier found so far")
+    elif screen:
+        w, r_opt, vol_opt, _ = find_min_var_portfolio_screened(
+            exp_rets,
+            cov,
+            r_min=best_output[0] * 0.99,
+            w0=w0,
+            telemetry=telemetry,
+            logger=logger,
+        )
+    else:
+        w, r_opt, vol_opt = find_min_var_portfolio(
+            exp_rets,
+            cov,
+            r_min=best_output[0] * 0.99,
+            w0=w0,
+            telemetry=telemetry,
+            logger=logger,
+        )
+    return w, r_opt, vol_opt, frnt
@@ -1,11 +1,17 @@
 import dataclasses
 import html
-from typing import Dict, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 import numpy as np
 import pandas as pd
 
+from hrp import get_quasi_diag_order
+from moments import FactorCovariance
+from opt import Covariance, subset_cov
+
 EPS = 1e-6
+# larger portfolios only show the correlations of their largest components
+MAX_CORR_COMPONENTS = 30
 
 
 @dataclasses.dataclass
@@ -20,11 +26,14 @@ class Portfolio(object):
         self,
         weight_map: Dict,
         exp_ret: Optional[np.ndarray] = None,
-        cov: Optional[np.ndarray] = None,
+        cov: Optional[Covariance] = None,
         risk_free_asset: Optional[Asset] = None,
         num_days_per_year: float = 250.0,
         min_weight: float = 0.001,
+        frontier: Optional[Dict[str, list]] = None,
     ):
+        # frontier is the efficient frontier the weights were picked from, as
+        # returned by calc_eff_front
         assert abs(sum(weight_map.values()) - 1.0) < EPS
         self.weight_map = weight_map
         self.exp_ret = exp_ret
@@ -32,6 +41,7 @@ class Portfolio(object):
         self.risk_free_asset = risk_free_asset
         self.num_days_per_year = num_days_per_year
         self.min_weight = min_weight
+        self.frontier = frontier
 
     @classmethod
     def from_string(cls, s: str) -> Tuple["Portfolio", str]:
@@ -60,29 +70,115 @@ class Portfolio(object):
             [f"{k}:{v}" for k, v in self.weight_map.items() if v > self.min_weight]
         )
 
-    def get_corr_html(self) -> str:
-        html_text = ""
-        if self.cov is not None:
-            html_text += "<h2>Correlation of Portfolio Components</h2>\n"
-            html_text += "<table class='table-metrics'><tr><th></th>\n"
-            for etf, weight in self.weight_map.items():
-                if weight > self.min_weight:
-                    html_text += f"<th>{etf}</th>\n"
-            html_text += "</tr>"
-            for idx, (etf1, w1) in enumerate(self.weight_map.items()):
-                if w1 >= self.min_weight:
-                    html_text += f"<tr><th>{etf1}</th>\n"
-                    for idy, (_, w2) in enumerate(self.weight_map.items()):
-                        if w2 >= self.min_weight:
-                            sigma = self.cov[idx, idy] / np.sqrt(
-                                self.cov[idx, idx] * self.cov[idy, idy],
-                            )
-                            html_text += f"<td>{sigma:.2f}</td>\n"
-                    html_text += "</tr>\n"
-            html_text += "</table>\n"
+    def get_metrics(self) -> Dict[str, float]:
+        assert self.exp_ret is not None and self.cov is not None
+        w = np.array(list(self.weight_map.values()))
+        portfolio_return = np.dot(w, self.exp_ret) * self.num_days_per_year
+        portfolio_variance = np.dot(w.T, self.cov @ w) * self.num_days_per_year
+        metrics = {
+            "return": portfolio_return,
+            "variance": portfolio_variance,
+            "volatility": np.sqrt(portfolio_variance),
+        }
+        if self.risk_free_asset is not None:
+            metrics["sharpe"] = (
+                portfolio_return - self.risk_free_asset.exp_ret
+            ) / metrics["volatility"]
+        return metrics
+
+    def get_component_map(self, w: np.ndarray) -> Dict[str, float]:
+        return {
+            etf: float(weight)
+            for etf, weight in zip(self.weight_map, w)
+            if weight > self.min_weight
+        }
+
+    def get_component_cov(self, idx: np.ndarray) -> np.ndarray:
+        assert self.cov is not None
+        cov = subset_cov(self.cov, idx)
+        if isinstance(cov, FactorCovariance):
+            return cov.to_dense()
+        return cov
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Structured version of to_html, which is rendered from it
+
+        Returns, volatilities and covariances are annualized and in percent,
+        as in to_html. The expected returns, the covariance matrix and the
+        contributions of the components to the variance of the portfolio are
+        only given for the components, in the order of "symbols".
+        """
+        w = np.array(list(self.weight_map.values()))
+        data: Dict[str, Any] = {
+            "type": "portfolio",
+            "weights": self.get_component_map(w),
+            "min_weight": self.min_weight,
+            "num_days_per_year": self.num_days_per_year,
+        }
+        if (self.exp_ret is not None) and (self.cov is not None):
+            idx = np.flatnonzero(w > self.min_weight)
+            cov = self.get_component_cov(idx)
+            contributions = w * (self.cov @ w) * self.num_days_per_year
+            data["symbols"] = [list(self.weight_map)[i] for i in idx]
+            data["exp_ret"] = (self.exp_ret[idx] * self.num_days_per_year).tolist()
+            data["cov"] = (cov * self.num_days_per_year).tolist()
+            data["variance_contributions"] = contributions[idx].tolist()
+            data["metrics"] = {k: float(v) for k, v in self.get_metrics().items()}
+        if self.risk_free_asset is not None:
+            data["risk_free_asset"] = dataclasses.asdict(self.risk_free_asset)
+        if self.frontier is not None:
+            points: List[Dict[str, Any]] = []
+            for ret, vol, weights in zip(
+                self.frontier["rets"], self.frontier["vols"], self.frontier["weights"]
+            ):
+                points.append(
+                    {
+                        "return": ret * self.num_days_per_year,
+                        "volatility": vol * np.sqrt(self.num_days_per_year),
+                        "weights": self.get_component_map(weights),
+                    }
+                )
+            data["frontier"] = points
+        return data
+
+    @staticmethod
+    def get_corr_html(
+        symbols: List[str],
+        weights: np.ndarray,
+        cov: np.ndarray,
+        max_components: int = MAX_CORR_COMPONENTS,
+    ) -> str:
+        # with more than max_components components, only the largest ones are
+        # shown, ordered so that correlated components are next to each other
+        idx: np.ndarray = np.arange(len(symbols))
+        html_text = "<h2>Correlation of Portfolio Components</h2>\n"
+        if len(idx) > max_components:
+            idx = np.sort(np.argsort(-weights, kind="stable")[:max_components])
+            html_text += (
+                f"<p>Showing the {max_components} largest of {len(symbols)} "
+                "components, clustered by correlation</p>\n"
+            )
+            cov = cov[np.ix_(idx, idx)]
+            order = get_quasi_diag_order(cov)
+            idx, cov = idx[order], cov[np.ix_(order, order)]
+        std = np.sqrt(np.diag(cov))
+        corr = cov / np.outer(std, std)
+        names = [html.escape(symbols[i]) for i in idx]
+        cells = np.char.mod("<td>%.2f</td>", corr)
+        rows = [
+            f"<tr><th>{etf}</th>{''.join(row)}</tr>" for etf, row in zip(names, cells)
+        ]
+        html_text += "<table class='table-metrics'><tr><th></th>"
+        html_text += "".join(f"<th>{etf}</th>" for etf in names) + "</tr>\n"
+        html_text += "\n".join(rows) + "\n</table>\n"
         return html_text
 
-    def get_pnl_sharpe_html(self, portfolio_return, portfolio_variance) -> str:
+    @staticmethod
+    def get_pnl_sharpe_html(
+        metrics: Dict[str, float], risk_free_asset: Optional[Dict[str, Any]]
+    ) -> str:
+        portfolio_return = metrics["return"]
+        portfolio_variance = metrics["variance"]
         html_text = "<h2>Portfolio Metrics</h2>\n"
         html_text += "<table  class='table-metrics'>"
         html_text += f"<tr><td>Return</td><td>{portfolio_return:.2f}%</td></tr>\n"
@@ -91,77 +187,79 @@ class Portfolio(object):
         html_text += (
             f"<tr><td>Volatility</td><td>{portfolio_volatility:.2f}%</td></tr>\n"
         )
-        if self.risk_free_asset is not None:
+        if risk_free_asset is not None:
             sharpe_ratio = (
-                portfolio_return - self.risk_free_asset.exp_ret
+                portfolio_return - risk_free_asset["exp_ret"]
             ) / portfolio_volatility
             html_text += "<tr><td>Risk-free Asset</td>"
-            html_text += f"<td>{self.risk_free_asset.symbol}</td></tr>\n"
+            html_text += f"<td>{risk_free_asset['symbol']}</td></tr>\n"
             html_text += "<tr><td>Risk-free Rate</td>"
-            html_text += f"<td>{self.risk_free_asset.exp_ret:.2f}%</td></tr>\n"
+            html_text += f"<td>{risk_free_asset['exp_ret']:.2f}%</td></tr>\n"
             html_text += "<tr><td>Sharpe Ratio</td>"
             html_text += f"<td>{sharpe_ratio:.2f}</td></tr>\n"
         html_text += "</table>\n"
         return html_text
 
     def to_html(self) -> str:
+        return self.render_html(self.to_dict())
+
+    @staticmethod
+    def render_html(data: Dict[str, Any]) -> str:
+        # the web tasks only keep to_dict() of their portfolio, and render it
+        # when its page is first requested
         html_text = "<div class='output'>\n"
         html_text += "<h2>Portfolio Components</h2>\n"
         html_text += "<p>Components are sorted in order of traded volume</p>\n"
-        w = np.array(list(self.weight_map.values()))
-        portfolio_return = None
-        portfolio_variance = None
-        sum_weights: float = 0.0
-        if self.exp_ret is None or self.cov is None:
+        weight_map = data["weights"]
+        names = [html.escape(etf) for etf in weight_map]
+        w = np.array(list(weight_map.values()))
+        sum_weights = w.sum()
+        if "metrics" not in data:
             html_text += "<table class='table-metrics'>"
             html_text += "<tr><th>Component</th><th>Weight</th></tr>\n"
-            for etf, weight in self.weight_map.items():
-                if weight > self.min_weight:
-                    html_text += f"<tr><td>{etf}</td><td>{weight:.2%}</td></tr>\n"
-                    sum_weights += weight
-        else:
-            portfolio_return = np.dot(w, self.exp_ret) * self.num_days_per_year
-            portfolio_variance = (
-                np.dot(w.T, np.dot(self.cov, w)) * self.num_days_per_year
+            html_text += "".join(
+                f"<tr><td>{etf}</td><td>{weight:.2%}</td></tr>\n"
+                for etf, weight in zip(names, w)
             )
-            component_contributions = w * np.dot(self.cov, w) * self.num_days_per_year
+        else:
+            rets = np.array(data["exp_ret"])
+            sigmas = np.sqrt(np.diagonal(data["cov"]))
+            mcrs = w * rets
+            mcvs = np.array(data["variance_contributions"])
             html_text += "<table class='table-metrics'>"
             html_text += "<tr><th>Component</th><th>Weight</th>\n"
             html_text += "<th>Return</th><th>Volatility</th>"
             html_text += "<th>Contribution to Return</th>"
             html_text += "<th>Contribution to Variance</th>"
             html_text += "</tr>\n"
-            sum_mcr: float = 0.0
-            sum_mcv: float = 0.0
-            for idx, ((etf, weight), mcv) in enumerate(
-                zip(self.weight_map.items(), component_contributions)
-            ):
-                if weight > self.min_weight:
-                    html_text += f"<tr><td>{etf}</td><td>{weight:.2%}</td>\n"
-                    html_text += (
-                        f"<td>{self.exp_ret[idx] * self.num_days_per_year:.2f}%</td>\n"
-                    )
-                    sigma = np.sqrt(self.cov[idx, idx] * self.num_days_per_year)
-                    html_text += f"<td>{sigma:.2f}%</td>\n"
-                    mcr = weight * self.exp_ret[idx] * self.num_days_per_year
-                    html_text += f"<td>{mcr:.2f}%</td><td>{mcv:.2f}%</td></tr>\n"
-                    sum_mcr += mcr
-                    sum_mcv += mcv
-                    sum_weights += weight
+            html_text += "".join(
+                f"<tr><td>{etf}</td><td>{weight:.2%}</td>\n"
+                f"<td>{ret:.2f}%</td>\n<td>{sigma:.2f}%</td>\n"
+                f"<td>{mcr:.2f}%</td><td>{mcv:.2f}%</td></tr>\n"
+                for etf, weight, ret, sigma, mcr, mcv in zip(
+                    names, w, rets, sigmas, mcrs, mcvs
+                )
+            )
             html_text += f"<tr><th>Portfolio</th><th>{sum_weights:.2%}</th>"
             html_text += "<th></th><th></th>"
-            html_text += f"<th>{sum_mcr:.2f}%</th><th>{sum_mcv:.2f}%</th></tr>\n"
+            html_text += f"<th>{mcrs.sum():.2f}%</th><th>{mcvs.sum():.2f}%</th></tr>\n"
         html_text += "</table>"
         if abs(sum_weights - 1.0) > 0.01:
             html_text += f"<p>Sum of weights is not 1.0: {sum_weights:.2%}</p>\n"
             html_text += "<p>It is likely due to dropping of too many components"
-            html_text += f" with low weights (less than {self.min_weight:.2%}).</p>\n"
-        html_text += self.get_corr_html()
-        if (self.exp_ret is not None) and (self.cov is not None):
-            html_text += self.get_pnl_sharpe_html(portfolio_return, portfolio_variance)
+            html_text += (
+                f" with low weights (less than {data['min_weight']:.2%}).</p>\n"
+            )
+        if "metrics" in data:
+            html_text += Portfolio.get_corr_html(
+                list(weight_map), w, np.array(data["cov"])
+            )
+            html_text += Portfolio.get_pnl_sharpe_html(
+                data["metrics"], data.get("risk_free_asset")
+            )
 
         # actions
-        portfolio_str = html.escape(self.to_string())
+        portfolio_str = html.escape("|".join(f"{k}:{v}" for k, v in weight_map.items()))
         start_date = (pd.Timestamp.now("UTC") - pd.Timedelta(days=2000)).strftime(
             "%Y-%m-%d"
         )
@@ -0,0 +1,172 @@
+"""
+Block-bootstrap projection of portfolio values
+
+Historical daily log returns are resampled in contiguous blocks (to retain
+short-term autocorrelation and volatility clustering) to simulate forward
+paths of a one-time investment and of a SIP on the same portfolio.
+
+Paths are simulated in chunks laid out time-major, i.e. as (day, path)
+arrays, so that every running sum / running max is a loop over days of
+operations that are vectorized across all the paths of the chunk.
+
+"""
+
+import dataclasses
+from typing import Dict, Sequence
+
+import numpy as np
+
+PERCENTILES = (5, 25, 50, 75, 95)
+MAX_CHUNK_BYTES = 64 * 1024 * 1024
+
+
+@dataclasses.dataclass
+class Projection(object):
+    days: np.ndarray
+    invested: np.ndarray
+    one_time_invested: float
+    one_time_bands: Dict[int, np.ndarray]
+    sip_bands: Dict[int, np.ndarray]
+    one_time_final: np.ndarray
+    sip_final: np.ndarray
+    one_time_drawdown: np.ndarray
+    sip_drawdown: np.ndarray
+
+
+def block_bootstrap_indices(
+    rng: np.random.Generator,
+    num_obs: int,
+    num_paths: int,
+    horizon: int,
+    block_size: int,
+) -> np.ndarray:
+    """Indices of shape (horizon, num_paths) into a series of length num_obs
+
+    Each path is made of contiguous blocks of block_size observations starting
+    at uniformly chosen offsets, truncated to horizon observations.
+    """
+    block_size = max(1, min(block_size, num_obs))
+    num_blocks = -(-horizon // block_size)
+    starts = rng.integers(
+        0,
+        num_obs - block_size + 1,
+        size=(num_blocks, 1, num_paths),
+        dtype=np.int32,
+    )
+    idx = starts + np.arange(block_size, dtype=np.int32)[None, :, None]
+    return idx.reshape(-1, num_paths)[:horizon]
+
+
+def _running(ufunc, x: np.ndarray, out: np.ndarray) -> np.ndarray:
+    """Running reduction of x along the first (time) axis
+
+    Every step is vectorized over the paths, along the contiguous axis.
+    ufunc.accumulate(x, axis=0) walks the paths one at a time instead, and is
+    slower: 0.75s against 0.19s for the 21 calls of 10k paths over 15 years.
+    """
+    out[0] = x[0]
+    for t in range(1, len(x)):
+        ufunc(out[t - 1], x[t], out=out[t])
+    return out
+
+
+def project_portfolio(
+    daily_returns: np.ndarray,
+    horizon: int,
+    sip_amount: float,
+    sip_frequency: int,
+    num_paths: int = 10000,
+    block_size: int = 21,
+    seed: int = 0,
+    num_points: int = 120,
+    percentiles: Sequence[int] = PERCENTILES,
+) -> Projection:
+    """Simulate portfolio value paths by block-bootstrapping daily returns
+
+    Parameters
+    ----------
+        daily_returns: historical daily log returns of the portfolio (in %).
+            The weights are static, so resampling rows of the component
+            return panel and resampling this weighted series are equivalent.
+        horizon: number of trading days to project
+        sip_amount: amount invested at t=0 (one-time) and at every SIP date
+        sip_frequency: number of trading days between SIP investments
+        num_paths: number of simulated paths
+        block_size: number of consecutive trading days in a resampled block
+        seed: seed for the random number generator
+        num_points: number of points in time at which bands are reported
+
+    Returns
+    -------
+        Projection with percentile bands of both paths sampled at `days`,
+        and per-path final values and maximum drawdowns
+    """
+    returns = np.asarray(daily_returns, dtype=np.float64)
+    returns = (returns[np.isfinite(returns)] / 100).astype(np.float32)
+    if len(returns) == 0:
+        raise ValueError("No historical returns to resample")
+    if horizon <= 0:
+        raise ValueError(f"The projection must be at least one day, not {horizon}")
+    if (num_paths <= 0) or (sip_frequency <= 0):
+        raise ValueError(
+            f"Invalid number of paths {num_paths} or SIP frequency {sip_frequency}"
+        )
+
+    rng = np.random.default_rng(seed)
+    days = np.unique(np.linspace(0, horizon, num_points + 1).astype(int))
+    sip_days = np.arange(0, horizon + 1, sip_frequency)
+    sip_segments = list(zip(sip_days, list(sip_days[1:]) + [horizon + 1]))
+    num_sips = np.searchsorted(sip_days, days, side="right")
+    invested = sip_amount * num_sips.astype(float)
+
+    one_time_paths = np.empty((len(days), num_paths))
+    sip_paths = np.empty((len(days), num_paths))
+    one_time_drawdown = np.empty(num_paths)
+    sip_drawdown = np.empty(num_paths)
+
+    # two float32 buffers and one int32 index array per path
+    chunk_size = min(num_paths, max(1, MAX_CHUNK_BYTES // (12 * (horizon + 1))))
+    cum_ret = np.empty((horizon + 1, chunk_size), dtype=np.float32)
+    buf = np.empty_like(cum_ret)
+    for start in range(0, num_paths, chunk_size):
+        stop = min(start + chunk_size, num_paths)
+        cum = cum_ret[:, : stop - start]
+        val = buf[:, : stop - start]
+        idx = block_bootstrap_indices(
+            rng, len(returns), stop - start, horizon, block_size
+        )
+        # cumulative log return with the value before any return at day 0
+        cum[0] = 0
+        np.take(returns, idx, out=cum[1:])
+        _running(np.add, cum, cum)
+
+        # one-time investment: drawdown is driven by the log-return path alone
+        _running(np.maximum, cum, val)
+        np.subtract(cum, val, out=val)
+        one_time_drawdown[start:stop] = 1 - np.exp(val.min(axis=0))
+        np.exp(cum, out=val)
+        one_time_paths[:, start:stop] = sip_amount * val[days]
+
+        # SIP: the investment at day t_j grows by exp(cum[t] - cum[t_j]), so
+        # the value is exp(cum[t]) times the units bought so far
+        units = np.cumsum(sip_amount * np.exp(-cum[sip_days]), axis=0)
+        for (seg_start, seg_stop), seg_units in zip(sip_segments, units):
+            val[seg_start:seg_stop] *= seg_units
+        sip_paths[:, start:stop] = val[days]
+        _running(np.maximum, val, cum)
+        np.divide(val, cum, out=cum)
+        sip_drawdown[start:stop] = 1 - cum.min(axis=0)
+
+    return Projection(
+        days=days,
+        invested=invested,
+        one_time_invested=sip_amount,
+        one_time_bands=dict(
+            zip(percentiles, np.percentile(one_time_paths, percentiles, axis=1))
+        ),
+        sip_bands=dict(zip(percentiles, np.percentile(sip_paths, percentiles, axis=1))),
+        one_time_final=one_time_paths[-1],
+        sip_final=sip_paths[-1],
+        one_time_drawdown=one_time_drawdown,
+        sip_drawdown=sip_drawdown,
+    )
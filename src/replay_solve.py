@@ -0,0 +1,55 @@
+"""
+Replay a solve saved by the solver telemetry
+
+Usage: cd src && python replay_solve.py __cache__/slow_solves/<file>.npz
+           [--profile]
+
+The solve is run again with the same expected returns, covariance, minimum
+return, bounds and initial weights, and its telemetry is printed. With
+--profile, the functions it spends the most time in are printed as well.
+"""
+
+import argparse
+import cProfile
+import logging
+import pstats
+from pathlib import Path
+
+import yfinance as yf
+
+from opt import find_min_var_portfolio
+from solver_telemetry import SolverTelemetry, load_solve
+
+logger = yf.utils.get_yf_logger()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("path", type=Path, nargs="+")
+    parser.add_argument("--profile", action="store_true")
+    parser.add_argument("--num-stats", type=int, default=20)
+    return parser.parse_args()
+
+
+def replay(path: Path, profile: bool, num_stats: int) -> None:
+    inputs = load_solve(path)
+    # no dumps, the inputs are already saved
+    telemetry = SolverTelemetry(dump_dir=None)
+    profiler = cProfile.Profile() if profile else None
+    if profiler is not None:
+        profiler.enable()
+    w, r_opt, vol_opt = find_min_var_portfolio(**inputs, telemetry=telemetry)
+    if profiler is not None:
+        profiler.disable()
+    logger.info(f"{path}: {telemetry.records[0]}")
+    logger.info(f"ret: {r_opt:.3f}%, vol: {vol_opt:.3f}%")
+    if profiler is not None:
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(num_stats)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    logger.setLevel(logging.INFO)
+    args = parse_args()
+    for path in args.path:
+        replay(path, args.profile, args.num_stats)
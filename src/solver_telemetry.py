@@ -0,0 +1,212 @@
+"""
+Telemetry of the SLSQP solves of the optimizer
+
+Every solve of find_min_var_portfolio can be recorded with its iterations,
+function evaluations, status, wall time and constraint violation. The
+inputs of the solves that take longer than SLOW_SOLVE_SECONDS or
+SLOW_SOLVE_ITERATIONS iterations are saved to SLOW_SOLVE_DIR, to be
+reproduced and profiled offline with replay_solve.py.
+
+"""
+
+import dataclasses
+import os
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from cache import CACHE_DIR
+from metrics import Counter, Histogram
+from moments import FactorCovariance
+
+SLOW_SOLVE_SECONDS = float(os.getenv("SLOW_SOLVE_SECONDS", "5"))
+SLOW_SOLVE_ITERATIONS = int(os.getenv("SLOW_SOLVE_ITERATIONS", "200"))
+SLOW_SOLVE_DIR = Path(os.getenv("SLOW_SOLVE_DIR", str(CACHE_DIR / "slow_solves")))
+# slow solves saved per task, the others are only counted
+MAX_SLOW_SOLVE_DUMPS = 3
+# saved solves kept by populate_all_caches, newest first
+MAX_SLOW_SOLVE_FILES = int(os.getenv("MAX_SLOW_SOLVE_FILES", "100"))
+SLOW_SOLVE_DAYS = float(os.getenv("SLOW_SOLVE_DAYS", "7"))
+
+SOLVE_SECONDS = Histogram(
+    "etf_optimizer_solve_seconds",
+    "Wall time of the SLSQP solves",
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60),
+)
+SOLVES_TOTAL = Counter(
+    "etf_optimizer_solves_total", "SLSQP solves by outcome", ["outcome"]
+)
+
+
+@dataclasses.dataclass
+class SolveRecord(object):
+    r_min: float
+    num_assets: int
+    nit: int
+    nfev: int
+    status: int
+    message: str
+    success: bool
+    seconds: float
+    # largest violation of the budget, return and bound constraints
+    violation: float
+    dump_path: Optional[str] = None
+
+
+def prune_slow_solves(
+    cutoff_time, logger, max_files: int = MAX_SLOW_SOLVE_FILES
+) -> int:
+    # removes the saved solves older than cutoff_time or beyond the max_files
+    # newest ones
+    if not SLOW_SOLVE_DIR.exists():
+        return 0
+    paths = sorted(
+        SLOW_SOLVE_DIR.glob("*.npz"), key=lambda x: x.stat().st_mtime, reverse=True
+    )
+    kept: List[Path] = []
+    for path in paths:
+        mtime = pd.Timestamp(path.stat().st_mtime, unit="s", tz="UTC")
+        if (len(kept) < max_files) and (mtime > cutoff_time):
+            kept.append(path)
+        else:
+            path.unlink(missing_ok=True)
+    logger.info(f"Pruned slow solves in {SLOW_SOLVE_DIR}: {len(kept)} kept")
+    return len(kept)
+
+
+def get_violation(
+    w: np.ndarray, exp_rets: np.ndarray, r_min: float, w_max: float
+) -> float:
+    return max(
+        abs(np.sum(w) - 1),
+        r_min - np.dot(w, exp_rets),
+        -np.min(w),
+        np.max(w) - w_max,
+        0.0,
+    )
+
+
+def save_solve(
+    path: Path,
+    exp_rets: np.ndarray,
+    cov,
+    r_min: float,
+    w_max: float,
+    w0: Optional[np.ndarray],
+) -> None:
+    # a factor covariance is saved as its factors, which is much smaller
+    arrays: Dict[str, Any] = {
+        "exp_rets": exp_rets,
+        "r_min": r_min,
+        "w_max": w_max,
+    }
+    if w0 is not None:
+        arrays["w0"] = np.asarray(w0, dtype=float)
+    if isinstance(cov, FactorCovariance):
+        arrays["loadings"] = cov.loadings
+        arrays["factor_cov"] = cov.factor_cov
+        arrays["specific_var"] = cov.specific_var
+    else:
+        arrays["cov"] = cov
+    np.savez_compressed(path, **arrays)
+
+
+def load_solve(path: Path) -> Dict[str, Any]:
+    """Inputs of a saved solve, as keyword arguments of find_min_var_portfolio"""
+    with np.load(path) as data:
+        if "cov" in data:
+            cov = data["cov"]
+        else:
+            cov = FactorCovariance(
+                data["loadings"], data["factor_cov"], data["specific_var"]
+            )
+        return {
+            "exp_rets": data["exp_rets"],
+            "cov": cov,
+            "r_min": float(data["r_min"]),
+            "w_max": float(data["w_max"]),
+            "w0": data["w0"] if "w0" in data else None,
+        }
+
+
+class SolverTelemetry(object):
+    """Records of the solves of one task, shared by its frontier points"""
+
+    def __init__(
+        self,
+        slow_seconds: float = SLOW_SOLVE_SECONDS,
+        slow_iterations: int = SLOW_SOLVE_ITERATIONS,
+        dump_dir: Optional[Path] = SLOW_SOLVE_DIR,
+        max_dumps: int = MAX_SLOW_SOLVE_DUMPS,
+    ):
+        self.slow_seconds = slow_seconds
+        self.slow_iterations = slow_iterations
+        self.dump_dir = dump_dir
+        self.max_dumps = max_dumps
+        self.records: List[SolveRecord] = []
+        self.lock = threading.Lock()
+
+    def record(
+        self,
+        result,
+        seconds: float,
+        exp_rets: np.ndarray,
+        cov,
+        r_min: float,
+        w_max: float,
+        w0: Optional[np.ndarray],
+        logger=None,
+    ) -> SolveRecord:
+        # result is the OptimizeResult of scipy.optimize.minimize
+        record = SolveRecord(
+            r_min=float(r_min),
+            num_assets=len(exp_rets),
+            nit=int(result.get("nit", 0)),
+            nfev=int(result.get("nfev", 0)),
+            status=int(result.get("status", -1)),
+            message=str(result.get("message", "")),
+            success=bool(result.get("success", False)),
+            seconds=seconds,
+            violation=float(get_violation(result["x"], exp_rets, r_min, w_max)),
+        )
+        SOLVE_SECONDS.observe(seconds)
+        SOLVES_TOTAL.inc(outcome="success" if record.success else "failure")
+        is_slow = (seconds > self.slow_seconds) or (record.nit >= self.slow_iterations)
+        with self.lock:
+            num_dumps = sum(x.dump_path is not None for x in self.records)
+            if is_slow and (self.dump_dir is not None) and (num_dumps < self.max_dumps):
+                self.dump_dir.mkdir(parents=True, exist_ok=True)
+                ts = pd.Timestamp.now("UTC").strftime("%Y%m%d_%H%M%S_%f")
+                path = self.dump_dir / f"{ts}_{record.num_assets}_{record.nit}.npz"
+                save_solve(path, exp_rets, cov, r_min, w_max, w0)
+                record.dump_path = str(path)
+            self.records.append(record)
+        if (logger is not None) and (is_slow or not record.success):
+            logger.warning(f"Slow or failed solve: {record}")
+        return record
+
+    def summary(self) -> Dict[str, Any]:
+        with self.lock:
+            records = list(self.records)
+        return {
+            "solves": len(records),
+            "failures": sum(not x.success for x in records),
+            "nit": sum(x.nit for x in records),
+            "nfev": sum(x.nfev for x in records),
+            "seconds": sum(x.seconds for x in records),
+            "max_seconds": max((x.seconds for x in records), default=0.0),
+            "max_violation": max((x.violation for x in records), default=0.0),
+            "dumps": [x.dump_path for x in records if x.dump_path is not None],
+        }
+
+    def __str__(self) -> str:
+        summary = self.summary()
+        return (
+            f"{summary['solves']} solves ({summary['failures']} failed), "
+            f"{summary['nit']} iterations, {summary['nfev']} evaluations, "
+            f"{summary['seconds']:.2f}s, max violation "
+            f"{summary['max_violation']:.2e}"
+        )
@@ -0,0 +1,231 @@
+"""
+Run the ETF optimizer over a grid of parameters
+
+Usage: python src/sweep.py --num-contracts 50 100 --correlation-cutoff 0.95 0.99
+           --num-years 3 5 --output sweep.parquet
+
+The returns are downloaded once for the longest lookback and sliced for the
+shorter ones. Selection runs in this process and shares the correlations
+computed for one lookback across all the cutoffs and contract counts; the
+optimizations run in a process pool. All the portfolios are written to one
+file (parquet if the output name ends in .parquet, csv otherwise), with one
+row per portfolio component.
+
+With --state, the correlations and portfolios of the run are saved, and the
+next run with the same --state refreshes them: it only compares again the
+pairs whose correlation is close to a cutoff or was computed more than
+REFRESH_MAX_DAYS ago, and starts every solver from the previous frontier,
+which is much faster after a day of new prices. How close is a heuristic
+(REFRESH_CORR_MARGIN per day since the correlation was computed), so a sample
+of the reused correlations is computed again first, and all of them are if
+one of the sample crossed a cutoff. The web tasks do not refresh.
+"""
+
+import argparse
+import itertools
+import logging
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Hashable, List, Optional, Tuple
+
+import pandas as pd
+import yfinance as yf
+
+from backend.data_provider import get_data_provider
+from backend.etf import NUM_FACTORS, ETFOptimizer, RefreshState
+from backend.yf_utils import YFReturnsCache
+from cache.etf_volume import ETFVolumeCache
+from portfolio import Portfolio
+from web.optimizer import CORR, NUM_CONTRACTS, NUM_YEARS
+
+logger = yf.utils.get_yf_logger()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--currency", default="USD")
+    parser.add_argument("--num-contracts", type=int, nargs="+", default=[NUM_CONTRACTS])
+    parser.add_argument("--correlation-cutoff", type=float, nargs="+", default=[CORR])
+    parser.add_argument("--num-years", type=float, nargs="+", default=[NUM_YEARS])
+    parser.add_argument(
+        "--shrinkage",
+        action="store_true",
+        help="Shrink the covariance matrices (Ledoit-Wolf)",
+    )
+    parser.add_argument("--covariance", choices=["sample", "factor"], default="sample")
+    parser.add_argument("--num-factors", type=int, default=NUM_FACTORS)
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--output", default="sweep.parquet")
+    parser.add_argument("--state", type=Path, help="Refresh state, e.g. sweep.pkl")
+    args = parser.parse_args()
+    if args.shrinkage and (args.covariance == "factor"):
+        parser.error("--shrinkage only applies to --covariance sample")
+    return args
+
+
+def load_state(path: Optional[Path]) -> Dict[Hashable, RefreshState]:
+    # the state of the selection of every lookback, and of every portfolio
+    if (path is None) or not path.exists():
+        return {}
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def get_portfolio_key(optimizer: ETFOptimizer) -> Hashable:
+    return (
+        "portfolio",
+        optimizer.num_contracts,
+        optimizer.correlation_cutoff,
+        optimizer.num_years,
+    )
+
+
+def select_etfs(
+    args: argparse.Namespace, state: Dict[Hashable, RefreshState]
+) -> Tuple[List[ETFOptimizer], Dict[Hashable, RefreshState]]:
+    ETFVolumeCache.process_cache(logger, days_to_prune_after=7, chunk_size=100)
+    base = ETFOptimizer(
+        args.currency,
+        max(args.num_contracts),
+        min(args.correlation_cutoff),
+        max(args.num_years),
+    )
+    base.etf_volume_cache = ETFVolumeCache(get_data_provider().list_etfs())
+    base.set_contract_list(logger)
+    assert base.contract_list is not None
+    returns_cache = YFReturnsCache(base.start_date, base.end_date, base.contract_list)
+
+    optimizers = []
+    selection_state: Dict[Hashable, RefreshState] = {}
+    for num_years in sorted(set(args.num_years), reverse=True):
+        # correlations only depend on the period, not on the cutoff
+        corr_cache: Dict[Tuple[str, str], float] = {}
+        # when the reused correlations were computed, the others are new
+        corr_dates: Dict[Tuple[str, str], str] = {}
+        prev_state = state.get(("selection", num_years))
+        if prev_state is not None:
+            corr_cache = prev_state.get_corr_cache(
+                base.end_date, args.correlation_cutoff
+            )
+            start_date = (base.now - pd.Timedelta(days=int(365 * num_years))).strftime(
+                "%Y-%m-%d"
+            )
+            crossed = RefreshState.check_corr_cache(
+                corr_cache, returns_cache, start_date, args.correlation_cutoff
+            )
+            if crossed is not None:
+                logger.warning(
+                    f"The correlation of {crossed} crossed a cutoff since the last "
+                    f"run, computing all of them again for num_years={num_years}"
+                )
+                corr_cache = {}
+            corr_dates = {key: prev_state.get_corr_date(key) for key in corr_cache}
+            logger.info(
+                f"Reusing {len(corr_cache)} of {len(prev_state.corr_cache)} "
+                f"correlations for num_years={num_years}"
+            )
+        for correlation_cutoff, num_contracts in itertools.product(
+            sorted(set(args.correlation_cutoff)), sorted(set(args.num_contracts))
+        ):
+            optimizer = ETFOptimizer(
+                args.currency,
+                num_contracts,
+                correlation_cutoff,
+                num_years,
+                shrinkage=args.shrinkage,
+                covariance=args.covariance,
+                num_factors=args.num_factors,
+            )
+            prev_state = state.get(get_portfolio_key(optimizer))
+            if prev_state is not None:
+                optimizer.prev_portfolio = prev_state.portfolio
+            optimizer.contract_list = base.contract_list
+            optimizer.set_top_etf_return_df(logger, returns_cache, corr_cache)
+            assert optimizer.returns_df is not None
+            logger.info(
+                f"Selected {len(optimizer.returns_df.columns)} ETFs for "
+                f"num_contracts={num_contracts}, "
+                f"correlation_cutoff={correlation_cutoff}, num_years={num_years}"
+            )
+            optimizers.append(optimizer)
+        selection_state[("selection", num_years)] = RefreshState(
+            base.end_date, corr_cache, None, corr_dates
+        )
+    return optimizers, selection_state
+
+
+def optimize(optimizer: ETFOptimizer) -> Tuple[List[Dict], Optional[Portfolio]]:
+    config = {
+        "num_contracts": optimizer.num_contracts,
+        "correlation_cutoff": optimizer.correlation_cutoff,
+        "num_years": optimizer.num_years,
+        "shrinkage": optimizer.shrinkage,
+        "covariance": optimizer.covariance,
+    }
+    try:
+        optimizer.optimize(logger)
+    except Exception as e:  # pylint: disable=broad-except
+        logger.error(f"Error in optimization for {config}: {e}")
+        return [{**config, "error": str(e)}], None
+    portfolio = optimizer.portfolio
+    assert portfolio is not None
+    assert portfolio.exp_ret is not None and portfolio.cov is not None
+    assert portfolio.risk_free_asset is not None
+    metrics = portfolio.get_metrics()
+    config.update(
+        {
+            "num_selected": len(portfolio.weight_map),
+            "risk_free_symbol": portfolio.risk_free_asset.symbol,
+            "risk_free_rate": portfolio.risk_free_asset.exp_ret,
+            "portfolio_return": metrics["return"],
+            "portfolio_volatility": metrics["volatility"],
+            "sharpe": metrics["sharpe"],
+        }
+    )
+    rows = []
+    for idx, (etf, weight) in enumerate(portfolio.weight_map.items()):
+        if weight > portfolio.min_weight:
+            rows.append(
+                {
+                    **config,
+                    "symbol": etf,
+                    "weight": weight,
+                    "exp_ret": portfolio.exp_ret[idx] * portfolio.num_days_per_year,
+                    "volatility": (
+                        portfolio.cov[idx, idx] * portfolio.num_days_per_year
+                    )
+                    ** 0.5,
+                }
+            )
+    return rows, portfolio
+
+
+def main():
+    args = parse_args()
+    state = load_state(args.state)
+    optimizers, new_state = select_etfs(args, state)
+    with ProcessPoolExecutor(max_workers=args.processes) as pool:
+        results = list(pool.map(optimize, optimizers))
+    sweep_df = pd.DataFrame([row for rows, _ in results for row in rows])
+    if args.output.endswith(".parquet"):
+        sweep_df.to_parquet(args.output, index=False)
+    else:
+        sweep_df.to_csv(args.output, index=False)
+    logger.info(f"Saved {len(optimizers)} portfolios to {args.output}")
+    if args.state is not None:
+        for optimizer, (_, portfolio) in zip(optimizers, results):
+            key = get_portfolio_key(optimizer)
+            new_state[key] = RefreshState(optimizer.end_date, {}, portfolio)
+        tmp_path = args.state.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump(new_state, f)
+        os.replace(tmp_path, args.state)
+        logger.info(f"Saved the refresh state to {args.state}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    logger.setLevel(logging.INFO)
+    main()
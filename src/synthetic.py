@@ -0,0 +1,123 @@
+"""
+Seeded synthetic ETF market for benchmarks and load tests
+
+Daily log returns (in percent, as in YFReturnsCache) come from a factor
+model, so that they are correlated like real ETFs. Some ETFs are listed
+after the start of the period, some have gaps in their history, and some
+are near-duplicates of others, like ETFs that track the same index.
+
+"""
+
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from backend.data_provider import ETF_INFO_KEYS, DataProvider
+
+NUM_DAYS_PER_YEAR = 252
+NUM_FACTORS = 8
+
+
+class SyntheticMarket(object):
+    def __init__(
+        self,
+        num_assets: int,
+        num_years: float,
+        seed: int = 0,
+        end_date: Optional[str] = None,
+        late_listing_ratio: float = 0.2,
+        gap_ratio: float = 0.002,
+        duplicate_ratio: float = 0.1,
+    ):
+        rng = np.random.default_rng(seed)
+        num_days = int(round(num_years * NUM_DAYS_PER_YEAR)) + 1
+        end = pd.Timestamp.now().normalize() if end_date is None else end_date
+        self.dates = pd.bdate_range(end=end, periods=num_days, name="Date")
+        self.symbols = [f"S{i:04d}" for i in range(num_assets)]
+
+        factors = rng.normal(0.02, 1.0, (num_days, NUM_FACTORS))
+        factors[:, 1:] *= 0.5
+        loadings = rng.normal(0, 0.3, (num_assets, NUM_FACTORS))
+        loadings[:, 0] = rng.uniform(0.2, 1.2, num_assets)
+        specific = rng.uniform(0.1, 1.0, num_assets) * rng.normal(
+            size=(num_days, num_assets)
+        )
+        returns = factors @ loadings.T + specific + rng.normal(0, 0.01, num_assets)
+
+        # near-duplicates of the ETFs before them
+        num_duplicates = int(duplicate_ratio * num_assets)
+        duplicates = rng.choice(
+            np.arange(1, num_assets), size=min(num_duplicates, num_assets - 1)
+        )
+        for idx in duplicates:
+            source = rng.integers(idx)
+            returns[:, idx] = returns[:, source] + rng.normal(0, 0.05, num_days)
+
+        # the first return is NaN as in YFReturnsCache
+        returns[0] = np.nan
+        late = rng.random(num_assets) < late_listing_ratio
+        listing = rng.integers(1, max(2, int(0.7 * num_days)), num_assets)
+        for idx in np.flatnonzero(late):
+            returns[: listing[idx], idx] = np.nan
+        returns[rng.random(returns.shape) < gap_ratio] = np.nan
+        self.returns_df = pd.DataFrame(returns, index=self.dates, columns=self.symbols)
+
+        self.etf_df = pd.DataFrame(
+            {
+                "symbol": self.symbols,
+                "quoteType": "ETF",
+                "exchange": rng.choice(["PCX", "NGM", "BTS"], num_assets),
+                "three_month_average_volume": np.round(
+                    rng.lognormal(11, 2, num_assets)
+                ),
+                "fifty_day_average": rng.uniform(20, 400, num_assets),
+                "currency": np.where(rng.random(num_assets) < 0.95, "USD", "EUR"),
+            }
+        )
+
+    def get_price_df(self, tickers: List[str], start: str, end: str) -> pd.DataFrame:
+        # prices in the yf.download layout, NaN before the listing and in the
+        # gaps, for the tickers that exist
+        tickers = [x for x in tickers if x in self.returns_df.columns]
+        returns_df = self.returns_df[tickers]
+        prices = 100 * (returns_df.fillna(0).cumsum() / 100).apply(np.exp)
+        # a price is needed on the day before every return
+        valid = returns_df.notnull()
+        prices = prices.where(valid | valid.shift(-1, fill_value=False))
+        prices = prices[(prices.index >= start) & (prices.index < end)]
+        volume = prices.notnull() * 1e6
+        return pd.concat(
+            {"Adj Close": prices, "Close": prices, "Volume": volume},
+            axis=1,
+            names=["Price", "Ticker"],
+        )
+
+    def save(self, data_dir: Path) -> None:
+        # in the layout of LocalProvider, to be served like recorded data
+        price_dir = data_dir / "prices"
+        price_dir.mkdir(parents=True, exist_ok=True)
+        self.etf_df.to_csv(data_dir / "etfs.csv", index=False)
+        end = f"{self.dates[-1] + pd.Timedelta(days=1):%Y-%m-%d}"
+        price_df = self.get_price_df(self.symbols, f"{self.dates[0]:%Y-%m-%d}", end)
+        for symbol in self.symbols:
+            ticker_df = price_df.xs(symbol, axis=1, level=1).dropna(how="all")
+            ticker_df.to_csv(price_dir / f"{symbol}.csv")
+
+
+class SyntheticProvider(DataProvider):
+    """DataProvider serving a SyntheticMarket from memory"""
+
+    def __init__(self, market: SyntheticMarket):
+        self.market = market
+
+    def list_etfs(self) -> List[str]:
+        return list(self.market.symbols)
+
+    def get_etf_info(self, symbol: str) -> Dict[str, Any]:
+        row = self.market.etf_df.set_index("symbol").loc[symbol]
+        return {key: row[key] for key in ETF_INFO_KEYS}
+
+    def download_prices(self, tickers: List[str], start: str, end: str):
+        return self.market.get_price_df(tickers, start, end)
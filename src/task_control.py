@@ -0,0 +1,93 @@
+import threading
+import time
+from typing import Dict, List, Optional
+
+# share of the time budget of each stage of an optimizer task, in the order
+# they run; selection includes downloading the returns since they are
+# fetched as the ETFs are considered
+STAGE_SHARES = {
+    "cache": 0.1,
+    "selection": 0.6,
+    "frontier": 0.3,
+}
+
+
+class TimeBudget(object):
+    """Wall-clock budget of a task, split between its stages
+
+    Each stage gets its share of the time left when it starts, so the time a
+    stage does not use is passed on to the later ones. Stages poll
+    should_stop() and stop early with what they have when it returns True.
+    """
+
+    def __init__(
+        self, seconds: Optional[float], shares: Dict[str, float] = STAGE_SHARES
+    ):
+        self.seconds = seconds
+        self.shares = shares
+        self.start_time = time.monotonic()
+        self.stage: Optional[str] = None
+        self.stage_end: Optional[float] = None
+        self.cut_stages: List[str] = []
+
+    def start_stage(self, stage: str) -> None:
+        assert stage in self.shares, stage
+        self.stage = stage
+        if self.seconds is None:
+            return
+        stages = list(self.shares)
+        later_shares = sum(self.shares[x] for x in stages[stages.index(stage) :])
+        now = time.monotonic()
+        remaining = max(0.0, self.start_time + self.seconds - now)
+        self.stage_end = now + remaining * self.shares[stage] / later_shares
+
+    def should_stop(self) -> bool:
+        if (self.stage_end is None) or (time.monotonic() < self.stage_end):
+            return False
+        if self.stage not in self.cut_stages:
+            assert self.stage is not None
+            self.cut_stages.append(self.stage)
+        return True
+
+
+class TaskCancelledError(Exception):
+    pass
+
+
+class CancelToken(object):
+    """Cooperative cancellation of a task running in a thread
+
+    The task calls check() at its checkpoints, which raises
+    TaskCancelledError once cancel() was called, or once no one has called
+    poll() for max_idle seconds, e.g. because the user closed the page.
+    """
+
+    def __init__(self, max_idle: Optional[float] = None):
+        self.max_idle = max_idle
+        self.event = threading.Event()
+        self.reason: Optional[str] = None
+        self.last_poll = time.monotonic()
+
+    def poll(self) -> None:
+        self.last_poll = time.monotonic()
+
+    def cancel(self, reason: str) -> None:
+        if not self.event.is_set():
+            self.reason = reason
+            self.event.set()
+
+    def is_cancelled(self) -> bool:
+        if (self.max_idle is not None) and (
+            time.monotonic() - self.last_poll > self.max_idle
+        ):
+            self.cancel(f"Task was not polled for {self.max_idle:g}s")
+        return self.event.is_set()
+
+    def check(self) -> None:
+        if self.is_cancelled():
+            raise TaskCancelledError(self.reason)
+
+    def sleep(self, seconds: float) -> None:
+        # time.sleep that wakes up and raises on cancel()
+        self.event.wait(seconds)
+        self.check()
@@ -0,0 +1,51 @@
+import logging
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from backend.etf import ETFOptimizer, RefreshState
+
+
+def test_pickle_optimizer():
+    # sweep.py sends the optimizers to a process pool
+    optimizer = ETFOptimizer("USD", 10, 0.9, 1)
+    optimizer.returns_df = pd.DataFrame(np.ones((3, 2)), columns=["A", "B"])
+    optimizer.cancel_token.cancel("test")
+    with optimizer.timings.stage("screening"):
+        pass
+    copy = pickle.loads(pickle.dumps(optimizer))
+    pd.testing.assert_frame_equal(copy.returns_df, optimizer.returns_df)
+    assert copy.end_date == optimizer.end_date
+    assert not copy.cancel_token.is_cancelled()
+    assert copy.timings.to_dict() == {}
+    with copy.timings.stage("moments"):
+        pass
+    assert copy.solver_telemetry.summary()["solves"] == 0
+
+
+def test_covariance_without_overlap():
+    optimizer = ETFOptimizer("USD", 10, 0.9, 1)
+    returns = np.random.default_rng(0).normal(0, 1, (100, 3))
+    returns[:50, 1] = np.nan
+    returns[50:, 2] = np.nan
+    optimizer.returns_df = pd.DataFrame(returns, columns=["A", "B", "C"])
+    with pytest.raises(ValueError, match="B and C"):
+        optimizer.optimize(logging.getLogger(__name__))
+
+
+def test_refresh_ages_correlations_by_when_they_were_computed():
+    end_date = "2024-01-10"
+    state = RefreshState(
+        "2024-01-09",
+        {("A", "B"): 0.5, ("A", "C"): 0.5, ("B", "C"): 0.85},
+        None,
+        {("A", "C"): "2024-01-01", ("B", "C"): "2024-01-04"},
+    )
+    # A-C was computed 9 days ago, B-C is 0.05 from the cutoff after 6 days
+    assert state.get_corr_cache(end_date, [0.9]) == {("A", "B"): 0.5}
+    optimizer = ETFOptimizer("USD", 10, 0.9, 1, refresh_state=state)
+    assert optimizer.get_refresh_state().corr_dates == {
+        key: state.get_corr_date(key) for key in optimizer.corr_cache
+    }
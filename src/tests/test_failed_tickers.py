@@ -0,0 +1,59 @@
+import pandas as pd
+import pytest
+
+import cache.failed_tickers
+from cache.failed_tickers import MAX_RETRY_HOURS, RETRY_HOURS, FailedTickerCache
+
+
+@pytest.fixture(autouse=True)
+def failed_tickers_csv(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache.failed_tickers, "CACHE_DIR", tmp_path)
+    monkeypatch.setattr(
+        cache.failed_tickers, "FAILED_TICKERS_CSV", tmp_path / "failed_tickers.csv"
+    )
+    monkeypatch.setattr(FailedTickerCache, "loaded", None)
+
+
+def get_record(symbol: str) -> dict:
+    failed_df = FailedTickerCache.read()
+    return failed_df[failed_df["symbol"] == symbol].iloc[0].to_dict()
+
+
+def make_due(symbol: str) -> None:
+    failed_df = FailedTickerCache.read()
+    failed_df.loc[failed_df["symbol"] == symbol, "retry_after"] = pd.Timestamp(
+        "2000-01-01", tz="UTC"
+    )
+    FailedTickerCache.write(failed_df)
+    # load() only reads again when the mtime changed, which may not within a
+    # test on a coarse clock
+    FailedTickerCache.loaded = None
+
+
+def test_backoff_doubles_up_to_max():
+    failure = ("AAA", "download", "No data", "")
+    hours = []
+    for _ in range(8):
+        FailedTickerCache.record([failure])
+        record = get_record("AAA")
+        hours.append((record["retry_after"] - record["last_failure"]).total_seconds())
+        # seen again by another task before the next probe
+        FailedTickerCache.record([failure])
+        assert get_record("AAA")["num_failures"] == record["num_failures"]
+        make_due("AAA")
+    expected = [min(RETRY_HOURS * 2**i, MAX_RETRY_HOURS) * 3600 for i in range(8)]
+    assert hours == expected
+
+
+def test_failures_apply_until_retry_and_clear():
+    FailedTickerCache.record(
+        [("AAA", "download", "No data", ""), ("BBB", "data_quality", "Gap", "2021")]
+    )
+    failures = FailedTickerCache.get_failures(["AAA", "BBB", "CCC"], "2020")
+    assert sorted(failures) == ["AAA", "BBB"]
+    # the returns from a later date do not include the ones BBB failed on
+    assert sorted(FailedTickerCache.get_failures(["AAA", "BBB"], "2022")) == ["AAA"]
+    make_due("AAA")
+    assert sorted(FailedTickerCache.get_failures(["AAA", "BBB"], "2020")) == ["BBB"]
+    FailedTickerCache.clear(["AAA", "BBB"], "2020")
+    assert FailedTickerCache.read().empty
@@ -0,0 +1,46 @@
+from typing import List
+
+import numpy as np
+
+from hrp import find_hrp_portfolio, get_quasi_diag_order
+
+
+def get_cluster_var(cov: np.ndarray, cluster: List[int]) -> float:
+    sub_cov = cov[np.ix_(cluster, cluster)]
+    ivp = 1 / np.diag(sub_cov)
+    ivp /= ivp.sum()
+    return float(ivp @ sub_cov @ ivp)
+
+
+def get_reference_weights(cov: np.ndarray, order: np.ndarray) -> np.ndarray:
+    # recursive bisection as listed in López de Prado (2016)
+    w = np.ones(len(cov))
+    clusters = [list(order)]
+    while clusters:
+        clusters = [
+            x
+            for cluster in clusters
+            for x in (cluster[: len(cluster) // 2], cluster[len(cluster) // 2 :])
+            if len(cluster) > 1
+        ]
+        for left, right in zip(clusters[::2], clusters[1::2]):
+            left_var = get_cluster_var(cov, left)
+            right_var = get_cluster_var(cov, right)
+            alpha = 1 - left_var / (left_var + right_var)
+            w[left] *= alpha
+            w[right] *= 1 - alpha
+    return w
+
+
+def test_recursive_bisection_matches_reference():
+    rng = np.random.default_rng(1)
+    for num_assets in [2, 3, 7, 16, 41]:
+        loadings = rng.normal(0, 1, (num_assets, 4))
+        cov = loadings @ loadings.T + np.diag(rng.uniform(0.1, 1, num_assets))
+        exp_rets = rng.normal(0, 1, num_assets)
+        w, r_opt, vol_opt = find_hrp_portfolio(exp_rets, cov)
+        expected = get_reference_weights(cov, get_quasi_diag_order(cov))
+        np.testing.assert_allclose(w, expected, rtol=1e-10)
+        assert abs(w.sum() - 1) < 1e-10
+        assert abs(r_opt - w @ exp_rets) < 1e-10
+        assert abs(vol_opt - np.sqrt(w @ cov @ w)) < 1e-10
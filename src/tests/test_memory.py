@@ -0,0 +1,72 @@
+import threading
+import time
+from typing import List
+
+import pytest
+
+from memory import AdmissionError, MemoryBudget, Reservation
+from task_control import CancelToken, TaskCancelledError
+
+
+class OrderedBudget(MemoryBudget):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.granted: List[float] = []
+
+    def grant(self, reservation: Reservation) -> None:
+        super().grant(reservation)
+        self.granted.append(reservation.footprint_mb)
+
+
+def wait_in_thread(budget: MemoryBudget, reservation: Reservation) -> threading.Thread:
+    thread = threading.Thread(target=budget.wait, args=(reservation, CancelToken()))
+    thread.start()
+    return thread
+
+
+def test_admit_wait_release_in_order():
+    budget = OrderedBudget(100, max_queued=2)
+    first = budget.admit(60)
+    assert first.granted
+    second = budget.admit(50)
+    # fits, but waits behind the reservation queued before it
+    third = budget.admit(10)
+    assert not (second.granted or third.granted)
+    with pytest.raises(AdmissionError):
+        budget.admit(1)
+    threads = [wait_in_thread(budget, x) for x in (third, second)]
+    time.sleep(0.2)
+    assert not (second.granted or third.granted)
+    budget.release(first)
+    for thread in threads:
+        thread.join(timeout=5)
+    assert second.granted and third.granted
+    assert budget.granted == [60, 50, 10]
+    assert budget.reserved_mb == 60
+    budget.release(second)
+    budget.release(third)
+    assert budget.reserved_mb == 0
+
+
+def test_reject_and_cancel():
+    budget = MemoryBudget(100)
+    with pytest.raises(AdmissionError):
+        budget.admit(101)
+    first = budget.admit(80)
+    second = budget.admit(30)
+    cancel_token = CancelToken()
+    cancel_token.cancel("closed")
+    with pytest.raises(TaskCancelledError):
+        budget.wait(second, cancel_token)
+    assert not budget.queue
+    budget.release(first)
+    assert budget.admit(30).granted
+
+
+def test_retained_results_count_against_budget():
+    budget = MemoryBudget(100)
+    budget.retain("task", 30)
+    budget.retain("task", 10)
+    assert not budget.admit(70).granted
+    budget.forget("task")
+    assert budget.retained_mb == 0
@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+
+from moments import RollingMoments, pairwise_moments
+
+
+def get_returns_df(num_rows: int = 300, num_assets: int = 8) -> pd.DataFrame:
+    # correlated returns with missing histories and holes, as in the ETF panel
+    rng = np.random.default_rng(0)
+    returns = rng.normal(0.05, 1, (num_rows, 3)) @ rng.normal(0, 1, (3, num_assets))
+    returns += rng.normal(0, 0.5, (num_rows, num_assets))
+    returns[: num_rows // 2, 0] = np.nan
+    returns[-num_rows // 3 :, 1] = np.nan
+    returns[rng.random((num_rows, num_assets)) < 0.05] = np.nan
+    return pd.DataFrame(returns)
+
+
+def test_pairwise_moments_match_pandas():
+    returns_df = get_returns_df()
+    mean, cov = pairwise_moments(returns_df.to_numpy())
+    np.testing.assert_allclose(mean, returns_df.mean().to_numpy(), rtol=1e-10)
+    np.testing.assert_allclose(cov, returns_df.cov().to_numpy(), rtol=1e-8)
+
+
+def test_rolling_moments_match_pandas_window():
+    returns_df = get_returns_df()
+    returns = returns_df.to_numpy()
+    moments = RollingMoments(returns.shape[1], shift=np.nanmean(returns, axis=0))
+    moments.add(returns[:200])
+    moments.remove(returns[:50])
+    window_df = returns_df.iloc[50:200]
+    np.testing.assert_allclose(moments.count(), window_df.count().to_numpy())
+    np.testing.assert_allclose(moments.mean(), window_df.mean().to_numpy(), rtol=1e-8)
+    np.testing.assert_allclose(moments.cov(), window_df.cov().to_numpy(), rtol=1e-8)
+    np.testing.assert_allclose(moments.corr(), window_df.corr().to_numpy(), atol=1e-10)
+
+
+def test_no_overlap_is_nan():
+    returns = np.full((10, 2), np.nan)
+    returns[:5, 0] = np.arange(5)
+    returns[5:, 1] = np.arange(5)
+    _, cov = pairwise_moments(returns)
+    assert np.isnan(cov[0, 1]) and np.isfinite(np.diag(cov)).all()
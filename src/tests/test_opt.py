@@ -0,0 +1,41 @@
+import numpy as np
+
+from moments import FactorCovariance
+from opt import find_min_var_portfolio, find_min_var_portfolio_screened
+
+
+def get_problem(num_assets: int, seed: int):
+    rng = np.random.default_rng(seed)
+    loadings = rng.normal(0, 1, (num_assets, 5))
+    cov = loadings @ loadings.T / 5 + np.diag(rng.uniform(0.2, 1, num_assets))
+    exp_rets = rng.normal(0.05, 0.1, num_assets)
+    return exp_rets, cov
+
+
+def test_screened_matches_full_solve():
+    for seed in range(3):
+        exp_rets, cov = get_problem(40, seed)
+        for r_min in np.quantile(exp_rets, [0.3, 0.6, 0.9]):
+            w, r_opt, vol_opt = find_min_var_portfolio(exp_rets, cov, r_min=r_min)
+            w_screened, r_screened, vol_screened, _ = find_min_var_portfolio_screened(
+                exp_rets, cov, r_min=r_min
+            )
+            assert abs(w_screened.sum() - 1) < 1e-6
+            assert w_screened @ exp_rets >= r_min - 1e-6
+            assert vol_screened <= vol_opt * (1 + 1e-4)
+            np.testing.assert_allclose(w_screened, w, atol=1e-3)
+
+
+def test_screened_with_factor_covariance():
+    rng = np.random.default_rng(3)
+    returns = rng.normal(0.05, 1, (500, 3)) @ rng.normal(0, 1, (3, 30))
+    returns += rng.normal(0, 0.5, returns.shape)
+    cov = FactorCovariance.from_returns(returns, 3)
+    exp_rets = returns.mean(axis=0)
+    r_min = float(np.quantile(exp_rets, 0.7))
+    w, _, vol_opt = find_min_var_portfolio(exp_rets, cov.to_dense(), r_min=r_min)
+    w_screened, _, vol_screened, _ = find_min_var_portfolio_screened(
+        exp_rets, cov, r_min=r_min
+    )
+    assert vol_screened <= vol_opt * (1 + 1e-4)
+    np.testing.assert_allclose(w_screened, w, atol=1e-3)
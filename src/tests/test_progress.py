@@ -0,0 +1,14 @@
+from web.progress import format_event, parse_offset
+
+
+def test_parse_offset():
+    assert parse_offset(None) == 0
+    assert parse_offset("") == 0
+    assert parse_offset("12") == 12
+    assert parse_offset("-3") == 0
+    assert parse_offset("abc") == 0
+
+
+def test_format_event():
+    assert format_event("log", "line", 3) == "event: log\nid: 3\ndata: line\n\n"
+    assert format_event("state", "SUCCESS") == "event: state\ndata: SUCCESS\n\n"
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from projection import block_bootstrap_indices, project_portfolio
+
+
+def test_projection_matches_loop():
+    rng = np.random.default_rng(0)
+    daily_returns = rng.normal(0.03, 1, 500)
+    horizon, sip_amount, sip_frequency, num_paths = 60, 100.0, 7, 50
+    projection = project_portfolio(
+        daily_returns,
+        horizon,
+        sip_amount,
+        sip_frequency,
+        num_paths=num_paths,
+        block_size=5,
+        seed=3,
+    )
+    # the same paths, one day at a time
+    returns = (daily_returns / 100).astype(np.float32)
+    idx = block_bootstrap_indices(
+        np.random.default_rng(3), len(returns), num_paths, horizon, 5
+    )
+    for path in range(num_paths):
+        value, units, peak, sip_peak = 1.0, 0.0, 1.0, 0.0
+        drawdown, sip_drawdown = 0.0, 0.0
+        for day in range(horizon + 1):
+            if day > 0:
+                value *= np.exp(float(returns[idx[day - 1, path]]))
+            if day % sip_frequency == 0:
+                units += sip_amount / value
+            peak = max(peak, value)
+            drawdown = max(drawdown, 1 - value / peak)
+            sip_peak = max(sip_peak, units * value)
+            sip_drawdown = max(sip_drawdown, 1 - units * value / sip_peak)
+        assert projection.one_time_final[path] == pytest.approx(
+            sip_amount * value, rel=1e-4
+        )
+        assert projection.sip_final[path] == pytest.approx(units * value, rel=1e-4)
+        assert projection.one_time_drawdown[path] == pytest.approx(drawdown, abs=1e-5)
+        assert projection.sip_drawdown[path] == pytest.approx(sip_drawdown, abs=1e-5)
+    assert projection.invested[-1] == sip_amount * (horizon // sip_frequency + 1)
+
+
+def test_projection_rejects_invalid_inputs():
+    with pytest.raises(ValueError):
+        project_portfolio(np.array([np.nan]), 10, 100.0, 5)
+    with pytest.raises(ValueError):
+        project_portfolio(np.ones(10), 0, 100.0, 5)
+    with pytest.raises(ValueError):
+        project_portfolio(np.ones(10), 10, 100.0, 0)
@@ -0,0 +1,125 @@
+import math
+from typing import Any
+
+from flask import Blueprint, Response, jsonify, make_response, request, url_for
+
+from memory import AdmissionError
+from web.optimizer import (
+    BACKTEST_YEARS,
+    CORR,
+    NUM_CONTRACTS,
+    NUM_YEARS,
+    REBALANCE_DAYS,
+    TaskDB,
+    TaskState,
+    get_logger,
+    start_task,
+)
+
+API_VERSION = 1
+
+api = Blueprint("api", __name__, url_prefix=f"/api/v{API_VERSION}")
+
+DEFAULT_ARGS = {
+    "universe": "etf_vol",
+    "currency": "USD",
+    "num_contracts": NUM_CONTRACTS,
+    "correlation_cutoff": CORR,
+    "num_years": NUM_YEARS,
+    "backtest_years": BACKTEST_YEARS,
+    "rebalance_days": REBALANCE_DAYS,
+}
+
+
+def json_safe(value: Any) -> Any:
+    # numpy types to python types and NaN / inf to null, which are not JSON
+    if isinstance(value, dict):
+        return {str(k): json_safe(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [json_safe(v) for v in value]
+    if hasattr(value, "tolist"):
+        # numpy arrays and scalars, without importing numpy
+        value = value.tolist()
+        if isinstance(value, list):
+            return json_safe(value)
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+def json_response(data: Any, status: int = 200) -> Response:
+    return make_response(jsonify(json_safe(data)), status)
+
+
+def get_task_status(task_id: str) -> dict:
+    log_text = (TaskDB.get("log", task_id) or "").strip()
+    timings = TaskDB.get("timings", task_id)
+    solver = TaskDB.get("solver", task_id)
+    memory = TaskDB.get("memory", task_id)
+    return {
+        "task_id": task_id,
+        "state": TaskDB.get_state(task_id).value,
+        "partial": TaskDB.get("partial", task_id),
+        "error": TaskDB.get("error", task_id),
+        "log": log_text.split("\n") if log_text else [],
+        # seconds spent in every stage so far
+        "timings": timings.to_dict() if timings is not None else {},
+        "solver": solver.summary() if solver is not None else {},
+        # resident memory of the process while the task runs
+        "memory": memory.to_dict() if memory is not None else {},
+    }
+
+
+@api.route("/tasks", methods=["POST"])
+def submit_task() -> Response:
+    """Start an optimizer or a backtest
+
+    The body is a JSON object with the fields of the optimizer form, the
+    missing ones take their default values. The task is cancelled if its
+    status is not polled for POLL_TIMEOUT seconds. Returns 503 if the task
+    does not fit in the memory budget.
+    """
+    app_logger = get_logger()
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return json_response({"error": "Expected a JSON object"}, 400)
+    args = {**DEFAULT_ARGS, **body}
+    try:
+        task_id = start_task(args, app_logger)
+    except (KeyError, ValueError, TypeError, NotImplementedError) as e:
+        return json_response({"error": f"Invalid arguments: {e}"}, 400)
+    except AdmissionError as e:
+        return json_response({"error": str(e)}, 503)
+    rsp = json_response(get_task_status(task_id), 202)
+    rsp.headers["Location"] = url_for("api.get_task", task_id=task_id)
+    return rsp
+
+
+@api.route("/tasks/<task_id>", methods=["GET"])
+def get_task(task_id) -> Response:
+    TaskDB.poll(task_id)
+    if TaskDB.get_state(task_id) == TaskState.NOT_FOUND:
+        return json_response({"error": f"Task not found: {task_id}"}, 404)
+    return json_response(get_task_status(task_id))
+
+
+@api.route("/tasks/<task_id>/result", methods=["GET"])
+def get_task_result(task_id) -> Response:
+    TaskDB.poll(task_id)
+    status = get_task_status(task_id)
+    if status["state"] == TaskState.NOT_FOUND.value:
+        return json_response({"error": f"Task not found: {task_id}"}, 404)
+    if status["state"] != TaskState.SUCCESS.value:
+        # the client should wait for the task, or give up if it failed
+        return json_response(status, 409)
+    result = TaskDB.get("result", task_id)
+    return json_response({"task_id": task_id, "partial": status["partial"], **result})
+
+
+@api.route("/tasks/<task_id>/cancel", methods=["POST"])
+def cancel_task(task_id) -> Response:
+    if TaskDB.get_state(task_id) == TaskState.NOT_FOUND:
+        return json_response({"error": f"Task not found: {task_id}"}, 404)
+    # a task that already finished is left as it is
+    TaskDB.cancel(task_id, "Cancelled by the user")
+    return json_response(get_task_status(task_id), 202)
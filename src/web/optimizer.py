@@ -1,89 +1,243 @@
+import logging
+import os
 import traceback
-from enum import Enum
 from threading import Thread
-from typing import Dict, Optional
+from typing import TYPE_CHECKING, Callable, Dict, Optional, Union
 
 from flask import Response, make_response, redirect, render_template, url_for
 
-from backend.etf import ETFOptimizer
-from backend.yf_utils import YFDataQualityError, YFDownloadError
+from memory import (
+    MB,
+    MEMORY_BUDGET,
+    MEMORY_SAMPLER,
+    AdmissionError,
+    Reservation,
+    estimate_footprint_mb,
+    get_size,
+)
+from metrics import TASKS_IN_PROGRESS, TASKS_TOTAL
+from task_control import CancelToken, TaskCancelledError
+from web.tasks import TaskDB, TaskState  # noqa: F401
+
+# the optimizer, pandas and yfinance are imported by the first task, so that
+# the server can start without them
+if TYPE_CHECKING:
+    from backend.backtest import WalkForwardBacktest
+    from backend.etf import ETFOptimizer
+    from portfolio import Portfolio
 
 NUM_CONTRACTS = 100
 CORR = 0.99
 NUM_YEARS = 5
+BACKTEST_YEARS = 3
+REBALANCE_DAYS = 91
+# seconds an optimizer task may take before it returns a partial result
+TIME_BUDGET = float(os.getenv("TIME_BUDGET", "600"))
+# seconds after which a task that is no longer polled by its page is cancelled
+POLL_TIMEOUT = float(os.getenv("POLL_TIMEOUT", "120"))
+# seconds the result, log and status of a finished task are kept
+TASK_TTL = float(os.getenv("TASK_TTL", "3600"))
+MODES = ("optimize", "backtest")
+METHODS = ("mean_variance", "hrp")
 
+TaskResult = Union["Portfolio", "WalkForwardBacktest"]
 
-class TaskState(Enum):
-    NOT_FOUND = "NOT_FOUND"
-    IN_PROGRESS = "IN_PROGRESS"
-    SUCCESS = "SUCCESS"
-    FAILURE = "FAILURE"
-
-
-class TaskDB(object):
-    task_data: Dict[str, Dict[str, str]] = {
-        "error": {},
-        "result": {},
-        "log": {},
-    }
 
-    @classmethod
-    def get(cls, key: str, task_id: str) -> Optional[str]:
-        return cls.task_data[key].get(task_id)
+def get_logger() -> logging.Logger:
+    # the logger of yfinance, which the app logs to, without importing it
+    return logging.getLogger("yfinance")
 
-    @classmethod
-    def put(cls, key: str, task_id: str, result) -> None:
-        cls.task_data[key][task_id] = result
 
-    @classmethod
-    def contains(cls, key: str, task_id: str) -> bool:
-        return task_id in cls.task_data[key]
+def run_task(
+    task_id: str,
+    target: Callable[[], TaskResult],
+    logger,
+    kind: str,
+    reservation: Reservation,
+):
+    # the error messages are stored as plain text, they are shown on the task
+    # page and returned by the API
+    from backend.etf import write_to_log
+    from backend.yf_utils import YFDataQualityError, YFDownloadError
 
-    @classmethod
-    def get_state(cls, task_id: str):
-        if task_id not in cls.task_data["log"]:
-            return TaskState.NOT_FOUND
-        if task_id in cls.task_data["result"]:
-            return TaskState.SUCCESS
-        if task_id in cls.task_data["error"]:
-            return TaskState.FAILURE
-        return TaskState.IN_PROGRESS
-
-
-def run_etf_optimizer(task_id, optimizer: ETFOptimizer, logger):
-    TaskDB.put("log", task_id, "")
+    TASKS_IN_PROGRESS.inc()
+    outcome = "success"
     try:
-        optimizer.run_optimizer(task_id, logger)
-        assert optimizer.portfolio is not None
-        TaskDB.put("result", task_id, optimizer.portfolio.to_html())
-        logger.info(f"Stored results for task ID {task_id}")
+        if not reservation.granted:
+            write_to_log(task_id, "Waiting for memory used by other tasks")
+            MEMORY_BUDGET.wait(reservation, TaskDB.cancel_tokens[task_id])
+        with MEMORY_SAMPLER.track(kind, reservation.footprint_mb) as usage:
+            TaskDB.put("memory", task_id, usage)
+            result = target()
+            # the result holds the returns, only what is shown of it is kept,
+            # and rendered by render_result if its page is requested
+            with TaskDB.get("timings", task_id).stage("to_dict"):
+                result_dict = result.to_dict()
+            MEMORY_BUDGET.retain(task_id, get_size(result_dict) / MB)
+            TaskDB.put("result", task_id, result_dict)
+        logger.info(f"Stored results for task ID {task_id}, memory: {usage}")
+    except TaskCancelledError as e:
+        outcome = "cancelled"
+        TaskDB.put("error", task_id, f"Task was cancelled: {e}")
+        logger.info(f"Cancelled task ID {task_id}: {e}")
     except (YFDownloadError, YFDataQualityError) as e:
         # Errors related to yahoo finance data so safe to expose
-        TaskDB.put(
-            "error",
-            task_id,
-            format_error(str(e)),
-        )
+        outcome = "data_error"
+        TaskDB.put("error", task_id, str(e))
         logger.error(f"Error for task ID {task_id}: {e}")
     except Exception as e:
-        TaskDB.put(
-            "error",
-            task_id,
-            format_error(f"Unexpected error in running task ID {task_id}"),
-        )
+        outcome = "error"
+        TaskDB.put("error", task_id, f"Unexpected error in running task ID {task_id}")
         logger.error(f"Unexpected error for task ID {task_id}: {e}")
         logger.error(traceback.format_exc())
+    finally:
+        TaskDB.drop_cancel_token(task_id)
+        TaskDB.finish(task_id)
+        MEMORY_BUDGET.release(reservation)
+        TASKS_IN_PROGRESS.dec()
+        TASKS_TOTAL.inc(outcome=outcome)
+
+
+def run_etf_optimizer(
+    task_id, optimizer: "ETFOptimizer", logger, reservation: Reservation
+):
+    def target() -> TaskResult:
+        optimizer.run_optimizer(task_id, logger, time_budget=TIME_BUDGET)
+        assert optimizer.portfolio is not None
+        return optimizer.portfolio
+
+    run_task(task_id, target, logger, "optimize", reservation)
+
+
+def run_walk_forward_backtest(
+    task_id, backtest: "WalkForwardBacktest", logger, reservation: Reservation
+):
+    def target() -> TaskResult:
+        backtest.run_backtest(task_id, logger)
+        return backtest
+
+    run_task(task_id, target, logger, "backtest", reservation)
+
+
+def start_task(args, logger) -> str:
+    """Start an optimizer or a backtest in a thread and return its task ID
+
+    args has the fields of the optimizer form, raises ValueError or KeyError
+    if they are invalid, and AdmissionError if the task does not fit in the
+    memory budget. A task larger than the whole budget runs with fewer ETFs,
+    and its result is marked as partial.
+    """
+    from backend.backtest import WalkForwardBacktest
+    from backend.etf import ETFOptimizer, write_to_log
+
+    evicted = TaskDB.evict(TASK_TTL)
+    for evicted_id in evicted:
+        MEMORY_BUDGET.forget(evicted_id)
+    # the oldest results go early when they take too much of the memory budget
+    while MEMORY_BUDGET.is_over_retained():
+        oldest_id = TaskDB.evict_oldest()
+        if oldest_id is None:
+            break
+        evicted.append(oldest_id)
+        MEMORY_BUDGET.forget(oldest_id)
+    if evicted:
+        logger.info(f"Evicted {len(evicted)} finished tasks")
+    if args["universe"] != "etf_vol":
+        raise NotImplementedError(f"Universe {args['universe']} not implemented")
+    mode = args.get("mode", "optimize")
+    method = args.get("method", "mean_variance")
+    if (mode not in MODES) or (method not in METHODS):
+        raise ValueError(f"Invalid mode {mode} or method {method}")
+    num_contracts = int(args["num_contracts"])
+    # the returns of a backtest start backtest_years before its first window
+    num_years = float(args["num_years"])
+    if mode == "backtest":
+        num_years += float(args["backtest_years"])
+    max_contracts = MEMORY_BUDGET.downsize(num_contracts, num_years)
+    cancel_token = CancelToken(max_idle=POLL_TIMEOUT)
+    run_target: Callable
+    task: Union[ETFOptimizer, WalkForwardBacktest]
+    if mode == "backtest":
+        backtest = WalkForwardBacktest(
+            args["currency"],
+            max_contracts,
+            float(args["correlation_cutoff"]),
+            float(args["num_years"]),
+            float(args["backtest_years"]),
+            int(args["rebalance_days"]),
+            cancel_token=cancel_token,
+        )
+        optimizer = backtest.optimizer
+        run_target, task = run_walk_forward_backtest, backtest
+    else:
+        optimizer = ETFOptimizer(
+            args["currency"],
+            max_contracts,
+            float(args["correlation_cutoff"]),
+            float(args["num_years"]),
+            method=method,
+            cancel_token=cancel_token,
+        )
+        run_target, task = run_etf_optimizer, optimizer
+    task_id = optimizer.now.strftime("%Y%m%d_%H%M%S_%f")
+    footprint_mb = estimate_footprint_mb(max_contracts, num_years)
+    reservation = MEMORY_BUDGET.admit(round(footprint_mb, 1))
+    thread = Thread(target=run_target, args=(task_id, task, logger, reservation))
+    TaskDB.put_cancel_token(task_id, cancel_token)
+    TaskDB.put("timings", task_id, optimizer.timings)
+    TaskDB.put("solver", task_id, optimizer.solver_telemetry)
+    # the task exists as soon as the page is redirected to it
+    TaskDB.put("log", task_id, "")
+    if max_contracts < num_contracts:
+        msg = (
+            f"Downsized from {num_contracts} to {max_contracts} ETFs to fit in "
+            f"the memory budget of {MEMORY_BUDGET.budget_mb:.0f}MB"
+        )
+        write_to_log(task_id, msg)
+        TaskDB.put("partial", task_id, msg)
+    logger.info(f"Starting optimizer thread {task_id}, estimated {footprint_mb:.0f}MB")
+    thread.start()
+    return task_id
+
+
+def render_result(task_id: str) -> str:
+    # rendered from to_dict() of the result on the first request of its page
+    html_text = TaskDB.get("html", task_id)
+    if html_text is not None:
+        return html_text
+    from backend.backtest import WalkForwardBacktest
+    from portfolio import Portfolio
+
+    result_dict = TaskDB.get("result", task_id)
+    assert result_dict is not None
+    with TaskDB.get("timings", task_id).stage("to_html"):
+        if result_dict["type"] == "backtest":
+            html_text = WalkForwardBacktest.render_html(result_dict)
+        else:
+            html_text = Portfolio.render_html(result_dict)
+    html_text = format_partial(TaskDB.get("partial", task_id)) + html_text
+    MEMORY_BUDGET.retain(task_id, get_size(html_text) / MB)
+    TaskDB.put("html", task_id, html_text)
+    return html_text
 
 
 def format_log(log_output: Optional[str]) -> str:
     if (log_output is None) or (log_output == ""):
         return ""
-    html_text = "<div class='code-box'>Progress Logs:<br>"
+    html_text = "<div class='code-box' id='log-box'>Progress Logs:<br>"
     html_text += log_output.strip().replace("\n", "<br>")
     html_text += "</div>\n"
     return html_text
 
 
+def format_partial(partial_output: Optional[str]) -> str:
+    if partial_output is None:
+        return ""
+    html_text = "<div class='code-box'>This result is partial. "
+    html_text += f"{partial_output}</div>\n"
+    return html_text
+
+
 def format_error(error_output: str) -> str:
     html_text = f"<div class='code-box'>{error_output}</div>"
     html_text += "<div class='form-container'>"
@@ -98,26 +252,34 @@ def render_optimizer(args: Optional[Dict], logger) -> Response:
         logger.info(f"Received args: {args}")
         if args["universe"] == "etf_vol":
             try:
-                optimizer = ETFOptimizer(
-                    args["currency"],
-                    int(args["num_contracts"]),
-                    float(args["correlation_cutoff"]),
-                    float(args["num_years"]),
-                )
-                task_id = optimizer.now.strftime("%Y%m%d_%H%M%S_%f")
-                thread = Thread(
-                    target=run_etf_optimizer,
-                    args=(task_id, optimizer, logger),
-                )
-                logger.info(f"Starting optimizer thread {task_id}")
-                thread.start()
+                task_id = start_task(args, logger)
                 rsp = make_response(redirect(url_for("task", task_id=task_id)))
                 rsp.set_cookie("task_id", task_id)
                 rsp.set_cookie("currency", args["currency"])
                 rsp.set_cookie("num_contracts", args["num_contracts"])
                 rsp.set_cookie("correlation_cutoff", args["correlation_cutoff"])
                 rsp.set_cookie("num_years", args["num_years"])
+                for key in ["mode", "method", "backtest_years", "rebalance_days"]:
+                    if key in args:
+                        rsp.set_cookie(key, args[key])
                 return rsp
+            except AdmissionError as e:
+                logger.warning(e)
+                return make_response(
+                    render_template(
+                        "optimizer.html",
+                        submitted=True,
+                        in_progress=False,
+                        error_output=format_error(str(e)),
+                        num_contracts=args["num_contracts"],
+                        corr=args["correlation_cutoff"],
+                        num_years=args["num_years"],
+                        mode=args.get("mode", "optimize"),
+                        method=args.get("method", "mean_variance"),
+                        backtest_years=args.get("backtest_years", BACKTEST_YEARS),
+                        rebalance_days=args.get("rebalance_days", REBALANCE_DAYS),
+                    ),
+                )
             except ValueError as e:
                 logger.error(e)
                 # need a better alternative to just ignore bad input
@@ -130,6 +292,8 @@ def render_optimizer(args: Optional[Dict], logger) -> Response:
                         num_contracts=NUM_CONTRACTS,
                         corr=CORR,
                         num_years=NUM_YEARS,
+                        backtest_years=BACKTEST_YEARS,
+                        rebalance_days=REBALANCE_DAYS,
                     ),
                 )
         else:
@@ -144,5 +308,7 @@ def render_optimizer(args: Optional[Dict], logger) -> Response:
                 num_contracts=NUM_CONTRACTS,
                 corr=CORR,
                 num_years=NUM_YEARS,
+                backtest_years=BACKTEST_YEARS,
+                rebalance_days=REBALANCE_DAYS,
             ),
         )
@@ -8,9 +8,14 @@ import pandas as pd
 from flask import Response, make_response, render_template
 
 from backend.yf_utils import YFError, YFReturnsCache
+from memory import MEMORY_SAMPLER
+from metrics import TaskTimings
 from portfolio import Portfolio
+from projection import PERCENTILES, Projection, project_portfolio
 
 MIN_INV_PCT = 10
+NUM_PROJECTION_PATHS = 10000
+PROJECTION_SEED = 0
 
 
 class PlotPortfolio:
@@ -23,6 +28,7 @@ class PlotPortfolio:
         sip_amount: float,
         sip_frequency_days: int,
         logger,
+        projection_years: float = 0,
     ):
         self.portfolio = portfolio
         self.start_date = start_date
@@ -30,6 +36,9 @@ class PlotPortfolio:
         self.sip_amount = sip_amount
         self.sip_frequency_days = sip_frequency_days
         self.logger = logger
+        self.projection_years = projection_years
+        self.projection: Optional[Projection] = None
+        self.timings = TaskTimings()
 
     def populate_price_returns(self):
         return_series = {}
@@ -39,6 +48,7 @@ class PlotPortfolio:
             self.portfolio.weight_map.keys(),
             impute_prices=True,
             return_column="Adj Close",
+            timings=self.timings,
         )
         for tickr in self.portfolio.weight_map.keys():
             try:
@@ -99,11 +109,97 @@ class PlotPortfolio:
         self.min_inv_made_date = self.min_inv_made[self.min_inv_made].index[0]
         self.logger.info(f"Set up price series w/ SIP: {self.price_series_sip.shape}")
 
+    def project(self, num_paths=NUM_PROJECTION_PATHS):
+        assert self.return_series is not None
+        num_years = (
+            pd.Timestamp(self.end_date) - pd.Timestamp(self.start_date)
+        ) / pd.Timedelta(days=365)
+        self.num_days_per_year = len(self.return_series) / num_years
+        horizon = max(1, int(round(self.projection_years * self.num_days_per_year)))
+        sip_frequency = max(
+            1, int(round(self.sip_frequency_days * self.num_days_per_year / 365))
+        )
+        self.projection = project_portfolio(
+            self.return_series.to_numpy(),
+            horizon,
+            self.sip_amount,
+            sip_frequency,
+            num_paths=num_paths,
+            seed=PROJECTION_SEED,
+        )
+        self.logger.info(
+            f"Projected {num_paths} paths over {horizon} days "
+            f"(SIP every {sip_frequency} days)"
+        )
+
+    def plot_projection(self, axes):
+        assert self.projection is not None
+        years = self.projection.days / self.num_days_per_year
+        lo, mid, hi = (
+            PERCENTILES[0],
+            PERCENTILES[len(PERCENTILES) // 2],
+            PERCENTILES[-1],
+        )
+        for ax, bands, invested, title in zip(
+            axes,
+            [self.projection.one_time_bands, self.projection.sip_bands],
+            [
+                np.full(len(years), self.projection.one_time_invested),
+                self.projection.invested,
+            ],
+            [
+                "Projected Value with One-Time-Investment",
+                "Projected Value with SIP",
+            ],
+        ):
+            ax.fill_between(
+                years,
+                bands[lo],
+                bands[hi],
+                color="blue",
+                alpha=0.15,
+                label=f"{lo}th-{hi}th percentile",
+            )
+            ax.fill_between(
+                years,
+                bands[PERCENTILES[1]],
+                bands[PERCENTILES[-2]],
+                color="blue",
+                alpha=0.3,
+                label=f"{PERCENTILES[1]}th-{PERCENTILES[-2]}th percentile",
+            )
+            ax.plot(years, bands[mid], color="blue", label="Median")
+            ax.plot(
+                years,
+                invested,
+                color="red",
+                linestyle="--",
+                linewidth=0.5,
+                label="Cumulative Investment Made",
+            )
+            ax.set_title(title)
+            ax.set_xlabel("Years from now")
+            ax.set_ylabel("Value")
+            ax.grid()
+            ax.legend()
+
     def plot(self):
-        self.populate_price_returns()
-        self.get_portfolio_value_series()
+        with self.timings.stage("plot_returns"):
+            self.populate_price_returns()
+        with self.timings.stage("plot_value_series"):
+            self.get_portfolio_value_series()
+        nrows = 2
+        if self.projection_years > 0:
+            with self.timings.stage("plot_projection"):
+                self.project()
+            nrows = 4
+        with self.timings.stage("plot_render"):
+            plot_url = self.render_figure(nrows)
+        self.logger.info(f"Plotted portfolio value, time per stage: {self.timings}")
+        return plot_url
 
-        fig, axes = plt.subplots(nrows=2, ncols=1, figsize=(20, 20))
+    def render_figure(self, nrows: int) -> str:
+        fig, axes = plt.subplots(nrows=nrows, ncols=1, figsize=(20, 10 * nrows))
         for ax, df, title in zip(
             axes,
             [self.price_series, self.price_series_sip],
@@ -153,13 +249,14 @@ class PlotPortfolio:
 
         axes[0].legend()
         axes[1].legend()
+        if self.projection is not None:
+            self.plot_projection(axes[2:])
 
         img = BytesIO()
         plt.savefig(img, format="png", bbox_inches="tight")
         img.seek(0)
         plot_url = base64.b64encode(img.getvalue()).decode()
         plt.close()
-        self.logger.info("Plotted portfolio value")
         return plot_url
 
     def description(self):
@@ -255,10 +352,40 @@ class PlotPortfolio:
             " of the total investment is made to avoid inconsequential outliers."
         )
         html_text += "</p>\n"
+        if self.projection is not None:
+            html_text += self.projection_description()
         html_text += "</div>"
 
         return html_text
 
+    def projection_description(self):
+        assert self.projection is not None
+        html_text = "<h2>Projected Performance</h2>\n"
+        html_text += (
+            f"<p>{len(self.projection.sip_final):,} paths over the next "
+            f"{self.projection_years:g} years, simulated by resampling blocks "
+            "of historical daily returns of the portfolio.</p>\n"
+        )
+        html_text += "<table class='table-metrics'><tr><th>Percentile</th>"
+        html_text += "<th>One-Time-Investment Value</th><th>Max Drawdown</th>"
+        html_text += "<th>SIP Value</th><th>Max Drawdown%-age</th></tr>\n"
+        one_time_final = np.percentile(self.projection.one_time_final, PERCENTILES)
+        one_time_dd = np.percentile(self.projection.one_time_drawdown, PERCENTILES)
+        sip_final = np.percentile(self.projection.sip_final, PERCENTILES)
+        sip_dd = np.percentile(self.projection.sip_drawdown, PERCENTILES)
+        for pct, ot_val, ot_dd, sip_val, s_dd in zip(
+            PERCENTILES, one_time_final, one_time_dd, sip_final, sip_dd
+        ):
+            html_text += f"<tr><td>{pct}th</td><td>${ot_val:,.2f}</td>"
+            html_text += f"<td>{ot_dd:.2%}</td><td>${sip_val:,.2f}</td>"
+            html_text += f"<td>{s_dd:.2%}</td></tr>\n"
+        html_text += "</table>\n"
+        html_text += (
+            f"<p>Amount invested: ${self.projection.one_time_invested:,.2f} "
+            f"(one-time), ${self.projection.invested[-1]:,.2f} (SIP)</p>\n"
+        )
+        return html_text
+
 
 def plot_portfolio(args: Optional[dict], cookies: Dict, logger) -> Response:
     start = (pd.Timestamp.now("UTC") - pd.Timedelta(days=365 * 5)).strftime("%Y-%m-%d")
@@ -269,6 +396,7 @@ def plot_portfolio(args: Optional[dict], cookies: Dict, logger) -> Response:
         "end_date": cookies.get("end_date", end),
         "sip_amount": cookies.get("sip_amount", "1000"),
         "sip_frequency_days": cookies.get("sip_frequency_days", "30"),
+        "projection_years": cookies.get("projection_years", "0"),
         "min_inv": MIN_INV_PCT,
     }
     try:
@@ -283,9 +411,14 @@ def plot_portfolio(args: Optional[dict], cookies: Dict, logger) -> Response:
                 float(args["sip_amount"]),
                 int(args["sip_frequency_days"]),
                 logger,
+                projection_years=float(args.get("projection_years", 0)),
             )
-            plot_url = plotter.plot()
-            desc = plotter.description()
+            # plots are not admitted against the memory budget, the
+            # projection is already simulated in bounded chunks
+            with MEMORY_SAMPLER.track("plot") as usage:
+                plot_url = plotter.plot()
+                with plotter.timings.stage("plot_description"):
+                    desc = plotter.description()
             for key, val in args.items():
                 default_vals[key] = val
             rsp = make_response(
@@ -297,7 +430,7 @@ def plot_portfolio(args: Optional[dict], cookies: Dict, logger) -> Response:
                     **default_vals,
                 ),
             )
-            logger.info("Plotted portfolio")
+            logger.info(f"Plotted portfolio, memory: {usage}")
             for key, val in args.items():
                 rsp.set_cookie(key, val)
             return rsp
@@ -0,0 +1,103 @@
+import os
+import threading
+import time
+from typing import Iterator, Optional
+
+from metrics import Gauge
+from web.tasks import TaskDB, TaskState
+
+# seconds between comments sent to keep an idle stream open
+HEARTBEAT_SECONDS = 15
+# every open stream holds a thread of the server, so the streams are limited
+# to part of its THREADS, and end after MAX_STREAM_SECONDS, when the browser
+# reconnects; the pages beyond the limit reload every POLL_SECONDS instead
+MAX_STREAMS = int(os.getenv("MAX_STREAMS", "16"))
+MAX_STREAM_SECONDS = float(os.getenv("MAX_STREAM_SECONDS", "300"))
+POLL_SECONDS = 10
+
+EVENT_STREAMS = Gauge(
+    "etf_optimizer_event_streams", "Open event streams of the progress pages"
+)
+
+
+class StreamSlots(object):
+    def __init__(self, max_streams: int = MAX_STREAMS):
+        self.max_streams = max_streams
+        self.num_streams = 0
+        self.lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        with self.lock:
+            if self.num_streams >= self.max_streams:
+                return False
+            self.num_streams += 1
+            EVENT_STREAMS.set(self.num_streams)
+            return True
+
+    def release(self) -> None:
+        with self.lock:
+            self.num_streams -= 1
+            EVENT_STREAMS.set(self.num_streams)
+
+
+STREAM_SLOTS = StreamSlots()
+
+
+def format_event(event: str, data: str, event_id: Optional[int] = None) -> str:
+    text = f"event: {event}\n"
+    if event_id is not None:
+        text += f"id: {event_id}\n"
+    return text + f"data: {data}\n\n"
+
+
+def parse_offset(value: Optional[str]) -> int:
+    # number of log lines a client already has, from Last-Event-ID or offset
+    try:
+        return max(0, int(value or 0))
+    except ValueError:
+        return 0
+
+
+def stream_task_events(task_id: str, offset: int = 0) -> Iterator[str]:
+    """Server-sent events with the progress of a task
+
+    A "log" event is sent for every new log line, with the number of lines
+    sent so far as its ID, so that a reconnecting client can pass it back as
+    Last-Event-ID (or offset) and only get the lines it missed. A "state"
+    event is sent when the state changes, and the stream ends once the task
+    has succeeded or failed, or after MAX_STREAM_SECONDS. If MAX_STREAMS are
+    already open, a single "poll" event tells the client to poll every
+    POLL_SECONDS instead.
+    """
+    if not STREAM_SLOTS.acquire():
+        yield format_event("poll", str(POLL_SECONDS))
+        return
+    try:
+        deadline = time.monotonic() + MAX_STREAM_SECONDS
+        state = None
+        version = TaskDB.version
+        # write_to_log appends every line as "\n" + line to the stripped log,
+        # so only what follows the part already read is split
+        num_read = 0
+        num_lines = 0
+        while True:
+            # an open stream counts as polling the task
+            TaskDB.poll(task_id)
+            log_text = (TaskDB.get("log", task_id) or "").rstrip()
+            for line in log_text[num_read:].split("\n")[1:]:
+                num_lines += 1
+                if num_lines > offset:
+                    yield format_event("log", line, num_lines)
+            num_read = len(log_text)
+            new_state = TaskDB.get_state(task_id)
+            if new_state != state:
+                state = new_state
+                yield format_event("state", state.value)
+            if (state != TaskState.IN_PROGRESS) or (time.monotonic() > deadline):
+                return
+            new_version = TaskDB.wait_for_update(version, HEARTBEAT_SECONDS)
+            if new_version == version:
+                yield ": keep-alive\n\n"
+            version = new_version
+    finally:
+        STREAM_SLOTS.release()
@@ -0,0 +1,127 @@
+import threading
+import time
+from enum import Enum
+from typing import Any, Dict, List, Optional
+
+from task_control import CancelToken
+
+
+class TaskState(Enum):
+    NOT_FOUND = "NOT_FOUND"
+    IN_PROGRESS = "IN_PROGRESS"
+    SUCCESS = "SUCCESS"
+    FAILURE = "FAILURE"
+
+
+class TaskDB(object):
+    task_data: Dict[str, Dict[str, Any]] = {
+        "error": {},
+        # to_dict() of the Portfolio or WalkForwardBacktest, the result itself
+        # is dropped with its returns once the task finishes
+        "result": {},
+        # the page rendered from it, once it was requested
+        "html": {},
+        "log": {},
+        # why a successful result is partial, e.g. the time budget ran out
+        "partial": {},
+        # TaskTimings of the stages of the task
+        "timings": {},
+        # SolverTelemetry of the solves of the task
+        "solver": {},
+        # MemoryUsage of the task once it starts
+        "memory": {},
+    }
+    cancel_tokens: Dict[str, CancelToken] = {}
+    # time.monotonic() when the task finished, see evict()
+    finished: Dict[str, float] = {}
+    # bumped on every put, so that streams can wait for new data
+    version = 0
+    condition = threading.Condition()
+
+    @classmethod
+    def get(cls, key: str, task_id: str) -> Any:
+        return cls.task_data[key].get(task_id)
+
+    @classmethod
+    def put(cls, key: str, task_id: str, result) -> None:
+        with cls.condition:
+            cls.task_data[key][task_id] = result
+            cls.version += 1
+            cls.condition.notify_all()
+
+    @classmethod
+    def wait_for_update(cls, version: int, timeout: float) -> int:
+        # wait until something is put after version, returns the new version
+        with cls.condition:
+            cls.condition.wait_for(lambda: cls.version != version, timeout=timeout)
+            return cls.version
+
+    @classmethod
+    def contains(cls, key: str, task_id: str) -> bool:
+        return task_id in cls.task_data[key]
+
+    @classmethod
+    def put_cancel_token(cls, task_id: str, cancel_token: CancelToken) -> None:
+        cls.cancel_tokens[task_id] = cancel_token
+
+    @classmethod
+    def drop_cancel_token(cls, task_id: str) -> None:
+        # once the task finished, there is nothing left to cancel
+        cls.cancel_tokens.pop(task_id, None)
+
+    @classmethod
+    def poll(cls, task_id: str) -> None:
+        # a task is cancelled if no one polls it for a while
+        if task_id in cls.cancel_tokens:
+            cls.cancel_tokens[task_id].poll()
+
+    @classmethod
+    def cancel(cls, task_id: str, reason: str) -> bool:
+        if task_id not in cls.cancel_tokens:
+            return False
+        cls.cancel_tokens[task_id].cancel(reason)
+        return True
+
+    @classmethod
+    def finish(cls, task_id: str) -> None:
+        with cls.condition:
+            cls.finished[task_id] = time.monotonic()
+
+    @classmethod
+    def remove(cls, task_id: str) -> None:
+        # drop everything about a finished task
+        with cls.condition:
+            for data in cls.task_data.values():
+                data.pop(task_id, None)
+            cls.cancel_tokens.pop(task_id, None)
+            del cls.finished[task_id]
+
+    @classmethod
+    def evict(cls, ttl: float) -> List[str]:
+        # the tasks that finished more than ttl seconds ago
+        cutoff = time.monotonic() - ttl
+        with cls.condition:
+            expired = [x for x, finished in cls.finished.items() if finished < cutoff]
+            for task_id in expired:
+                cls.remove(task_id)
+        return expired
+
+    @classmethod
+    def evict_oldest(cls) -> Optional[str]:
+        # the task that finished first, None if no task has finished
+        with cls.condition:
+            if not cls.finished:
+                return None
+            task_id = min(cls.finished, key=cls.finished.__getitem__)
+            cls.remove(task_id)
+        return task_id
+
+    @classmethod
+    def get_state(cls, task_id: str):
+        if task_id not in cls.task_data["log"]:
+            return TaskState.NOT_FOUND
+        if task_id in cls.task_data["result"]:
+            return TaskState.SUCCESS
+        if task_id in cls.task_data["error"]:
+            return TaskState.FAILURE
+        return TaskState.IN_PROGRESS